@@ -13,7 +13,7 @@ from django.conf import settings
 from chat.mongo import get_db
 from datetime import datetime
 from .forms import CustomUserCreationForm
-from django.contrib.auth.views import LoginView
+from django.contrib.auth.views import LoginView, LogoutView
 from django_ratelimit.decorators import ratelimit
 from django.apps import apps
 from django.contrib.auth import get_user_model
@@ -34,14 +34,12 @@ class CustomLoginView(LoginView):
         if user:
             refresh = RefreshToken.for_user(user)
             access_token = str(refresh.access_token)
-            # Pass the access token to the template context
-            redirect_url = reverse('home')
-            response = redirect(redirect_url)
-            # Set the access token in an HTTP-only cookie for security
+            # Set the access token in an HTTP-only cookie for security; WebSocket connects
+            # authenticate with it (chat/jwt_auth.py). The redirect honours ?next like LoginView's.
             response.set_cookie(
                 key=settings.SIMPLE_JWT['AUTH_COOKIE'],
                 value=access_token,
-                expires=settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'],
+                max_age=settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'],
                 secure=settings.SIMPLE_JWT['AUTH_COOKIE_SECURE'],
                 httponly=settings.SIMPLE_JWT['AUTH_COOKIE_HTTP_ONLY'],
                 samesite=settings.SIMPLE_JWT['AUTH_COOKIE_SAMESITE']
@@ -53,6 +51,16 @@ class CustomLoginView(LoginView):
         self.model = get_user_model()
         return super().dispatch(request, *args, **kwargs)
 
+class CustomLogoutView(LogoutView):
+    def post(self, request, *args, **kwargs):
+        response = super().post(request, *args, **kwargs)
+        # Otherwise WebSockets would keep authenticating with the token until it expires
+        response.delete_cookie(
+            settings.SIMPLE_JWT['AUTH_COOKIE'],
+            samesite=settings.SIMPLE_JWT['AUTH_COOKIE_SAMESITE'],
+        )
+        return response
+
 class SignUpView(generic.CreateView):
     form_class = CustomUserCreationForm
     success_url = reverse_lazy('login')
@@ -0,0 +1,122 @@
+"""Per-recipient CPU cost of broadcasting one frame, before and after serialize-once fan-out.
+
+Before: the event carries the message dict and every receiving consumer calls json.dumps.
+After:  the sender encodes the JSON text once (chat.codec.prepared_event) and every JSON
+        consumer forwards the ready-made string. A msgpack (compact) consumer either
+        re-encodes from that text (default) or, with WS_PREPACK_MSGPACK, forwards the
+        msgpack copy the sender added to every event.
+
+All variants include the channel layer's own msgpack round trip of the event per recipient.
+The event size on the channel layer is reported too, since the prepacked copy is carried to
+every recipient whether or not it uses it.
+
+    python benchmarks/fanout_serialization.py --recipients 1000 --repeat 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import msgpack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "videochat.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from chat import codec  # noqa: E402
+from chat.codec import COMPACT, JSON, frame_for, prepared_event  # noqa: E402
+
+MESSAGES = {
+    "user_status": {"type": "user_status", "username": "alice", "is_online": True},
+    "chat": {
+        "type": "chat",
+        "from": "alice",
+        "event_type": "chat",
+        "sender": "alice",
+        "recipient": "bob",
+        "room": "alice_bob",
+        "message": "Hey! Are we still on for the call later this afternoon? " * 2,
+        "message_id": "66f1c0ffee0000000000beef",
+        "timestamp": "2026-10-18T12:34:56.789012",
+        "read": False,
+        "temp_message_id": "temp-1729254896789",
+    },
+}
+
+
+def _channel_layer_hop(event):
+    # What channels_redis does to every event on its way to a consumer
+    return msgpack.unpackb(msgpack.packb(event, use_bin_type=True), raw=False)
+
+
+def _prepared(message, prepack):
+    codec.PREPACK_COMPACT = prepack
+    try:
+        return prepared_event("room_event", message)
+    finally:
+        codec.PREPACK_COMPACT = False
+
+
+def before(message, recipients, socket_codec=JSON):
+    event = {"type": "room_event", "message": message}
+    for _ in range(recipients):
+        received = _channel_layer_hop(event)
+        socket_codec.encode(received["message"])
+
+
+def after(message, recipients, socket_codec=JSON, prepack=False):
+    event = _prepared(message, prepack)
+    for _ in range(recipients):
+        frame_for(_channel_layer_hop(event), socket_codec)
+
+
+def measure(fn, message, recipients, repeat, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.process_time()
+        fn(message, recipients, **kwargs)
+        best = min(best, time.process_time() - started)
+    return best / recipients * 1e6 # microseconds of CPU per recipient
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results.")
+    args = parser.parse_args()
+
+    results = {}
+    for name, message in MESSAGES.items():
+        m = lambda fn, **kw: measure(fn, message, args.recipients, args.repeat, **kw)
+        results[name] = {
+            "before_us_per_recipient": m(before),
+            "after_us_per_recipient": m(after),
+            "prepacked_us_per_recipient": m(after, prepack=True),
+            "compact_before_us_per_recipient": m(before, socket_codec=COMPACT),
+            "compact_after_us_per_recipient": m(after, socket_codec=COMPACT),
+            "compact_prepacked_us_per_recipient": m(after, socket_codec=COMPACT, prepack=True),
+            "event_bytes": len(msgpack.packb(_prepared(message, False), use_bin_type=True)),
+            "prepacked_event_bytes": len(msgpack.packb(_prepared(message, True), use_bin_type=True)),
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("CPU per recipient (us)     JSON sockets               compact sockets         event bytes")
+    print(f"{'frame':<14}{'before':>8}{'after':>8}{'prepack':>9}{'before':>10}{'after':>8}{'prepack':>9}{'default':>10}{'prepack':>9}")
+    for name, r in results.items():
+        print(
+            f"{name:<14}{r['before_us_per_recipient']:>8.2f}{r['after_us_per_recipient']:>8.2f}"
+            f"{r['prepacked_us_per_recipient']:>9.2f}{r['compact_before_us_per_recipient']:>10.2f}"
+            f"{r['compact_after_us_per_recipient']:>8.2f}{r['compact_prepacked_us_per_recipient']:>9.2f}"
+            f"{r['event_bytes']:>10}{r['prepacked_event_bytes']:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Key spread and rebalancing cost of the consistent hash ring, plus an optional live check.
+
+Offline: how evenly group/user names land on N shards, and what fraction moves when a
+shard is added (ideally ~1/(N+1)).
+
+Live: with several local Redis processes, e.g.
+
+    for p in 6380 6381 6382; do redis-server --port $p --save '' --daemonize yes; done
+    python benchmarks/shard_distribution.py --urls redis://localhost:6380,redis://localhost:6381,redis://localhost:6382
+
+sends a message to groups spread over every shard through the sharded channel layer
+(both backends) and checks each arrives, then reports which shard holds each group.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chat.sharding import HashRing, ShardedRedisChannelLayer, ShardedRedisPubSubChannelLayer, parse_urls  # noqa: E402
+
+
+def offline(shards, keys):
+    nodes = [f"redis://shard{i}" for i in range(shards)]
+    ring = HashRing(nodes)
+    names = [f"user_{i}" for i in range(keys)]
+    spread = Counter(ring.index(n) for n in names)
+    grown = HashRing(nodes + [f"redis://shard{shards}"])
+    moved = sum(nodes[ring.index(n)] != grown.nodes[grown.index(n)] for n in names)
+    print(f"{shards} shards, {keys} keys")
+    for index in range(shards):
+        print(f"  shard {index}: {spread[index] / keys:.1%}")
+    print(f"  adding a shard moves {moved / keys:.1%} of keys (ideal {1 / (shards + 1):.1%})")
+
+
+async def live(layer_class, urls, groups):
+    layer = layer_class(hosts=urls)
+    channel = await layer.new_channel()
+    names = [f"bench_{i}" for i in range(groups)]
+    for name in names:
+        await layer.group_add(name, channel)
+    # Let pub/sub subscriptions settle before publishing
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    for name in names:
+        await layer.group_send(name, {"type": "bench", "group": name})
+    received = set()
+    while len(received) < groups:
+        message = await asyncio.wait_for(layer.receive(channel), timeout=5)
+        received.add(message["group"])
+    elapsed = time.perf_counter() - start
+    for name in names:
+        await layer.group_discard(name, channel)
+    await layer.flush()
+    ring = HashRing(urls)
+    spread = Counter(urls[ring.index(n)] for n in names)
+    print(f"{layer_class.__name__}: {groups} group sends in {elapsed * 1000:.1f} ms")
+    for url in urls:
+        print(f"  {url}: {spread[url]} groups")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--urls", help="comma-separated Redis URLs for the live check")
+    parser.add_argument("--groups", type=int, default=200)
+    args = parser.parse_args()
+
+    offline(args.shards, args.keys)
+    urls = parse_urls(args.urls)
+    if urls:
+        for layer_class in (ShardedRedisChannelLayer, ShardedRedisPubSubChannelLayer):
+            asyncio.run(live(layer_class, urls, args.groups))
+
+
+if __name__ == "__main__":
+    main()
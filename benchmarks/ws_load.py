@@ -0,0 +1,526 @@
+"""Load generator for ChatConsumer: throughput, end-to-end latency and memory per connection.
+
+Scenarios (run in order, on one set of connected clients paired up as 1:1 chats):
+
+    connect     connect storm, --concurrency handshakes in flight at a time
+    chat        each client sends --messages chat frames to its pair
+    typing      alternating typing on/off frames (every frame is a state change)
+    read        read_up_to frames with increasing ids; coalesced into read_watermark frames
+    signaling   offer/ice/answer frames routed with "to"
+
+In-process (default), clients are channels.testing.WebsocketCommunicator instances on an
+in-memory channel layer, with fakeredis for presence and an in-memory stand-in for Mongo
+that accepts the writes the consumer makes and returns empty reads. --redis and
+--mongo-uri switch to local servers instead. Web push and inbound rate limits are
+disabled; push never runs on the socket's path. Against a live server, raise
+WS_RATE_LIMITS there or the run measures throttling. InMemoryChannelLayer scans every channel for expired messages on each
+send, so for runs beyond a few hundred clients use --redis to avoid measuring that.
+
+    python benchmarks/ws_load.py --clients 2000 --messages 20 --output bench.json
+
+Against a running server (needs the "websockets" package; sessions are created for
+bench_<n> users in the server's database):
+
+    daphne -p 8000 videochat.asgi:application
+    python benchmarks/ws_load.py --url ws://localhost:8000 --clients 500
+
+The JSON written to --output includes the git commit, so runs can be compared across commits.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "videochat.settings")
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+SCENARIOS = ("connect", "chat", "typing", "read", "signaling")
+SIGNALING_TYPES = ("offer", "ice", "ice", "answer")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(latencies_ns):
+    ms = [v / 1e6 for v in latencies_ns]
+    return {
+        "p50": percentile(ms, 50),
+        "p90": percentile(ms, 90),
+        "p99": percentile(ms, 99),
+        "max": max(ms) if ms else None,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Mongo stand-in: enough of the async collection API for the consumer's hot paths
+# ---------------------------------------------------------------------------
+
+class _EmptyCursor:
+    def sort(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args):
+        return self
+
+    def batch_size(self, *args):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+
+class MemoryCollection:
+    """Counts writes instead of storing documents, so it does not skew memory figures."""
+
+    def __init__(self):
+        self.writes = 0
+
+    async def insert_one(self, doc):
+        self.writes += 1
+
+    async def insert_many(self, docs, ordered=True):
+        self.writes += len(docs)
+
+    async def update_one(self, query, update, upsert=False):
+        self.writes += 1
+
+    async def find_one(self, *args, **kwargs):
+        return None
+
+    def find(self, *args, **kwargs):
+        return _EmptyCursor()
+
+
+class MemoryDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, MemoryCollection())
+
+    __getattr__ = __getitem__
+
+
+# ---------------------------------------------------------------------------
+# Clients
+# ---------------------------------------------------------------------------
+
+class InProcessClient:
+    def __init__(self, app, username, room):
+        from channels.testing import WebsocketCommunicator
+
+        self.username = username
+        self.comm = WebsocketCommunicator(app, f"/ws/chat/{room}/")
+        self.comm.scope["user"] = SimpleNamespace(username=username, is_authenticated=True)
+        self.on_frame = None
+        self._reader = None
+
+    async def connect(self):
+        connected, _ = await self.comm.connect(timeout=60)
+        if connected:
+            self._reader = asyncio.create_task(self._read())
+        return connected
+
+    async def _read(self):
+        # Read the output queue directly; receive_from() cancels the app on timeout
+        while True:
+            message = await self.comm.output_queue.get()
+            if message["type"] != "websocket.send":
+                return
+            if self.on_frame is not None:
+                self.on_frame(self, json.loads(message["text"]))
+
+    async def send(self, frame):
+        await self.comm.send_to(text_data=json.dumps(frame))
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.comm.disconnect()
+
+
+class LiveClient:
+    def __init__(self, url, cookie, username, room):
+        self.username = username
+        self.url = f"{url.rstrip('/')}/ws/chat/{room}/"
+        self.cookie = cookie
+        self.on_frame = None
+        self._ws = None
+        self._reader = None
+
+    async def connect(self):
+        import websockets
+
+        origin = self.url.replace("ws://", "http://").replace("wss://", "https://").split("/ws/")[0]
+        self._ws = await websockets.connect(
+            self.url, additional_headers={"Cookie": self.cookie}, origin=origin, max_queue=None
+        )
+        self._reader = asyncio.create_task(self._read())
+        return True
+
+    async def _read(self):
+        async for text in self._ws:
+            if self.on_frame is not None:
+                self.on_frame(self, json.loads(text))
+
+    async def send(self, frame):
+        await self._ws.send(json.dumps(frame))
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self._ws.close()
+
+
+def live_session_cookie(username):
+    """Creates (or reuses) a user and a logged-in session in the server's database."""
+    from importlib import import_module
+
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+
+    user, created = get_user_model().objects.get_or_create(username=username)
+    if created:
+        user.set_unusable_password()
+        user.save()
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return f"{settings.SESSION_COOKIE_NAME}={session.session_key}"
+
+
+# ---------------------------------------------------------------------------
+# Scenarios
+# ---------------------------------------------------------------------------
+
+class Recorder:
+    def __init__(self, is_done):
+        self.is_done = is_done
+        self.latencies = []
+        self.done = asyncio.Event()
+        if is_done(0):
+            self.done.set()
+
+    def hit(self, sent_ns):
+        self.latencies.append(time.perf_counter_ns() - sent_ns)
+        if self.is_done(len(self.latencies)):
+            self.done.set()
+
+
+async def run_phase(clients, pairs, frames_per_sender, make_frame, match, timeout, is_done=None):
+    """Sends make_frame(i, sender, receiver) frames_per_sender times per pair and records deliveries.
+
+    match(receiver, frame) returns the send timestamp for frames that count, else None.
+    The phase ends once is_done(delivered) holds (by default: every frame delivered).
+    """
+    expected = len(pairs) * frames_per_sender
+    recorder = Recorder(is_done or (lambda delivered: delivered >= expected))
+
+    def on_frame(client, frame):
+        sent_ns = match(client, frame)
+        if sent_ns is not None:
+            recorder.hit(sent_ns)
+
+    for client in clients:
+        client.on_frame = on_frame
+
+    async def sender(a, b):
+        for i in range(frames_per_sender):
+            await a.send(make_frame(i, a, b))
+            await asyncio.sleep(0) # Let the consumer and readers interleave like real traffic
+
+    start = time.perf_counter()
+    await asyncio.gather(*(sender(a, b) for a, b in pairs))
+    sent_duration = time.perf_counter() - start
+    timed_out = False
+    try:
+        await asyncio.wait_for(recorder.done.wait(), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+    duration = time.perf_counter() - start
+    for client in clients:
+        client.on_frame = None
+    delivered = len(recorder.latencies)
+    return {
+        "frames_sent": len(pairs) * frames_per_sender,
+        "frames_delivered": delivered,
+        "send_duration_s": round(sent_duration, 4),
+        "duration_s": round(duration, 4),
+        "msgs_per_sec": round(delivered / duration, 1) if duration else None,
+        "latency_ms": latency_summary(recorder.latencies),
+        "timed_out": timed_out,
+    }
+
+
+async def connect_all(clients, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(client):
+        async with semaphore:
+            started = time.perf_counter_ns()
+            ok = await client.connect()
+            latencies.append(time.perf_counter_ns() - started)
+            return ok
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(c) for c in clients), return_exceptions=True)
+    duration = time.perf_counter() - start
+    failed = sum(1 for r in results if r is not True)
+    return {
+        "clients": len(clients),
+        "failed": failed,
+        "duration_s": round(duration, 4),
+        "connects_per_sec": round(len(clients) / duration, 1) if duration else None,
+        "latency_ms": latency_summary(latencies),
+    }
+
+
+def build_clients(make_client, count):
+    from chat.views import _pair_room_name
+
+    names = [f"bench_{i}" for i in range(count - count % 2)]
+    clients = []
+    for i in range(0, len(names), 2):
+        room = _pair_room_name(names[i], names[i + 1])
+        clients.append(make_client(names[i], room))
+        clients.append(make_client(names[i + 1], room))
+    pairs = [(clients[i], clients[i + 1]) for i in range(0, len(clients), 2)]
+    return clients, pairs
+
+
+async def measure_memory(make_client, count, concurrency):
+    """Python heap allocated per open in-process connection (consumer, communicator, layer state)."""
+    clients, _ = build_clients(make_client, count)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    await connect_all(clients, concurrency)
+    await asyncio.sleep(0.2)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    grown = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+    return round(grown / len(clients) / 1024, 2)
+
+
+async def run(args):
+    from bson.objectid import ObjectId
+
+    from chat import mongo, push
+    from chat.persistence import chat_writer
+    from chat.views import _pair_room_name
+
+    if args.url:
+        from asgiref.sync import sync_to_async
+
+        cookies = {}
+        for i in range(args.clients):
+            name = f"bench_{i}"
+            cookies[name] = await sync_to_async(live_session_cookie)(name)
+
+        def make_client(username, room):
+            return LiveClient(args.url, cookies[username], username, room)
+    else:
+        from channels.routing import URLRouter
+
+        from chat.routing import websocket_urlpatterns
+
+        if not args.mongo_uri:
+            mongo._async_db = MemoryDatabase()
+            mongo._async_loop = asyncio.get_running_loop()
+        push.dispatcher.enqueue = lambda *a, **kw: None
+        app = URLRouter(websocket_urlpatterns)
+
+        def make_client(username, room):
+            return InProcessClient(app, username, room)
+
+    clients, pairs = build_clients(make_client, args.clients)
+    results = {}
+    scenarios = [s for s in SCENARIOS if s in args.scenarios]
+
+    results["connect"] = await connect_all(clients, args.concurrency)
+    await asyncio.sleep(0.5) # Let join/presence frames settle
+
+    def ts_field(receiver_type):
+        def match(client, frame):
+            if frame.get("type") == receiver_type and frame.get("from") != client.username:
+                return frame.get("bench_ts")
+            return None
+        return match
+
+    if "chat" in scenarios:
+        results["chat"] = await run_phase(
+            clients, pairs, args.messages,
+            lambda i, a, b: {
+                "type": "chat", "recipient": b.username, "message": f"bench message {i}",
+                "temp_message_id": f"t{i}", "bench_ts": time.perf_counter_ns(),
+            },
+            ts_field("chat"), args.timeout,
+        )
+
+    if "typing" in scenarios:
+        pending = {b.username: deque() for _, b in pairs}
+
+        def typing_frame(i, a, b):
+            pending[b.username].append(time.perf_counter_ns())
+            return {"type": "typing", "recipient": b.username, "is_typing": i % 2 == 0}
+
+        def typing_match(client, frame):
+            queue = pending.get(client.username)
+            if frame.get("type") == "typing_indicator" and queue:
+                return queue.popleft()
+            return None
+
+        results["typing"] = await run_phase(
+            clients, pairs, args.messages - args.messages % 2, typing_frame, typing_match, args.timeout,
+        )
+
+    if "read" in scenarios:
+        sent_at, last_id, caught_up = {}, {}, set()
+
+        def read_frame(i, reader, author):
+            # The reader acknowledges a newer message each time; the author gets read_watermark frames
+            message_id = str(ObjectId())
+            sent_at[message_id] = time.perf_counter_ns()
+            last_id[author.username] = message_id
+            return {
+                "type": "read_up_to", "room": _pair_room_name(reader.username, author.username),
+                "peer": author.username, "message_id": message_id,
+            }
+
+        def read_match(client, frame):
+            if frame.get("type") != "read_watermark":
+                return None
+            if frame.get("message_id") == last_id.get(client.username):
+                caught_up.add(client.username)
+            return sent_at.get(frame.get("message_id"))
+
+        # Coalescing means only some ids are delivered; the phase ends when every author saw the last one
+        results["read"] = await run_phase(
+            clients, [(b, a) for a, b in pairs], args.messages, read_frame, read_match, args.timeout,
+            is_done=lambda delivered: len(caught_up) >= len(pairs),
+        )
+        results["read"]["note"] = "frames_delivered counts coalesced read_watermark frames; latency includes READ_WATERMARK_WINDOW"
+
+    if "signaling" in scenarios:
+        results["signaling"] = await run_phase(
+            clients, pairs, args.messages,
+            lambda i, a, b: {
+                "type": SIGNALING_TYPES[i % len(SIGNALING_TYPES)], "to": b.username, "to_user": b.username,
+                "candidate" if i % 4 in (1, 2) else "sdp": "x" * args.payload_bytes,
+                "bench_ts": time.perf_counter_ns(),
+            },
+            lambda client, frame: frame.get("bench_ts") if frame.get("type") in SIGNALING_TYPES and frame.get("from") != client.username else None,
+            args.timeout,
+        )
+
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+    if not args.url:
+        await chat_writer.drain()
+        if args.memory_clients:
+            results["memory_per_connection_kb"] = await measure_memory(
+                make_client, args.memory_clients, args.concurrency
+            )
+    return results
+
+
+def configure(args):
+    if not args.url:
+        if args.redis:
+            settings.CHANNEL_LAYERS = {
+                "default": {"BACKEND": "chat.sharding.ShardedRedisChannelLayer", "CONFIG": {"hosts": args.redis.split(",")}}
+            }
+            settings.PRESENCE_REDIS_URLS = args.redis
+        else:
+            settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+        if args.mongo_uri:
+            settings.MONGO_URI = args.mongo_uri
+            settings.MONGO_DB_NAME = args.mongo_db
+        else:
+            settings.MONGO_URI = ""
+        settings.WS_RATE_LIMITS = ""
+        settings.WS_USER_RATE_LIMITS = ""
+    django.setup()
+
+    if not args.url and not args.redis:
+        import fakeredis
+        import redis.asyncio as redis
+
+        from chat import presence
+        from chat.sharding import HashRing
+
+        presence.shards = [fakeredis.FakeAsyncRedis(connection_pool=redis.BlockingConnectionPool(
+            connection_class=fakeredis.FakeAsyncConnection, server=fakeredis.FakeServer(), max_connections=50,
+        ))]
+        presence.ring = HashRing(["fakeredis"])
+        presence.tracker = presence.PresenceTracker(
+            presence.shards, ttl=presence.tracker.ttl, heartbeat_interval=presence.tracker.heartbeat_interval
+        )
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000, help="connected clients (paired into 1:1 chats)")
+    parser.add_argument("--messages", type=int, default=10, help="frames per sender per scenario")
+    parser.add_argument("--concurrency", type=int, default=200, help="handshakes in flight during the connect storm")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS[1:]), help="comma-separated subset of chat,typing,read,signaling")
+    parser.add_argument("--payload-bytes", type=int, default=200, help="size of the SDP/candidate field in signaling frames")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for deliveries per scenario")
+    parser.add_argument("--memory-clients", type=int, default=200, help="connections opened under tracemalloc (0 to skip)")
+    parser.add_argument("--redis", help="comma-separated local Redis URLs instead of the in-memory layer and fakeredis")
+    parser.add_argument("--mongo-uri", help="local MongoDB instead of the in-memory stand-in")
+    parser.add_argument("--mongo-db", default="videochat_bench")
+    parser.add_argument("--url", help="base ws:// URL of a running server instead of in-process clients")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the chat loggers at their configured levels")
+    args = parser.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+
+    configure(args)
+    if not args.verbose:
+        logging.getLogger("chat").setLevel(logging.WARNING)
+    results = asyncio.run(run(args))
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "mode": "live" if args.url else "in-process",
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "verbose")},
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
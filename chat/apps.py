@@ -0,0 +1,16 @@
+from django.apps import AppConfig
+
+
+class ChatConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'chat'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.db.models.signals import post_delete, post_save
+        from .directory import bump_version
+
+        # Any change to the user table invalidates the cached contact directory
+        User = get_user_model()
+        post_save.connect(bump_version, sender=User, dispatch_uid="chat.directory.save")
+        post_delete.connect(bump_version, sender=User, dispatch_uid="chat.directory.delete")
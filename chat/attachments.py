@@ -0,0 +1,236 @@
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from django.conf import settings
+from pymongo import ReturnDocument
+
+from .log import get_logger
+from .mongo import get_db
+
+try:
+    from PIL import Image
+except ImportError: # Pillow is optional; without it attachments simply have no thumbnail
+    Image = None
+
+# Attachments are stored once per content hash, under ATTACHMENT_ROOT (outside MEDIA_ROOT,
+# so nothing serves them without the access check in the views):
+#   <root>/<sha256[:2]>/<sha256>        the file
+#   <root>/thumbs/<sha256>.jpg          thumbnail, for images
+#   <root>/incoming/<upload id>.part    resumable uploads in progress
+# db.uploads tracks uploads in progress (owner, declared size, bytes received). db.attachments
+# is keyed by the hash and records who uploaded the file and which rooms it was sent to.
+# Chat frames and stored messages only carry attachment_ref(), never the bytes.
+
+logger = get_logger("attachments")
+
+COPY_CHUNK = 64 * 1024
+THUMBNAIL_TYPES = frozenset({"image/jpeg", "image/png", "image/gif", "image/webp"})
+# Declared types served inline; anything else is sent as a download so uploads can't run as pages
+INLINE_TYPES = re.compile(r"^(image/(jpeg|png|gif|webp)|video/[\w.+-]+|audio/[\w.+-]+)$")
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+thumbnail_pool = ThreadPoolExecutor(
+    max_workers=getattr(settings, "ATTACHMENT_THUMBNAIL_WORKERS", 2), thread_name_prefix="thumbnails"
+)
+
+
+def _root():
+    return str(getattr(settings, "ATTACHMENT_ROOT", os.path.join(settings.BASE_DIR, "attachments")))
+
+
+def content_path(sha):
+    return os.path.join(_root(), sha[:2], sha)
+
+
+def thumbnail_path(sha):
+    return os.path.join(_root(), "thumbs", f"{sha}.jpg")
+
+
+def upload_path(upload_id):
+    return os.path.join(_root(), "incoming", f"{upload_id}.part")
+
+
+def is_attachment_id(value):
+    return isinstance(value, str) and _SHA256.match(value) is not None
+
+
+def attachment_ref(doc):
+    """The small reference carried by chat frames and stored with the message."""
+    return {"id": doc["_id"], "name": doc.get("filename"), "size": doc.get("size"), "type": doc.get("content_type")}
+
+
+def push_summary(ref):
+    """Push notification text for a message that has only an attachment."""
+    return f"Sent {ref['name']}" if ref else ""
+
+
+def serve_as(content_type):
+    """(content type, inline?) to serve a file with, from the type declared at upload."""
+    if content_type and INLINE_TYPES.match(content_type):
+        return content_type, True
+    return "application/octet-stream", False
+
+
+def create_upload(db, owner, filename, size, content_type):
+    doc = {
+        "_id": ObjectId(),
+        "owner": owner,
+        "filename": filename,
+        "size": size,
+        "content_type": content_type,
+        "received": 0,
+        "updated": datetime.utcnow(),
+    }
+    path = upload_path(doc["_id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    db.uploads.insert_one(doc)
+    return doc
+
+
+def append_chunk(db, upload, stream, length):
+    """Streams `length` bytes from stream onto the end of the upload, COPY_CHUNK at a time.
+
+    Returns the new byte count, or None if the body ended early; the partial tail is
+    then discarded by the next attempt, which starts again from the recorded offset.
+    """
+    offset = upload["received"]
+    written = 0
+    with open(upload_path(upload["_id"]), "r+b") as f:
+        f.seek(offset)
+        f.truncate() # Drops what an interrupted earlier attempt left past the recorded offset
+        while written < length:
+            block = stream.read(min(COPY_CHUNK, length - written))
+            if not block:
+                break
+            f.write(block)
+            written += len(block)
+    if written != length:
+        return None
+    received = offset + written
+    db.uploads.update_one(
+        {"_id": upload["_id"], "received": offset},
+        {"$set": {"received": received, "updated": datetime.utcnow()}},
+    )
+    return received
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(COPY_CHUNK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def finish_upload(db, upload):
+    """Hashes a complete upload and files it under its hash, reusing an identical stored file.
+
+    Returns the attachment document. Thumbnails for images are queued on the worker pool.
+    """
+    path = upload_path(upload["_id"])
+    sha = _sha256_file(path)
+    target = content_path(sha)
+    if os.path.exists(target):
+        os.remove(path) # Same bytes are already stored; keep a single copy
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    attachment = db.attachments.find_one_and_update(
+        {"_id": sha},
+        {
+            "$setOnInsert": {
+                "size": upload["size"],
+                "content_type": upload["content_type"],
+                "filename": upload["filename"],
+                "created": datetime.utcnow(),
+                "thumbnail": False,
+            },
+            "$addToSet": {"uploaders": upload["owner"]},
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    db.uploads.delete_one({"_id": upload["_id"]})
+    if Image is not None and attachment["content_type"] in THUMBNAIL_TYPES and not attachment.get("thumbnail"):
+        thumbnail_pool.submit(make_thumbnail, sha)
+    return attachment
+
+
+def make_thumbnail(sha):
+    """Runs on thumbnail_pool: writes a JPEG thumbnail and flags the attachment as having one."""
+    size = getattr(settings, "ATTACHMENT_THUMBNAIL_SIZE", 320)
+    target = thumbnail_path(sha)
+    partial = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with Image.open(content_path(sha)) as image:
+            image.draft("RGB", (size, size)) # JPEGs decode straight at a reduced scale
+            image.thumbnail((size, size))
+            image.convert("RGB").save(partial, "JPEG", quality=80)
+        os.replace(partial, target)
+    except Exception as e:
+        logger.warning("thumbnail failed for %s: %s", sha, e)
+        if os.path.exists(partial):
+            os.remove(partial)
+        return
+    db = get_db()
+    if db is not None:
+        db.attachments.update_one({"_id": sha}, {"$set": {"thumbnail": True}})
+
+
+def expire_uploads(db, hours):
+    """Removes uploads that have not received a chunk for `hours`, with their partial files."""
+    cutoff = datetime.utcnow() - timedelta(hours=hours)
+    removed = 0
+    for upload in db.uploads.find({"updated": {"$lt": cutoff}}, {"_id": 1}):
+        try:
+            os.remove(upload_path(upload["_id"]))
+        except FileNotFoundError:
+            pass
+        removed += db.uploads.delete_one({"_id": upload["_id"]}).deleted_count
+    return removed
+
+
+def parse_range(header, size):
+    """Parses a single "bytes=" range into inclusive (start, end) offsets.
+
+    Returns None when there is no usable range (absent, malformed or multi-range), in
+    which case the whole file is served. Raises ValueError if it cannot be satisfied.
+    """
+    match = _RANGE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        length = int(last) # Suffix range: the final `length` bytes
+        if length == 0 or size == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("range starts past the end")
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def file_range(path, start, end):
+    """Yields bytes start..end (inclusive) of a file in COPY_CHUNK blocks."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = f.read(min(COPY_CHUNK, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
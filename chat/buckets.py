@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+from django.conf import settings
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+
+# Storage tiers for chat messages:
+#   hot     one document per message in db.chats (everything newer than CHAT_BUCKET_AFTER_DAYS)
+#   bucket  db.chat_buckets: per-room time windows holding up to CHAT_BUCKET_MAX_MESSAGES
+#           messages each, so an old history page is one or two documents instead of fifty
+#   archive db.chat_archive: documents older than CHAT_ARCHIVE_AFTER_DAYS, kept but no longer served
+# Messages keep their ObjectId in every tier, so keyset cursors work across tier boundaries.
+
+BUCKET_FIELDS = ("_id", "sender", "recipient", "message", "timestamp", "read", "group", "attachment")
+
+
+def bucket_after_days():
+    return getattr(settings, "CHAT_BUCKET_AFTER_DAYS", 0)
+
+
+def archive_after_days():
+    return getattr(settings, "CHAT_ARCHIVE_AFTER_DAYS", 0)
+
+
+def cutoff_id(days):
+    """Smallest ObjectId generated `days` ago; every message older than that sorts below it."""
+    return ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(days=days))
+
+
+def is_bucketed(message_id):
+    """True if messages after message_id may already have been moved out of db.chats."""
+    days = bucket_after_days()
+    return days > 0 and message_id < cutoff_id(days)
+
+
+def _window(doc, span_hours):
+    generated = doc["_id"].generation_time
+    return int(generated.timestamp() // (span_hours * 3600))
+
+
+def history_page(db, room_name, before, limit, projection):
+    """Returns up to limit + 1 messages older than `before` (newest first) from the hot and bucket tiers.
+
+    Buckets only ever hold messages older than the hot documents, so they are read only when
+    db.chats runs out. Ids are deduplicated, which also hides the overlap a compaction that
+    was interrupted between its bucket write and its delete can leave behind.
+    """
+    query = {"room": room_name}
+    if before is not None:
+        query["_id"] = {"$lt": before}
+    docs = list(db.chats.find(query, projection).sort("_id", -1).limit(limit + 1))
+    if len(docs) > limit:
+        return docs
+
+    seen = {doc["_id"] for doc in docs}
+    bucket_query = {"room": room_name}
+    if docs:
+        bucket_query["start_id"] = {"$lt": docs[-1]["_id"]}
+    elif before is not None:
+        bucket_query["start_id"] = {"$lt": before}
+    for bucket in db.chat_buckets.find(bucket_query, {"messages": 1}).sort("start_id", -1):
+        for message in sorted(bucket["messages"], key=lambda m: m["_id"], reverse=True):
+            if before is not None and message["_id"] >= before:
+                continue
+            if message["_id"] in seen:
+                continue
+            seen.add(message["_id"])
+            docs.append(message)
+        if len(docs) > limit:
+            break
+    docs.sort(key=lambda d: d["_id"], reverse=True)
+    return docs[:limit + 1]
+
+
+def compact_batch(db, cutoff, batch_size, max_messages, span_hours):
+    """Moves up to batch_size of the oldest hot messages older than `cutoff` into buckets.
+
+    Messages are taken in _id order and appended to the room's newest bucket for their
+    window until it is full, so bucket id ranges never overlap. Safe to rerun after a crash:
+    messages at or below a bucket's end_id were already bucketed and are only deleted.
+    Returns the number of messages removed from db.chats.
+    """
+    docs = list(db.chats.find({"_id": {"$lt": cutoff}}).sort("_id", 1).limit(batch_size))
+    if not docs:
+        return 0
+
+    chunks = {}
+    for doc in docs:
+        message = {key: doc[key] for key in BUCKET_FIELDS if key in doc}
+        chunks.setdefault((doc.get("room"), _window(doc, span_hours)), []).append(message)
+
+    ops = []
+    for (room_name, window), messages in chunks.items():
+        latest = db.chat_buckets.find_one(
+            {"room": room_name, "window": window}, {"count": 1, "end_id": 1}, sort=[("start_id", -1)]
+        )
+        if latest is not None:
+            messages = [m for m in messages if m["_id"] > latest["end_id"]]
+            space = max_messages - latest["count"]
+            if space > 0 and messages:
+                head, messages = messages[:space], messages[space:]
+                ops.append(UpdateOne(
+                    {"_id": latest["_id"]},
+                    {"$push": {"messages": {"$each": head}}, "$inc": {"count": len(head)}, "$set": {"end_id": head[-1]["_id"]}},
+                ))
+        for i in range(0, len(messages), max_messages):
+            chunk = messages[i:i + max_messages]
+            ops.append(InsertOne({
+                "room": room_name,
+                "window": window,
+                "start_id": chunk[0]["_id"],
+                "end_id": chunk[-1]["_id"],
+                "count": len(chunk),
+                "messages": chunk,
+            }))
+    if ops:
+        db.chat_buckets.bulk_write(ops, ordered=True)
+    db.chats.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+    return len(docs)
+
+
+def archive_batch(db, source, query, batch_size):
+    """Copies a batch matching query from `source` into db.chat_archive, then deletes it there.
+
+    Documents keep their _id and are upserted, so reruns are idempotent.
+    """
+    docs = list(db[source].find(query).sort("_id", 1).limit(batch_size))
+    if not docs:
+        return 0
+    db.chat_archive.bulk_write(
+        [ReplaceOne({"_id": doc["_id"]}, dict(doc, tier=source), upsert=True) for doc in docs],
+        ordered=False,
+    )
+    db[source].delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+    return len(docs)
@@ -0,0 +1,287 @@
+import asyncio
+import uuid
+from collections import namedtuple
+from datetime import datetime
+
+from django.conf import settings
+
+from . import codec, metrics, presence, push
+from .log import get_logger
+from .mongo import get_async_db
+
+# Server-side registry of 1:1 call sessions. A call is a hash at call:<id> with caller,
+# callee, room and state (ringing -> active -> ended); call:user:<username> points at the
+# user's current call and doubles as the busy marker. Calls that are ringing, or active
+# but left by a disconnected participant, sit in a deadline sorted set; any worker's
+# sweeper ends them atomically once due (missed / disconnected) and emits the events.
+# Everything lives on the first presence shard, so caller and callee markers change in
+# one script. Group calls are still coordinated by their clients.
+
+logger = get_logger("calls")
+
+Call = namedtuple("Call", "id caller callee room reason")
+
+# call_logs entry type for each way a call can end
+LOG_TYPES = {
+    "missed": "missed_call",
+    "cancelled": "missed_call",
+    "busy": "missed_call",
+    "rejected": "reject",
+    "ended": "end_call",
+    "disconnected": "end_call",
+}
+
+# Shared by every script: ARGV[1] is the key prefix and KEYS[1] the deadline set
+_COMMON_LUA = """
+local prefix = ARGV[1]
+local function now()
+  return tonumber(redis.call('TIME')[1])
+end
+local function live(state)
+  return state == 'ringing' or state == 'active'
+end
+local function current(user)
+  local id = redis.call('GET', prefix .. 'user:' .. user)
+  if not id then return nil, {} end
+  return id, redis.call('HMGET', prefix .. id, 'caller', 'callee', 'state', 'room')
+end
+local function finish(id, reason)
+  local key = prefix .. id
+  local call = redis.call('HMGET', key, 'caller', 'callee', 'state', 'room')
+  if not live(call[3]) then return nil end
+  redis.call('HSET', key, 'state', 'ended', 'reason', reason)
+  redis.call('EXPIRE', key, 60)
+  for _, user in ipairs({call[1], call[2]}) do
+    local marker = prefix .. 'user:' .. user
+    if redis.call('GET', marker) == id then redis.call('DEL', marker) end
+  end
+  redis.call('ZREM', KEYS[1], id)
+  return {id, call[1], call[2], call[4], reason}
+end
+"""
+
+# ARGV = [prefix, id, caller, callee, room, ring seconds, max seconds]
+_START_LUA = _COMMON_LUA + """
+local caller, callee = ARGV[3], ARGV[4]
+local own, call = current(caller)
+if own and live(call[3]) then
+  if call[1] == callee or call[2] == callee then
+    if call[3] == 'active' then redis.call('ZREM', KEYS[1], own) end -- Back after a reconnect
+    return {'existing', own}
+  end
+  return {'in_call', own}
+end
+local other, theirs = current(callee)
+if other and live(theirs[3]) then return {'busy', other} end
+local t, id = now(), ARGV[2]
+redis.call('HSET', prefix .. id, 'caller', caller, 'callee', callee, 'room', ARGV[5], 'state', 'ringing', 'created', t)
+redis.call('EXPIRE', prefix .. id, ARGV[7])
+redis.call('SET', prefix .. 'user:' .. caller, id, 'EX', ARGV[7])
+redis.call('SET', prefix .. 'user:' .. callee, id, 'EX', ARGV[7])
+redis.call('ZADD', KEYS[1], t + tonumber(ARGV[6]), id)
+return {'ringing', id}
+"""
+
+# ARGV = [prefix, user]. The callee answering makes the call active; either side
+# answering an active call (renegotiation after a reconnect) re-attaches it.
+_ANSWER_LUA = _COMMON_LUA + """
+local user = ARGV[2]
+local id, call = current(user)
+if not id then return nil end
+if call[3] == 'ringing' and call[2] == user then
+  redis.call('HSET', prefix .. id, 'state', 'active', 'answered', now())
+  redis.call('ZREM', KEYS[1], id)
+  return {id, call[1], call[2], call[4], 'answered'}
+elseif call[3] == 'active' then
+  redis.call('ZREM', KEYS[1], id)
+  return {id, call[1], call[2], call[4], 'active'}
+end
+return nil
+"""
+
+# ARGV = [prefix, user]: a hang-up or decline by either side
+_END_LUA = _COMMON_LUA + """
+local user = ARGV[2]
+local id, call = current(user)
+if not id then return nil end
+if call[3] == 'ringing' then
+  return finish(id, call[1] == user and 'cancelled' or 'rejected')
+elseif call[3] == 'active' then
+  return finish(id, 'ended')
+end
+return nil
+"""
+
+# ARGV = [prefix, user, grace seconds]: the socket carrying the user's side went away
+_DETACH_LUA = _COMMON_LUA + """
+local user = ARGV[2]
+local id, call = current(user)
+if not id then return nil end
+if call[3] == 'ringing' and call[1] == user then
+  return finish(id, 'cancelled')
+elseif call[3] == 'active' then
+  redis.call('ZADD', KEYS[1], now() + tonumber(ARGV[3]), id)
+end
+return nil
+"""
+
+# ARGV = [prefix, batch]
+_SWEEP_LUA = _COMMON_LUA + """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now(), 'LIMIT', 0, tonumber(ARGV[2]))
+local ended = {}
+for _, id in ipairs(due) do
+  local state = redis.call('HGET', prefix .. id, 'state')
+  local result = nil
+  if state == 'ringing' then
+    result = finish(id, 'missed')
+  elseif state == 'active' then
+    result = finish(id, 'disconnected')
+  end
+  if result then
+    table.insert(ended, result)
+  else
+    redis.call('ZREM', KEYS[1], id)
+  end
+end
+return ended
+"""
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _call(result):
+    return Call(*(_text(v) for v in result)) if result else None
+
+
+class CallRegistry:
+    def __init__(self, client, prefix="call:", ring_seconds=45, reconnect_grace=30,
+                 max_seconds=4 * 3600, sweep_interval=2, sweep_batch=100):
+        self.client = client
+        self.prefix = prefix
+        self.ring_seconds = ring_seconds
+        self.reconnect_grace = reconnect_grace
+        self.max_seconds = max_seconds # Backstop expiry for sessions nobody ended
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._keys = [f"{prefix}deadlines"]
+        self._start = client.register_script(_START_LUA)
+        self._answer = client.register_script(_ANSWER_LUA)
+        self._end = client.register_script(_END_LUA)
+        self._detach = client.register_script(_DETACH_LUA)
+        self._sweep = client.register_script(_SWEEP_LUA)
+        self._task = None
+
+    def ensure_started(self):
+        """Starts this worker's sweeper; every worker with sockets runs one."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def start(self, caller, callee, room):
+        """Rings callee. Returns (status, call id); status is ringing, existing, busy or in_call."""
+        status, call_id = await self._start(
+            keys=self._keys,
+            args=[self.prefix, uuid.uuid4().hex, caller, callee, room, self.ring_seconds, self.max_seconds],
+        )
+        return _text(status), _text(call_id)
+
+    async def answer(self, username):
+        """Marks the user's ringing call active; the Call's reason is "answered" on that transition."""
+        return _call(await self._answer(keys=self._keys, args=[self.prefix, username]))
+
+    async def end(self, username):
+        """Ends the user's call; returns the Call with reason cancelled, rejected or ended."""
+        return _call(await self._end(keys=self._keys, args=[self.prefix, username]))
+
+    async def detach(self, username):
+        """Starts the reconnect grace period for an active call; a caller leaving while ringing cancels it."""
+        return _call(await self._detach(keys=self._keys, args=[self.prefix, username, self.reconnect_grace]))
+
+    async def busy_among(self, usernames):
+        """The subset of usernames currently ringing or in a call."""
+        usernames = list(usernames)
+        if not usernames:
+            return []
+        markers = await self.client.mget([f"{self.prefix}user:{u}" for u in usernames])
+        return [u for u, marker in zip(usernames, markers) if marker]
+
+    async def sweep(self):
+        """Ends due calls (missed or abandoned) in bounded batches; returns them."""
+        ended = []
+        while True:
+            batch = await self._sweep(keys=self._keys, args=[self.prefix, self.sweep_batch])
+            ended.extend(_call(result) for result in batch)
+            if len(batch) < self.sweep_batch:
+                return ended
+
+    async def _run(self):
+        from channels.layers import get_channel_layer
+
+        channel_layer = get_channel_layer()
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                for call in await self.sweep():
+                    await broadcast_call_state(channel_layer, call, "ended")
+                    await log_call_end(call)
+            except Exception as e:
+                logger.warning("call sweep failed: %s", e)
+
+
+def call_state_frame(call, state, ended_by=None):
+    return {
+        "type": "call_state",
+        "call_id": call.id,
+        "state": state,
+        "reason": call.reason if state == "ended" else None,
+        "ended_by": ended_by,
+        "caller": call.caller,
+        "callee": call.callee,
+        "call_room": call.room, # Not "room": clients drop frames for rooms other than the open one
+    }
+
+
+async def broadcast_call_state(channel_layer, call, state, ended_by=None):
+    """Sends a call_state frame to every socket of both participants."""
+    frame = call_state_frame(call, state, ended_by)
+    # call_closed lets the participants' consumers forget the call without decoding the frame
+    event = codec.prepared_event("room_event", frame, **({"call_closed": call.id} if state == "ended" else {}))
+    with metrics.group_send_seconds.time():
+        await asyncio.gather(*(channel_layer.group_send(f"user_{u}", event) for u in (call.caller, call.callee)))
+
+
+async def log_call_event(event_type, sender, recipient, room, is_group_call=False):
+    """Writes one compact call-log entry and pushes call/missed-call alerts to the callee."""
+    db = await get_async_db()
+    if db is not None:
+        try:
+            await db.call_logs.insert_one({
+                "type": event_type,
+                "sender": sender,
+                "recipient": recipient,
+                "room": room,
+                "is_group_call": is_group_call,
+                "timestamp": datetime.utcnow(),
+            })
+        except Exception as e:
+            logger.warning("call log write failed: %s", e, extra={"user": sender, "room": room})
+    if recipient and event_type in ("call", "missed_call"):
+        verb = "Incoming call" if event_type == "call" else "Missed call"
+        push.dispatcher.enqueue(recipient, "VideoChat Call", f"{verb} from {sender}", f"/chat/room/{sender}/")
+
+
+async def log_call_end(call, ended_by=None):
+    """Logs how a call ended; declines are attributed to the callee, everything else to the ender or caller."""
+    sender = call.callee if call.reason == "rejected" else ended_by or call.caller
+    recipient = call.callee if sender == call.caller else call.caller
+    await log_call_event(LOG_TYPES.get(call.reason, "end_call"), sender, recipient, call.room)
+
+
+registry = CallRegistry(
+    presence.shards[0],
+    ring_seconds=getattr(settings, "CALL_RING_SECONDS", 45),
+    reconnect_grace=getattr(settings, "CALL_RECONNECT_GRACE", 30),
+    max_seconds=getattr(settings, "CALL_MAX_SECONDS", 4 * 3600),
+    sweep_interval=getattr(settings, "CALL_SWEEP_INTERVAL", 2),
+)
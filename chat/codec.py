@@ -0,0 +1,118 @@
+import json
+
+import msgpack
+from django.conf import settings
+
+# WebSocket subprotocols a client may offer at connect time. JSON stays the default
+# when the client offers nothing we recognise.
+JSON_SUBPROTOCOL = "chat.json"
+COMPACT_SUBPROTOCOL = "chat.msgpack.v1"
+
+# Long field name -> short key used by the compact encoding
+SHORT_KEYS = {
+    "type": "t",
+    "from": "f",
+    "to": "o",
+    "room": "r",
+    "message": "m",
+    "message_id": "i",
+    "temp_message_id": "ti",
+    "timestamp": "ts",
+    "read": "rd",
+    "recipient": "rc",
+    "username": "u",
+    "is_online": "on",
+    "is_typing": "ty",
+    "users": "us",
+    "peer": "p",
+    "reader": "rr",
+    "to_user": "tu",
+    "is_group_call": "g",
+    "offer": "of",
+    "answer": "an",
+    "candidate": "c",
+    "attachment": "at",
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+# Legacy aliases that JSON clients read but compact clients derive from type/from
+_ALIASES = {"event_type": "type", "sender": "from"}
+
+
+class JsonCodec:
+    subprotocol = None
+    binary = False
+
+    def encode(self, message):
+        return json.dumps(message)
+
+    def decode(self, text_data, bytes_data):
+        raw = text_data if text_data is not None else bytes_data
+        if not raw:
+            return None
+        return json.loads(raw)
+
+
+class CompactCodec:
+    subprotocol = COMPACT_SUBPROTOCOL
+    binary = True
+
+    def encode(self, message):
+        compact = {}
+        for key, value in message.items():
+            alias_of = _ALIASES.get(key)
+            if alias_of is not None and message.get(alias_of) == value:
+                continue # Duplicate of type/from, dropped on the wire
+            compact[SHORT_KEYS.get(key, key)] = value
+        return msgpack.packb(compact, use_bin_type=True)
+
+    def decode(self, text_data, bytes_data):
+        if bytes_data:
+            data = msgpack.unpackb(bytes_data, raw=False)
+        elif text_data:
+            data = json.loads(text_data) # Compact clients may still send the odd text frame
+        else:
+            return None
+        if not isinstance(data, dict):
+            return None
+        return {LONG_KEYS.get(key, key): value for key, value in data.items()}
+
+
+JSON = JsonCodec()
+COMPACT = CompactCodec()
+
+
+# Whether broadcast events also carry the msgpack encoding. Off by default: the browser client
+# speaks JSON, so a second copy would only add Redis payload and sender CPU. Compact sockets
+# then convert the JSON text themselves (frame_for); turn this on when most sockets are compact.
+PREPACK_COMPACT = getattr(settings, "WS_PREPACK_MSGPACK", False)
+
+
+def prepared_event(handler, message, **extra):
+    """Builds a channel-layer event carrying the frame already encoded as JSON text.
+
+    The sender serializes once; each receiving JSON consumer forwards the ready-made
+    text without touching the message again. See PREPACK_COMPACT for msgpack.
+    """
+    event = {"type": handler, "text": JSON.encode(message), **extra}
+    if PREPACK_COMPACT:
+        event["packed"] = COMPACT.encode(message)
+    return event
+
+
+def frame_for(event, codec):
+    """The wire frame for a prepared event in a socket's codec."""
+    if not codec.binary:
+        return event["text"]
+    packed = event.get("packed")
+    return packed if packed is not None else codec.encode(json.loads(event["text"]))
+
+
+def negotiate(offered):
+    """Picks the codec for the subprotocols offered in the handshake (scope["subprotocols"])."""
+    offered = offered or []
+    if COMPACT_SUBPROTOCOL in offered:
+        return COMPACT, COMPACT_SUBPROTOCOL
+    if JSON_SUBPROTOCOL in offered:
+        return JSON, JSON_SUBPROTOCOL
+    return JSON, None
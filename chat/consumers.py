@@ -1,36 +1,25 @@
-import json
+import asyncio
 from datetime import datetime
-import redis.asyncio as redis
-import os
-from bson.objectid import ObjectId # Added for MongoDB ObjectId
 
-from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.conf import settings
-from django.contrib.auth import get_user_model # Added get_user_model
-from webpush import send_user_notification # Assuming webpush is installed
 
-from .mongo import get_db
-from chat.views import _pair_room_name # Import _pair_room_name
-import json
-from datetime import datetime
-import redis.asyncio as redis
-import os
-from bson.objectid import ObjectId # Added for MongoDB ObjectId
-
-from asgiref.sync import sync_to_async
-from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.conf import settings
-from django.contrib.auth import get_user_model # Added get_user_model
-from webpush import send_user_notification # Assuming webpush is installed
+from .mongo import get_async_db
+from .persistence import chat_writer
+from . import attachments, buckets, calls, codec, groups, message_ids, metrics, outbound, presence, push, ratelimit, receipts
+from .log import get_logger
+from .typing_state import TypingThrottle
+from chat.views import HISTORY_PROJECTION, _pair_room_name, _room_peer, _serialize_message
 
-from .mongo import get_db
-from chat.views import _pair_room_name # Import _pair_room_name
+logger = get_logger("consumer")
+presence_logger = get_logger("presence")
+frames_logger = get_logger("frames") # One record per inbound frame; sampled (see LOGGING)
 
-# Initialize Redis client
-redis_client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+# WebRTC negotiation frames: relayed to the peer and never stored
+SIGNALING_TYPES = ("offer", "answer", "ice")
+# Call lifecycle frames. For 1:1 calls the registry in chat/calls.py owns the lifecycle and
+# emits call_state frames; clients' end_call/reject only trigger it. Group calls are relayed and logged.
+CALL_LOG_TYPES = ("call", "missed_call", "end_call", "reject")
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -41,29 +30,53 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.username = (
             str(user.username) if getattr(user, "is_authenticated", False) else "Anonymous"
         )
-        print(f"[ChatConsumer] User connected: {self.username}, Authenticated: {getattr(user, 'is_authenticated', False)}") # Debugging
+        logger.debug("connect user=%s room=%s authenticated=%s", self.username, self.room_name, getattr(user, "is_authenticated", False))
+
+        # Group rooms are only open to their members
+        db = await get_async_db()
+        group_id = groups.parse_group_room(self.room_name)
+        if group_id is not None and (db is None or self.username not in await groups.get_members(db, group_id)):
+            await self.close()
+            return
 
         # Add user to a specific group for direct messaging (if needed, otherwise room_group_name is enough)
         self.user_channel_name = f"user_{self.username}"
+        metrics.active_connections.inc() # Paired with the dec() in disconnect()
         await self.channel_layer.group_add(self.user_channel_name, self.channel_name)
 
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.channel_layer.group_add("global_presence", self.channel_name) # Add to global presence group
-        await self.accept()
+        # One channel-layer group per group conversation the user belongs to
+        self.group_ids = set()
+        if db is not None and self.username != "Anonymous":
+            self.group_ids = set(await groups.groups_for_user(db, self.username))
+            await asyncio.gather(*(
+                self.channel_layer.group_add(groups.group_channel(gid), self.channel_name)
+                for gid in self.group_ids
+            ))
 
-        # Add user to online users set in Redis and broadcast status
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        # Users whose status this socket has subscribed to (see presence_subscribe)
+        self.presence_interest = set()
+        # Read watermarks waiting to be written, room -> (peer, highest message ObjectId)
+        self.pending_reads = {}
+        # Peer -> call id for the 1:1 calls this socket carries (see chat/calls.py)
+        self.active_calls = {}
+        self.read_flush_task = None
+        self.typing = TypingThrottle(send_stop=lambda recipient: self.send_typing(recipient, False))
+        self.limiter = ratelimit.FrameLimiter(self.username)
+        # Frame encoding is negotiated through the WebSocket subprotocol; JSON unless the client opts in
+        self.codec, subprotocol = codec.negotiate(self.scope.get("subprotocols"))
+        # Every frame to the client goes through this bounded buffer (see chat/outbound.py)
+        self.outbound = outbound.OutboundQueue(self.write_frame, lambda code: self.close(code=code))
+        await self.accept(subprotocol=subprotocol)
+
+        # Add user to online users set in Redis and broadcast status to interested sockets only.
+        # The online list is sent once the client subscribes to its contacts.
         if self.username != "Anonymous":
-            print(f"[ChatConsumer] Adding {self.username} to online_users Redis set.") # Debugging
-            await redis_client.sadd("online_users", self.username)
-            await self.broadcast_user_status(self.username, True)
-
-            # Send the current list of online users to the newly connected user
-            online_users_list = await self.get_online_users()
-            print(f"[ChatConsumer] Sending online_users_list to {self.username}: {online_users_list}") # Debugging
-            await self.send(text_data=json.dumps({
-                "type": "online_users_list",
-                "users": online_users_list,
-            }))
+            # Only the user's first live connection is an online transition
+            if await presence.tracker.connect(self.username, self.channel_name):
+                presence_logger.debug("%s is online", self.username)
+                await self.broadcast_user_status(self.username, True)
+            calls.registry.ensure_started()
 
         try:
             join_msg = {
@@ -72,25 +85,42 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 "event_type": "join",
                 "sender": self.username,
             }
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
-                {"type": "room_event", "message": join_msg},
+                codec.prepared_event("room_event", join_msg),
             )
         except Exception:
             pass
 
     async def disconnect(self, close_code):
-        print(f"[ChatConsumer] User {self.username} disconnected from room {self.room_name} with code {close_code}")
+        if not hasattr(self, "user_channel_name"):
+            return # Rejected before joining anything
+        metrics.active_connections.dec()
+        logger.debug("disconnect user=%s room=%s code=%s", self.username, self.room_name, close_code)
+        self.outbound.close()
+        if hasattr(self, "typing"):
+            await self.typing.stop_all() # Before the awaits below, so no typing timer fires mid-teardown
 
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
         await self.channel_layer.group_discard(self.user_channel_name, self.channel_name)
-        await self.channel_layer.group_discard("global_presence", self.channel_name) # Discard from global presence group
+        await asyncio.gather(*(
+            self.channel_layer.group_discard(groups.group_channel(gid), self.channel_name)
+            for gid in self.group_ids
+        ))
+        await self.set_presence_interest([])
+        await self.flush_read_watermarks()
+        # A ringing outgoing call is cancelled; an active one gets a grace period to reconnect
+        if getattr(self, "active_calls", None):
+            call = await calls.registry.detach(self.username)
+            if call is not None:
+                await self.close_call(call)
 
         # Remove user from online users set in Redis and broadcast status
         if self.username != "Anonymous":
-            print(f"[ChatConsumer] Removing {self.username} from online_users Redis set.")
-            await redis_client.srem("online_users", self.username)
-            await self.broadcast_user_status(self.username, False)
+            # Other tabs keep the user online; only the last connection going away is broadcast
+            if await presence.tracker.disconnect(self.username, self.channel_name):
+                presence_logger.debug("%s is offline", self.username)
+                await self.broadcast_user_status(self.username, False)
 
         try:
             leave_msg = {
@@ -99,47 +129,76 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 "event_type": "leave",
                 "sender": self.username,
             }
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
-                {"type": "room_event", "message": leave_msg},
+                codec.prepared_event("room_event", leave_msg),
             )
         except Exception:
             pass
 
     async def broadcast_user_status(self, username, is_online):
-        """Broadcasts a user's online/offline status to all relevant groups."""
-        status_message = {
-            "type": "user_status",
-            "username": username,
-            "is_online": is_online,
-        }
-        await self.channel_layer.group_send(
-            "global_presence",
-            {"type": "send_user_status", "message": status_message},
+        """Sends a user's online/offline status to the sockets subscribed to that user."""
+        await presence.broadcast_status(self.channel_layer, username, is_online)
+
+    async def set_presence_interest(self, usernames):
+        """Replaces the set of users this socket receives status updates for."""
+        wanted = set(usernames)
+        current = getattr(self, "presence_interest", set())
+        await asyncio.gather(
+            *(self.channel_layer.group_discard(presence.presence_group(u), self.channel_name)
+              for u in current - wanted),
+            *(self.channel_layer.group_add(presence.presence_group(u), self.channel_name)
+              for u in wanted - current),
         )
+        self.presence_interest = wanted
 
     async def send_user_status(self, event):
         """Handles the 'send_user_status' event to send status updates to the websocket."""
-        message = event["message"]
-        await self.send(text_data=json.dumps(message))
+        # Only the latest status per user matters, so a queued older one is replaced
+        self.send_prepared(event, outbound.LOW, f"status:{event.get('username')}")
 
     async def get_online_users(self):
-        """Returns the list of currently online users from Redis."""
-        online_users_bytes = await redis_client.smembers("online_users")
-        online_users_list = [user.decode('utf-8') for user in online_users_bytes]
-        print(f"[ChatConsumer] Current online users in Redis: {online_users_list}") # Debugging
+        """Returns which of the users this socket is interested in are currently online."""
+        online_users_list = await presence.online_among(self.presence_interest)
+        presence_logger.debug("online %d of %d watched users for %s", len(online_users_list), len(self.presence_interest), self.username)
         return online_users_list
 
-    async def receive(self, text_data=None, bytes_data=None):
-        if not text_data:
-            return
+    async def group_send(self, group, event):
+        """channel_layer.group_send, timed for /metrics."""
+        with metrics.group_send_seconds.time():
+            await self.channel_layer.group_send(group, event)
+
+    async def send_frame(self, message):
+        """Encodes a reply with the codec negotiated at connect and queues it, waiting while the client is behind."""
+        await self.outbound.put_wait(self.codec.encode(message))
 
+    async def write_frame(self, frame):
+        """Writes one encoded frame to the socket; called by the outbound queue's writer."""
+        metrics.frames_sent.inc()
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
+            data = self.codec.decode(text_data, bytes_data)
         except Exception:
             return
+        if not isinstance(data, dict):
+            return
 
         msg_type = data.get("type")
+        metrics.count_frame(msg_type)
+        frames_logger.debug("frame type=%s user=%s room=%s", msg_type, self.username, self.room_name)
+        if msg_type == "ack":
+            # Never rate limited: a dropped ack would make a healthy client look slow
+            self.outbound.ack(data.get("frames"))
+            return
+        throttled = await self.limiter.check(msg_type)
+        if throttled is not None:
+            await self.send_throttle(msg_type, data, *throttled)
+            return
         payload = {k: v for k, v in data.items() if k != "type"}
         sender = self.username
 
@@ -151,7 +210,59 @@ class ChatConsumer(AsyncWebsocketConsumer):
             **payload,
         }
 
-        db = get_db()
+        # Ephemeral frames never touch Mongo here, so they work even when it is unavailable
+        if msg_type == "typing":
+            recipient_username = payload.get("recipient")
+            is_typing = bool(payload.get("is_typing"))
+            # Only state changes (and periodic refreshes) reach the channel layer
+            if recipient_username and self.typing.should_forward(recipient_username, is_typing):
+                await self.send_typing(recipient_username, is_typing)
+            return # Don't save typing indicators to DB
+
+        if msg_type == "read_up_to":
+            # The client reports the newest message it has seen; everything before it is read too
+            room = payload.get("room")
+            peer = payload.get("peer")
+            message_id = receipts.parse_message_id(payload.get("message_id"))
+            if message_id and groups.parse_group_room(room) in self.group_ids:
+                # Group reads are tracked per member for unread counts; nobody is notified
+                self.queue_read_watermark(room, None, message_id)
+            elif peer and message_id and room == _pair_room_name(sender, peer):
+                self.queue_read_watermark(room, peer, message_id)
+            return # Don't broadcast read receipts globally, handle client-side
+
+        if msg_type == "sync":
+            await self.sync_missed_messages(payload.get("rooms"))
+            return
+
+        if msg_type in SIGNALING_TYPES:
+            to_user = data.get("to")
+            if to_user and not payload.get("is_group_call") and not await self.track_call(msg_type, to_user, out):
+                return # Not rung: one side is already in another call
+            # Relayed straight through the channel layer; SDP and ICE are only useful during setup
+            await self.group_send(
+                f"user_{to_user}" if to_user else self.room_group_name,
+                codec.prepared_event("room_event", out),
+            )
+            return
+
+        if msg_type in CALL_LOG_TYPES:
+            if not payload.get("is_group_call"):
+                # The registry decides how the call ended and tells both sides; client-sent
+                # "call"/"missed_call" frames are ignored since the server logs those itself
+                if msg_type in ("end_call", "reject"):
+                    call = await calls.registry.end(self.username)
+                    if call is not None:
+                        await self.close_call(call, ended_by=self.username)
+                return
+            to_user = payload.get("to_user") or data.get("to")
+            await self.record_call_event(msg_type, to_user, payload)
+
+        if msg_type == "chat" and payload.get("group"):
+            await self.send_group_message(payload)
+            return
+
+        db = await get_async_db()
         if db is not None:
             try:
                 if msg_type == "chat":
@@ -165,117 +276,76 @@ class ChatConsumer(AsyncWebsocketConsumer):
                         "sender": sender,
                         "recipient": recipient_username, # Add recipient to the saved message
                         "message": payload.get("message", ""),
-                        "timestamp": datetime.utcnow().isoformat(), # Convert to ISO 8601 string
+                        "timestamp": datetime.utcnow(), # Stored as a native BSON date so (room, timestamp) sorts chronologically
                         "read": False, # For read receipts
                     }
                     out["room"] = chat_room_name # Always include room in outgoing payload
-                    print(f"[DEBUG chat/consumers.py] Attempting to save message to MongoDB for room: {chat_room_name}")
-                    print(f"[DEBUG chat/consumers.py] Message doc: {doc}")
-                    result = await sync_to_async(db.chats.insert_one)(doc)
-                    out["message_id"] = str(result.inserted_id) # Add the message ID
-                    out["timestamp"] = doc["timestamp"] # Add timestamp to the broadcast message
+                    out.pop("attachment", None) # Only a verified reference is forwarded
+                    if payload.get("attachment"):
+                        ref = await self.resolve_attachment(payload["attachment"], chat_room_name)
+                        if ref is not None:
+                            doc["attachment"] = out["attachment"] = ref
+                    # Assign the id locally and let the write-behind queue persist it off the hot path
+                    doc["_id"] = message_ids.new_message_id()
+                    await chat_writer.enqueue(doc)
+                    out["message_id"] = str(doc["_id"]) # Add the message ID
+                    out["timestamp"] = doc["timestamp"].isoformat() # Add timestamp to the broadcast message
                     out["read"] = doc["read"] # Add read status to the broadcast message
                     out["temp_message_id"] = payload.get("temp_message_id") # Pass temp ID back to client
-                    print(f"[DEBUG chat/consumers.py] Message saved with ID: {out['message_id']}")
+                    logger.debug("queued message %s for room %s", doc["_id"], chat_room_name)
 
                     # Send push notification for new chat message
-                    if sender != self.room_name: # Only send if not a self-message in a 1-1 chat
+                    if recipient_username and recipient_username != sender: # Only send if not a self-message in a 1-1 chat
                         await self.send_push_notification(
-                            recipient_username=self.room_name, # Assuming room_name is the peer's username in 1-1 chat
+                            recipient_username=recipient_username,
                             title=f"New message from {sender}",
-                            body=payload.get("message", ""),
+                            body=doc["message"] or attachments.push_summary(doc.get("attachment")),
                             url=f"/chat/room/{sender}/" # Link to the chat room
                         )
 
-                elif msg_type in (
-                    "offer", "answer", "ice",
-                    "call", "missed_call",
-                    "end_call", "reject"
-                ):
-                    recipient = payload.get("to_user")
-                    doc = {
-                        "room": self.room_name,
-                        "sender": sender,
-                        "recipient": recipient,
-                        "type": msg_type,
-                        "payload": payload,
-                        "timestamp": datetime.utcnow(),
-                        "read": False,
-                    }
-                    await sync_to_async(db.notifications.insert_one)(doc)
-                    # Send push notification for call events
-                    if recipient:
-                        notification_body = ""
-                        notification_url = "/"
-                        if msg_type == "call":
-                            notification_body = f"Incoming call from {sender}"
-                            notification_url = f"/chat/room/{sender}/" # Link to the call room
-                        elif msg_type == "missed_call":
-                            notification_body = f"Missed call from {sender}"
-                            notification_url = f"/chat/room/{sender}/"
-                        
-                        if notification_body:
-                            await self.send_push_notification(
-                                recipient_username=recipient,
-                                title="VideoChat Call",
-                                body=notification_body,
-                                url=notification_url
-                            )
-
-                elif msg_type == "typing":
-                    recipient_username = payload.get("recipient")
-                    if recipient_username:
-                        # Send typing indicator only to the intended recipient
-                        await self.channel_layer.group_send(
-                            f"user_{recipient_username}",
-                            {
-                                "type": "typing_indicator",
-                                "username": sender,
-                                "is_typing": payload.get("is_typing"),
-                                "room": self.room_name, # Include room for client-side filtering
-                            }
-                        )
-                    return # Don't save typing indicators to DB
-
-                elif msg_type == "read_receipt":
-                    message_id = payload.get("message_id")
-                    if message_id:
-                        await sync_to_async(db.chats.update_one)(
-                            {"_id": ObjectId(message_id)},
-                            {"$set": {"read": True, "read_at": datetime.utcnow()}}
-                        )
-                        # Broadcast the read receipt update to the sender's channel
-                        await self.channel_layer.group_send(
-                            self.user_channel_name,
-                            {"type": "room_event", "message": {"type": "read_receipt_update", "message_id": message_id}},
-                        )
-                    return # Don't broadcast read receipts globally, handle client-side
 
             except Exception as e:
-                print(f"[MongoDB] save failed: {e}")
+                logger.warning("save failed for %s frame: %s", msg_type, e, extra={"user": sender, "room": self.room_name})
 
         # Determine if the message should be sent to a specific user or broadcast
         to_user = data.get("to")
-        if msg_type == "get_online_users":
+        if msg_type == "presence_subscribe":
+            # Client sends the usernames it displays (contact list, open room); replaces the previous set
+            users = presence.normalize_interest(payload.get("users"), exclude=self.username)
+            await self.set_presence_interest(users)
+            online_users_list = await self.get_online_users()
+            await self.send_frame({
+                "type": "online_users_list",
+                "users": online_users_list,
+            })
+        elif msg_type == "busy_check":
+            # Lets a client grey out the call button for contacts already ringing or in a call
+            users = presence.normalize_interest(payload.get("users"), exclude=self.username)
+            await self.send_frame({
+                "type": "busy_users",
+                "users": await calls.registry.busy_among(users),
+            })
+        elif msg_type == "get_online_users":
             online_users_list = await self.get_online_users()
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "type": "online_users_list",
                 "users": online_users_list,
-            }))
+            })
         elif msg_type == "chat":
             recipient_username = payload.get("recipient")
-            
+            event = codec.prepared_event("room_event", out) # Encoded once for both deliveries
+
             # Send to sender's channel for immediate display and confirmation
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.user_channel_name,
-                {"type": "room_event", "message": out},
+                event,
             )
             
             # Send to recipient's channel if specified and not the sender
             if recipient_username and recipient_username != self.username:
-                await self.channel_layer.group_send(
+                await self.group_send(
                     f"user_{recipient_username}",
-                    {"type": "room_event", "message": out},
+                    event,
                 )
             # Also send to the room group for general chat if it's a group chat,
             # or if we want all participants in a 1-1 chat to receive it via room_group_name
@@ -284,57 +354,267 @@ class ChatConsumer(AsyncWebsocketConsumer):
             # If group chats are intended, this logic might need adjustment.
         elif to_user:
             # Send directly to the target user's channel for other message types
-            await self.channel_layer.group_send(
+            await self.group_send(
                 f"user_{to_user}",
-                {"type": "room_event", "message": out},
+                codec.prepared_event("room_event", out),
             )
         else:
             # Broadcast to the entire room group for other message types (e.g., group calls)
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
-                {"type": "room_event", "message": out},
+                codec.prepared_event("room_event", out),
             )
 
+    async def sync_missed_messages(self, rooms):
+        """Streams messages newer than the client's last-seen id for each room.
+
+        The client sends {"rooms": {room_name: last_seen_message_id}} after reconnecting.
+        Channel-layer events for this socket are dispatched only after receive() returns,
+        so live delivery resumes once the catch-up frames have been sent.
+        """
+        if not isinstance(rooms, dict):
+            return
+        db = await get_async_db()
+        max_rooms = getattr(settings, "SYNC_MAX_ROOMS", 20)
+        for room, last_seen in list(rooms.items())[:max_rooms]:
+            peer = _room_peer(room, self.username) if isinstance(room, str) else None
+            is_group = groups.parse_group_room(room) in self.group_ids
+            last_id = receipts.parse_message_id(last_seen)
+            if (peer is None and not is_group) or last_id is None:
+                continue
+            has_more = False
+            if db is not None:
+                try:
+                    has_more = await self.stream_room_since(db, room, peer, last_id)
+                except Exception as e:
+                    logger.warning("sync failed for room %s: %s", room, e, extra={"user": self.username})
+            # has_more tells the client to fall back to the history API for the rest
+            await self.send_frame({"type": "sync_complete", "room": room, "has_more": has_more})
+
+    async def stream_room_since(self, db, room, peer, last_id):
+        """Sends messages after last_id in bounded batches; returns True if the cap was hit.
+
+        Reading starts SYNC_OVERLAP_SECONDS before last_id, so a message another worker sent
+        just before it but with a higher id is not skipped; the client drops ids it already has.
+        """
+        if buckets.is_bucketed(last_id):
+            return True # Part of the gap has been compacted into buckets; the history API serves it
+        batch_size = getattr(settings, "SYNC_BATCH_SIZE", 100)
+        max_messages = getattr(settings, "SYNC_MAX_MESSAGES", 1000)
+        # Group messages carry no per-peer read state
+        peer_watermark = await receipts.get_watermark_async(db, room, peer) if peer else None
+        # ids are assigned when a message is sent and sort by its millisecond (chat/message_ids.py)
+        since = message_ids.overlap_floor(last_id, getattr(settings, "SYNC_OVERLAP_SECONDS", 2))
+        cursor = (
+            db.chats.find({"room": room, "_id": {"$gte": since}}, HISTORY_PROJECTION)
+            .sort("_id", 1)
+            .limit(max_messages + 1)
+            .batch_size(batch_size)
+        )
+        batch, sent, has_more = [], 0, False
+        async for doc in cursor:
+            if sent == max_messages:
+                has_more = True
+                break
+            batch.append(_serialize_message(doc, room, peer_watermark))
+            sent += 1
+            if len(batch) == batch_size:
+                await self.send_frame({"type": "sync_batch", "room": room, "messages": batch})
+                batch = []
+        if batch:
+            await self.send_frame({"type": "sync_batch", "room": room, "messages": batch})
+        return has_more
+
+    async def send_group_message(self, payload):
+        """Stores a group message once and fans it out with a single group_send."""
+        group_id = groups.parse_group_id(payload.get("group"))
+        if group_id not in self.group_ids:
+            return # Not a member (or membership was revoked on this socket)
+        room = groups.group_room(group_id)
+        doc = {
+            "_id": message_ids.new_message_id(),
+            "room": room,
+            "group": group_id,
+            "sender": self.username,
+            "recipient": None,
+            "message": payload.get("message", ""),
+            "timestamp": datetime.utcnow(),
+            "read": False,
+        }
+        if payload.get("attachment"):
+            ref = await self.resolve_attachment(payload["attachment"], room)
+            if ref is not None:
+                doc["attachment"] = ref
+        await chat_writer.enqueue(doc)
+        out = {
+            "type": "chat",
+            "from": self.username,
+            "event_type": "chat",
+            "sender": self.username,
+            "room": room,
+            "group": group_id,
+            "message": doc["message"],
+            "message_id": str(doc["_id"]),
+            "timestamp": doc["timestamp"].isoformat(),
+            "read": False,
+            "temp_message_id": payload.get("temp_message_id"),
+        }
+        if "attachment" in doc:
+            out["attachment"] = doc["attachment"]
+        # Every member socket (the sender's included) is in the group's channel; no per-member sends
+        await self.group_send(groups.group_channel(group_id), codec.prepared_event("room_event", out))
+
+    async def resolve_attachment(self, reference, room):
+        """Checks a chat frame's attachment reference and returns the compact form to store and send.
+
+        Only an uploader of the file may send it; the room is recorded so its members can
+        download it. Returns None for anything else.
+        """
+        attachment_id = reference.get("id") if isinstance(reference, dict) else reference
+        if not attachments.is_attachment_id(attachment_id):
+            return None
+        db = await get_async_db()
+        if db is None:
+            return None
+        doc = await db.attachments.find_one_and_update(
+            {"_id": attachment_id, "uploaders": self.username},
+            {"$addToSet": {"rooms": room}},
+            projection={"filename": 1, "size": 1, "content_type": 1},
+        )
+        return attachments.attachment_ref(doc) if doc is not None else None
+
+    async def group_membership(self, event):
+        """Joins or leaves a group's channel when membership changes while connected."""
+        group_id = event["group_id"]
+        groups.invalidate(group_id, [self.username])
+        if event["is_member"]:
+            self.group_ids.add(group_id)
+            await self.channel_layer.group_add(groups.group_channel(group_id), self.channel_name)
+        else:
+            self.group_ids.discard(group_id)
+            await self.channel_layer.group_discard(groups.group_channel(group_id), self.channel_name)
+        await self.send_frame({"type": "group_membership", "group": group_id, "is_member": event["is_member"]})
+
+    async def record_call_event(self, event_type, recipient, payload):
+        """Logs a group call event sent by this user (1:1 calls are logged by chat/calls.py)."""
+        await calls.log_call_event(
+            event_type, self.username, recipient, self.room_name, bool(payload.get("is_group_call"))
+        )
+
+    async def track_call(self, msg_type, peer, out):
+        """Keeps the call registry in step with 1:1 signaling; returns False if the frame must not be relayed."""
+        if msg_type == "offer":
+            status, call_id = await calls.registry.start(self.username, peer, self.room_name)
+            if status in ("busy", "in_call"):
+                call = calls.Call(None, self.username, peer, self.room_name, status)
+                await self.send_frame(calls.call_state_frame(call, "ended"))
+                if status == "busy":
+                    await calls.log_call_end(call) # The callee still sees they missed a call
+                return False
+            self.active_calls[peer] = out["call_id"] = call_id
+            if status == "ringing":
+                await calls.log_call_event("call", self.username, peer, self.room_name)
+        elif msg_type == "answer":
+            call = await calls.registry.answer(self.username)
+            if call is not None and peer in (call.caller, call.callee):
+                self.active_calls[peer] = out["call_id"] = call.id
+                if call.reason == "answered":
+                    await calls.broadcast_call_state(self.channel_layer, call, "active")
+        return True
+
+    async def close_call(self, call, ended_by=None):
+        """Tells both participants a call ended and logs how."""
+        await calls.broadcast_call_state(self.channel_layer, call, "ended", ended_by)
+        await calls.log_call_end(call, ended_by)
+
     async def send_push_notification(self, recipient_username, title, body, url):
-        db = get_db()
-        if db is not None:
+        """Hands the notification to the push dispatcher; delivery happens off the socket's path."""
+        push.dispatcher.enqueue(recipient_username, title, body, url)
+
+    def queue_read_watermark(self, room, peer, message_id):
+        """Coalesces read marks per room so only the highest id is written once per window."""
+        current = self.pending_reads.get(room)
+        if current is None or message_id > current[1]:
+            self.pending_reads[room] = (peer, message_id)
+        if self.read_flush_task is None or self.read_flush_task.done():
+            delay = getattr(settings, "READ_WATERMARK_WINDOW", 0.5)
+            self.read_flush_task = asyncio.create_task(self.flush_read_watermarks(delay))
+
+    async def flush_read_watermarks(self, delay=0):
+        """Persists pending watermarks and sends each peer one aggregated update."""
+        if delay:
+            await asyncio.sleep(delay)
+        pending, self.pending_reads = getattr(self, "pending_reads", {}), {}
+        if not pending:
+            return
+        db = await get_async_db()
+        for room, (peer, message_id) in pending.items():
             try:
-                # Get the recipient user object
-                RecipientUser = await database_sync_to_async(get_user_model().objects.get)(username=recipient_username)
-
-                # Find the recipient's subscription from MongoDB
-                subscription_doc = await sync_to_async(db.subscriptions.find_one)(
-                    {"user_id": RecipientUser.id} # Use recipient's user_id
+                if db is not None:
+                    await receipts.advance_watermark(db, room, self.username, message_id)
+                if peer is None:
+                    continue # Group room: the watermark only feeds unread counts
+                await self.group_send(
+                    f"user_{peer}",
+                    codec.prepared_event("room_event", {
+                        "type": "read_watermark",
+                        "room": room,
+                        "reader": self.username,
+                        "message_id": str(message_id),
+                    }),
                 )
-                if subscription_doc and subscription_doc.get("subscription"):
-                    subscription_info = subscription_doc["subscription"]
-                    payload = {"head": title, "body": body, "url": url}
-                    await sync_to_async(send_user_notification)(
-                        user=RecipientUser, # Pass the Django recipient user object
-                        payload=payload,
-                        vapid_private_key=settings.VAPID_PRIVATE_KEY,
-                        vapid_admin_email=settings.VAPID_ADMIN_EMAIL,
-                        push_subscription=subscription_info
-                    )
             except Exception as e:
-                print(f"[WebPush] Failed to send push notification: {e}")
+                logger.warning("read watermark update failed for room %s: %s", room, e, extra={"user": self.username})
+
+    async def send_throttle(self, msg_type, data, name, scope, retry_after):
+        """Tells the client a frame was dropped for exceeding its budget and when to retry."""
+        metrics.frames_throttled.inc(name, scope)
+        frames_logger.info("throttled type=%s user=%s scope=%s", msg_type, self.username, scope)
+        # Chat frames are always answered so the client can mark that message as failed
+        temp_id = data.get("temp_message_id")
+        if temp_id is None and not self.limiter.should_notify(name, retry_after):
+            return
+        await self.send_frame({
+            "type": "throttle",
+            "class": name,
+            "scope": scope,
+            "frame_type": msg_type,
+            "retry_after": round(retry_after, 3),
+            "temp_message_id": temp_id,
+        })
+
+    async def send_typing(self, recipient_username, is_typing):
+        """Send typing indicator only to the intended recipient."""
+        await self.group_send(
+            f"user_{recipient_username}",
+            codec.prepared_event(
+                "typing_indicator",
+                {
+                    "type": "typing_indicator",
+                    "username": self.username,
+                    "is_typing": is_typing,
+                    "room": self.room_name, # Include room for client-side filtering
+                },
+                username=self.username, # Kept outside the encoded frame for the sender check
+                room=self.room_name,
+            ),
+        )
+
+    def send_prepared(self, event, priority=outbound.NORMAL, key=None):
+        """Queues a pre-encoded frame as-is; events carrying a plain message are encoded here."""
+        if "message" in event:
+            frame = self.codec.encode(event["message"])
+        else:
+            frame = codec.frame_for(event, self.codec)
+        self.outbound.put(frame, priority, key)
 
     async def typing_indicator(self, event):
         """Handles the 'typing_indicator' event to send typing status to the websocket."""
-        username = event["username"]
-        is_typing = event["is_typing"]
-        room = event.get("room") # Get room from event
-        if username != self.username: # Don't send typing indicator back to the sender
-            await self.send(text_data=json.dumps({
-                "type": "typing_indicator",
-                "username": username,
-                "is_typing": is_typing,
-                "room": room, # Include room in the outgoing message
-            }))
+        if event.get("username") != self.username: # Don't send typing indicator back to the sender
+            self.send_prepared(event, outbound.LOW, f"typing:{event.get('username')}:{event.get('room')}")
 
     async def room_event(self, event):
-        message = event.get("message", {})
-        try:
-            await self.send(text_data=json.dumps(message))
-        except Exception:
-            pass
+        closed = event.get("call_closed")
+        if closed and closed in self.active_calls.values():
+            self.active_calls = {peer: cid for peer, cid in self.active_calls.items() if cid != closed}
+        self.send_prepared(event)
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+
+from .log import get_logger
+
+logger = get_logger("directory")
+
+VERSION_KEY = "contacts:version"
+
+
+def _version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # add() keeps concurrent first requests from resetting each other's version
+        cache.add(VERSION_KEY, 1, None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def bump_version(update_fields=None, using=None, **kwargs):
+    """Invalidates every cached directory page; connected to user save/delete signals."""
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        return # Logins touch the user row but don't change the directory
+    # After commit, so a page read in between can't be cached under the new version
+    transaction.on_commit(_incr_version, using=using)
+
+
+def _incr_version():
+    # Runs inside signup, login and admin saves: a cache outage must not fail them
+    try:
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.add(VERSION_KEY, 1, None)
+    except Exception as e:
+        logger.warning("contacts version bump failed: %s", e)
+
+
+def page_size(raw=None):
+    default = getattr(settings, "CONTACTS_PAGE_SIZE", 50)
+    try:
+        size = int(raw) if raw else default
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, getattr(settings, "CONTACTS_MAX_PAGE_SIZE", 200)))
+
+
+def _fetch_page(prefix, after, limit):
+    users = get_user_model().objects.order_by("username")
+    if prefix:
+        # A range on the unique username index instead of LIKE, so prefix search stays indexed
+        users = users.filter(username__gte=prefix, username__lt=prefix + "\uffff")
+    if after:
+        users = users.filter(username__gt=after)
+    return list(users.values_list("username", flat=True)[:limit])
+
+
+def search(exclude_username, prefix="", after="", limit=None):
+    """Returns one page of contacts ordered by username.
+
+    Pages are keyset-paginated on username and cached under the current user-table
+    version, so they are shared by every viewer (the viewer is filtered out afterwards).
+    """
+    limit = page_size(limit)
+    key = f"contacts:v{_version()}:{prefix}:{after}:{limit}"
+    # One extra row covers the excluded viewer, one more tells us whether another page exists
+    usernames = cache.get(key)
+    if usernames is None:
+        usernames = _fetch_page(prefix, after, limit + 2)
+        cache.set(key, usernames, getattr(settings, "CONTACTS_CACHE_TTL", 300))
+
+    visible = [u for u in usernames if u != exclude_username]
+    has_more = len(visible) > limit
+    visible = visible[:limit]
+    return {
+        "contacts": [{"username": u} for u in visible],
+        "next_after": visible[-1] if has_more else None,
+        "has_more": has_more,
+    }
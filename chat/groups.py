@@ -0,0 +1,159 @@
+from datetime import datetime
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from django.conf import settings
+
+from .ttl_cache import TTLCache
+
+# Group conversations live in db.groups as {name, members: [usernames], created_by, admins, created_at}.
+# Only the creator and admins change membership; any member may leave.
+# Messages are stored once per group under room "group_<id>", and every member socket joins
+# the single channel-layer group "groupmsg_<id>", so a message is one group_send regardless
+# of the number of members.
+
+GROUP_ROOM_PREFIX = "group_"
+UNREAD_ROOMS_PER_QUERY = 100 # $unionWith branches per aggregate, well under the pipeline stage limit
+
+_members = TTLCache(getattr(settings, "GROUP_CACHE_TTL", 60)) # group id -> frozenset of usernames
+_user_groups = TTLCache(getattr(settings, "GROUP_CACHE_TTL", 60)) # username -> tuple of group ids
+
+
+def max_members():
+    return getattr(settings, "GROUP_MAX_MEMBERS", 256)
+
+
+def group_room(group_id):
+    return f"{GROUP_ROOM_PREFIX}{group_id}"
+
+
+def group_channel(group_id):
+    return f"groupmsg_{group_id}"
+
+
+def parse_group_id(value):
+    try:
+        return str(ObjectId(value))
+    except (InvalidId, TypeError):
+        return None
+
+
+def parse_group_room(room_name):
+    """Returns the group id for a "group_<id>" room name, or None for 1-1 rooms."""
+    if isinstance(room_name, str) and room_name.startswith(GROUP_ROOM_PREFIX):
+        return parse_group_id(room_name[len(GROUP_ROOM_PREFIX):])
+    return None
+
+
+def invalidate(group_id, usernames=()):
+    _members.invalidate(group_id)
+    for username in usernames:
+        _user_groups.invalidate(username)
+
+
+async def get_members(db, group_id):
+    """Cached member set for a group (empty if the group does not exist)."""
+    entry = _members.get(group_id)
+    if entry is not None:
+        return entry[1]
+    doc = await db.groups.find_one({"_id": ObjectId(group_id)}, {"members": 1})
+    members = frozenset(doc.get("members", ())) if doc else frozenset()
+    _members.set(group_id, members)
+    return members
+
+
+def get_members_sync(db, group_id):
+    entry = _members.get(group_id)
+    if entry is not None:
+        return entry[1]
+    doc = db.groups.find_one({"_id": ObjectId(group_id)}, {"members": 1})
+    members = frozenset(doc.get("members", ())) if doc else frozenset()
+    _members.set(group_id, members)
+    return members
+
+
+async def groups_for_user(db, username):
+    """Cached ids of the groups a user belongs to; served by the multikey members index."""
+    entry = _user_groups.get(username)
+    if entry is not None:
+        return entry[1]
+    limit = getattr(settings, "GROUP_MAX_PER_USER", 500)
+    group_ids = tuple([
+        str(doc["_id"]) async for doc in db.groups.find({"members": username}, {"_id": 1}).limit(limit)
+    ])
+    _user_groups.set(username, group_ids)
+    return group_ids
+
+
+def get_group_sync(db, group_id):
+    """Uncached group document, for permission checks."""
+    return db.groups.find_one({"_id": ObjectId(group_id)}, {"members": 1, "created_by": 1, "admins": 1})
+
+
+def is_member_sync(db, group_id, username):
+    """Uncached membership check for HTTP views: the member cache is per process, and other
+    workers only invalidate it when a member socket hears about the change."""
+    return db.groups.find_one({"_id": ObjectId(group_id), "members": username}, {"_id": 1}) is not None
+
+
+def is_admin(group, username):
+    # Groups created before admins existed only have created_by
+    return username == group.get("created_by") or username in group.get("admins", ())
+
+
+def create_group(db, name, created_by, members):
+    members = sorted(set(members) | {created_by})
+    result = db.groups.insert_one({
+        "name": name,
+        "members": members,
+        "created_by": created_by,
+        "admins": [created_by],
+        "created_at": datetime.utcnow(),
+    })
+    group_id = str(result.inserted_id)
+    invalidate(group_id, members)
+    return group_id, members
+
+
+def update_members(db, group_id, add=(), remove=()):
+    """Applies membership changes and returns the new member list, or None if `add` would exceed max_members().
+
+    `add` should only hold users who are not members yet.
+    """
+    if add:
+        room_left = max_members() - len(add)
+        if room_left < 0:
+            return None
+        # Only matches while the group has room for all of them, so concurrent adds can't overshoot
+        result = db.groups.update_one(
+            {"_id": ObjectId(group_id), f"members.{room_left}": {"$exists": False}},
+            {"$addToSet": {"members": {"$each": list(add)}}},
+        )
+        if not result.matched_count:
+            return None
+    if remove:
+        db.groups.update_one({"_id": ObjectId(group_id)}, {"$pullAll": {"members": list(remove)}})
+    invalidate(group_id, list(add) + list(remove))
+    return sorted(get_members_sync(db, group_id))
+
+
+def unread_counts(db, reader, watermarks, cap):
+    """Unread messages from others per group room, each counted up to cap.
+
+    watermarks maps each room to the reader's last read id (or None). Every room is its own
+    capped branch on the (room, _id) index, joined with $unionWith, so many groups cost a
+    few round trips and a busy group at most cap index entries.
+    """
+    def branch(room):
+        match = {"room": room, "sender": {"$ne": reader}}
+        if watermarks.get(room) is not None:
+            match["_id"] = {"$gt": watermarks[room]}
+        return [{"$match": match}, {"$limit": cap}, {"$group": {"_id": room, "unread": {"$sum": 1}}}]
+
+    rooms = list(watermarks)
+    counts = {}
+    for start in range(0, len(rooms), UNREAD_ROOMS_PER_QUERY):
+        chunk = rooms[start:start + UNREAD_ROOMS_PER_QUERY]
+        pipeline = branch(chunk[0]) + [{"$unionWith": {"coll": "chats", "pipeline": branch(r)}} for r in chunk[1:]]
+        counts.update((doc["_id"], doc["unread"]) for doc in db.chats.aggregate(pipeline))
+    return counts
@@ -0,0 +1,101 @@
+import time
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.http.cookie import parse_cookie
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import metrics
+from .log import get_logger
+from .ttl_cache import TTLCache
+
+# WebSocket authentication from the SimpleJWT access token that the login view sets as a
+# cookie. The token's signature and expiry are checked in-process and the user row it names
+# is cached briefly, so a reconnect storm does not cost a session and a user query per
+# socket. Sockets without a valid token fall through to the session AuthMiddlewareStack.
+
+# Clients that cannot send the cookie offer the token as an extra subprotocol, "jwt.<token>",
+# next to a codec subprotocol (chat.json / chat.msgpack.v1) that the server can select.
+TOKEN_SUBPROTOCOL_PREFIX = "jwt."
+
+logger = get_logger("auth")
+
+# user id -> active user, or None for unknown/inactive ids
+user_cache = TTLCache(getattr(settings, "WS_AUTH_USER_CACHE_TTL", 60))
+
+
+def token_from_scope(scope):
+    """The raw access token from the handshake's subprotocols or cookie, if any."""
+    for protocol in scope.get("subprotocols") or ():
+        if protocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return protocol[len(TOKEN_SUBPROTOCOL_PREFIX):]
+    cookie_name = settings.SIMPLE_JWT.get("AUTH_COOKIE")
+    for name, value in scope.get("headers") or ():
+        if name == b"cookie":
+            return parse_cookie(value.decode("latin1")).get(cookie_name)
+    return None
+
+
+@database_sync_to_async
+def _load_user(user_id):
+    User = get_user_model()
+    user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+    return user if user is not None and user.is_active else None
+
+
+async def user_for_token(raw):
+    """Returns (user, from_cache); user is None when the token is invalid or names no active user."""
+    try:
+        token = AccessToken(raw)
+    except TokenError as e:
+        logger.debug("rejected websocket token: %s", e)
+        return None, False
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    if user_id is None:
+        return None, False
+
+    entry = user_cache.get(user_id)
+    if entry is not None:
+        return entry[1], True
+    user = await _load_user(user_id)
+    user_cache.set(user_id, user)
+    return user, False
+
+
+class _SessionTimer:
+    """Innermost app of the session stack; records how long session authentication took."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        started = scope.get("auth_started")
+        if started is not None:
+            metrics.ws_auth_seconds.observe(time.perf_counter() - started, "session")
+        return await self.inner(scope, receive, send)
+
+
+class JWTAuthMiddleware:
+    """Sets scope["user"] from a valid access token, otherwise defers to session auth."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.session_stack = AuthMiddlewareStack(_SessionTimer(inner))
+
+    async def __call__(self, scope, receive, send):
+        started = time.perf_counter()
+        raw = token_from_scope(scope)
+        if raw:
+            user, from_cache = await user_for_token(raw)
+            if user is not None:
+                metrics.ws_auth_seconds.observe(time.perf_counter() - started, "jwt_cached" if from_cache else "jwt")
+                return await self.inner(dict(scope, user=user), receive, send)
+        return await self.session_stack(dict(scope, auth_started=started), receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    return JWTAuthMiddleware(inner)
@@ -0,0 +1,104 @@
+import atexit
+import itertools
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# Structured logging for the realtime stack. Loggers are named "chat.<category>" so levels
+# can be set per category (see LOGGING in settings). Records are handed to a queue on the
+# calling thread and formatted/written by a listener thread, so the event loop never
+# blocks on stdout. Messages use %-style args, which are only formatted if emitted.
+
+# Standard LogRecord attributes; anything else on a record came from extra= and is emitted as a field
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+def get_logger(category):
+    return logging.getLogger(f"chat.{category}")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any extra= fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class QueueLogHandler(QueueHandler):
+    """Enqueues records without formatting them; a listener thread formats and writes.
+
+    If the queue is full the record is dropped and counted rather than blocking the loop.
+    """
+
+    def __init__(self, max_queue=10000, stream=None, json_format=True):
+        super().__init__(queue.Queue(maxsize=max_queue))
+        self.dropped = 0
+        target = logging.StreamHandler(stream or sys.stderr)
+        target.setFormatter(JsonFormatter() if json_format else logging.Formatter("[%(name)s] %(levelname)s %(message)s"))
+        self.listener = QueueListener(self.queue, target, respect_handler_level=False)
+        self.listener.start()
+        atexit.register(self.listener.stop) # Flushes what is still queued
+
+    def prepare(self, record):
+        # Tracebacks reference live frames, so render them now; the message itself is formatted later
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through 1 in `rate` records (per logger), for high-frequency events.
+
+    WARNING and above always pass. The emitted record carries sample_rate so totals can be
+    estimated downstream.
+    """
+
+    def __init__(self, rate=100, name=""):
+        super().__init__(name)
+        self.rate = max(1, int(rate))
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate == 1:
+            return True
+        if next(self._counter) % self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+
+
+def apply_levels(loggers, spec):
+    """Merges per-category levels ("consumer=DEBUG,frames=INFO") into a LOGGING["loggers"] dict.
+
+    Levels are added to an existing logger entry rather than replacing it, so filters
+    configured there (e.g. sampling on chat.frames) stay in place.
+    """
+    for item in (spec or "").split(","):
+        category, _, level = item.partition("=")
+        if category.strip() and level.strip():
+            name = f"chat.{category.strip()}"
+            loggers[name] = {**loggers.get(name, {}), "level": level.strip().upper()}
+    return loggers
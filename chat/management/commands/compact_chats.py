@@ -0,0 +1,76 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import attachments, buckets
+from chat.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = (
+        "Packs chat messages older than CHAT_BUCKET_AFTER_DAYS into per-room buckets and moves "
+        "data older than CHAT_ARCHIVE_AFTER_DAYS to db.chat_archive. Also removes attachment "
+        "uploads abandoned for ATTACHMENT_UPLOAD_EXPIRY_HOURS. Run one instance at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--sleep", type=float, default=0.05,
+            help="Seconds to pause between batches to keep load on the primary low.",
+        )
+        parser.add_argument(
+            "--loop", type=float, default=0,
+            help="Keep running as a background job, starting a new pass every LOOP seconds.",
+        )
+
+    def handle(self, *args, **options):
+        db = get_db()
+        if db is None:
+            raise CommandError("MongoDB not connected.")
+        while True:
+            self.run_pass(db, options["batch_size"], options["sleep"])
+            if not options["loop"]:
+                break
+            time.sleep(options["loop"])
+
+    def run_pass(self, db, batch_size, sleep):
+        expired = attachments.expire_uploads(db, getattr(settings, "ATTACHMENT_UPLOAD_EXPIRY_HOURS", 24))
+        if expired:
+            self.stdout.write(f"Removed {expired} abandoned uploads")
+
+        # Archive first so nothing is bucketed only to be moved again straight away
+        archive_days = buckets.archive_after_days()
+        if archive_days > 0:
+            cutoff = buckets.cutoff_id(archive_days)
+            for source, query in (("chats", {"_id": {"$lt": cutoff}}), ("chat_buckets", {"end_id": {"$lt": cutoff}})):
+                moved = self.drain(lambda: buckets.archive_batch(db, source, query, batch_size), sleep)
+                if moved:
+                    self.stdout.write(f"Archived {moved} documents from {source}")
+
+        bucket_days = buckets.bucket_after_days()
+        if bucket_days > 0:
+            cutoff = buckets.cutoff_id(bucket_days)
+            moved = self.drain(
+                lambda: buckets.compact_batch(
+                    db, cutoff, batch_size,
+                    getattr(settings, "CHAT_BUCKET_MAX_MESSAGES", 200),
+                    getattr(settings, "CHAT_BUCKET_SPAN_HOURS", 24),
+                ),
+                sleep,
+            )
+            if moved:
+                self.stdout.write(f"Compacted {moved} messages into buckets")
+
+        self.stdout.write(self.style.SUCCESS("Compaction pass complete."))
+
+    def drain(self, step, sleep):
+        total = 0
+        while True:
+            moved = step()
+            total += moved
+            if not moved:
+                return total
+            if sleep:
+                time.sleep(sleep)
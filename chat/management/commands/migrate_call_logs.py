@@ -0,0 +1,97 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import UpdateOne
+
+from chat.mongo import get_db
+
+CHECKPOINT_ID = "call_logs"
+LIFECYCLE_TYPES = ["call", "missed_call", "end_call", "reject"]
+SIGNALING_TYPES = ["offer", "answer", "ice"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Copies call lifecycle events from db.notifications into the compact db.call_logs "
+        "collection in resumable batches, optionally purging stored offer/answer/ice frames."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--sleep", type=float, default=0.05,
+            help="Seconds to pause between batches to keep load on the primary low.",
+        )
+        parser.add_argument(
+            "--restart", action="store_true",
+            help="Ignore the saved checkpoint and scan from the beginning.",
+        )
+        parser.add_argument(
+            "--purge-signaling", action="store_true",
+            help="Afterwards, delete offer/answer/ice documents from db.notifications.",
+        )
+
+    def handle(self, *args, **options):
+        db = get_db()
+        if db is None:
+            raise CommandError("MongoDB not connected.")
+
+        batch_size = options["batch_size"]
+        if options["restart"]:
+            db.migrations.delete_one({"_id": CHECKPOINT_ID})
+        checkpoint = db.migrations.find_one({"_id": CHECKPOINT_ID}) or {}
+        last_id = checkpoint.get("last_id")
+        copied = checkpoint.get("copied", 0)
+        if last_id is not None:
+            self.stdout.write(f"Resuming after _id {last_id} ({copied} copied so far)")
+
+        while True:
+            query = {"type": {"$in": LIFECYCLE_TYPES}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            docs = list(db.notifications.find(query).sort("_id", 1).limit(batch_size))
+            if not docs:
+                break
+
+            # Upserting on the original _id keeps reruns idempotent
+            ops = [
+                UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$setOnInsert": {
+                        "type": doc["type"],
+                        "sender": doc.get("sender"),
+                        "recipient": doc.get("recipient") or (doc.get("payload") or {}).get("to"),
+                        "room": doc.get("room"),
+                        "is_group_call": bool((doc.get("payload") or {}).get("is_group_call")),
+                        "timestamp": doc.get("timestamp"),
+                    }},
+                    upsert=True,
+                )
+                for doc in docs
+            ]
+            result = db.call_logs.bulk_write(ops, ordered=False)
+            copied += result.upserted_count
+
+            last_id = docs[-1]["_id"]
+            db.migrations.update_one(
+                {"_id": CHECKPOINT_ID},
+                {"$set": {"last_id": last_id, "copied": copied, "updated_at": datetime.utcnow()}},
+                upsert=True,
+            )
+            self.stdout.write(f"Copied {copied} call events (up to _id {last_id})")
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        if options["purge_signaling"]:
+            purged = 0
+            while True:
+                ids = [d["_id"] for d in db.notifications.find({"type": {"$in": SIGNALING_TYPES}}, {"_id": 1}).limit(batch_size)]
+                if not ids:
+                    break
+                purged += db.notifications.delete_many({"_id": {"$in": ids}}).deleted_count
+                self.stdout.write(f"Purged {purged} signaling documents")
+                if options["sleep"]:
+                    time.sleep(options["sleep"])
+
+        self.stdout.write(self.style.SUCCESS(f"Done. {copied} call events copied to call_logs."))
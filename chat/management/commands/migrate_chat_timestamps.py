@@ -0,0 +1,76 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import UpdateOne
+
+from chat.mongo import get_db
+
+CHECKPOINT_ID = "chat_timestamps"
+
+
+class Command(BaseCommand):
+    help = "Converts ISO-string chats.timestamp values to native BSON dates in resumable batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--sleep", type=float, default=0.05,
+            help="Seconds to pause between batches to keep load on the primary low.",
+        )
+        parser.add_argument(
+            "--restart", action="store_true",
+            help="Ignore the saved checkpoint and scan from the beginning.",
+        )
+
+    def handle(self, *args, **options):
+        db = get_db()
+        if db is None:
+            raise CommandError("MongoDB not connected.")
+
+        batch_size = options["batch_size"]
+        if options["restart"]:
+            db.migrations.delete_one({"_id": CHECKPOINT_ID})
+        checkpoint = db.migrations.find_one({"_id": CHECKPOINT_ID}) or {}
+        last_id = checkpoint.get("last_id")
+        converted = checkpoint.get("converted", 0)
+        if last_id is not None:
+            self.stdout.write(f"Resuming after _id {last_id} ({converted} converted so far)")
+
+        while True:
+            query = {"timestamp": {"$type": "string"}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            docs = list(
+                db.chats.find(query, {"timestamp": 1}).sort("_id", 1).limit(batch_size)
+            )
+            if not docs:
+                break
+
+            ops = []
+            for doc in docs:
+                try:
+                    parsed = datetime.fromisoformat(doc["timestamp"])
+                except ValueError:
+                    self.stderr.write(f"Skipping {doc['_id']}: unparseable timestamp {doc['timestamp']!r}")
+                    continue
+                # Matching on the old value keeps the update a no-op if the document changed meanwhile
+                ops.append(UpdateOne(
+                    {"_id": doc["_id"], "timestamp": doc["timestamp"]},
+                    {"$set": {"timestamp": parsed}},
+                ))
+            if ops:
+                result = db.chats.bulk_write(ops, ordered=False)
+                converted += result.modified_count
+
+            last_id = docs[-1]["_id"]
+            db.migrations.update_one(
+                {"_id": CHECKPOINT_ID},
+                {"$set": {"last_id": last_id, "converted": converted, "updated_at": datetime.utcnow()}},
+                upsert=True,
+            )
+            self.stdout.write(f"Converted {converted} messages (up to _id {last_id})")
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        self.stdout.write(self.style.SUCCESS(f"Done. {converted} chat timestamps converted."))
@@ -0,0 +1,40 @@
+import itertools
+import os
+import threading
+import time
+from datetime import timedelta
+
+from bson.objectid import ObjectId
+
+# Chat message ids. Catch-up, read watermarks, history pages and buckets all order messages
+# by _id, but a standard ObjectId only has a seconds timestamp followed by a random
+# per-process value, so two workers' messages within one second sort in arbitrary order.
+# Message ids keep the ObjectId layout and its seconds prefix (generation_time still works)
+# but put the milliseconds next, so ids from different processes sort by send time:
+#   4 bytes unix seconds | 2 bytes milliseconds | 3 bytes per-process random | 3 bytes counter
+# Ids made within the same millisecond on different hosts can still differ from send order
+# by their clock skew; catch-up re-reads a short overlap for that (see overlap_floor).
+
+_process = os.urandom(3)
+_process_pid = os.getpid()
+_counter = itertools.count(int.from_bytes(os.urandom(3), "big"))
+_lock = threading.Lock()
+
+
+def new_message_id(now=None):
+    global _process, _process_pid
+    now = time.time() if now is None else now
+    seconds = int(now)
+    millis = min(999, int((now - seconds) * 1000))
+    with _lock:
+        if os.getpid() != _process_pid: # Forked worker: don't share the parent's process bytes
+            _process, _process_pid = os.urandom(3), os.getpid()
+        count = next(_counter) & 0xFFFFFF
+    return ObjectId(
+        seconds.to_bytes(4, "big") + millis.to_bytes(2, "big") + _process + count.to_bytes(3, "big")
+    )
+
+
+def overlap_floor(message_id, seconds):
+    """The lowest id that could belong to a message sent up to `seconds` before message_id."""
+    return ObjectId.from_datetime(message_id.generation_time - timedelta(seconds=seconds))
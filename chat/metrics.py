@@ -0,0 +1,203 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+from .log import get_logger
+
+# Per-process metrics in Prometheus text format. Most updates come from the worker's event
+# loop, but pymongo calls the command listener on whichever thread runs the sync client
+# (views, management commands, flush_sync), so each metric guards its values with a lock.
+# Derived values such as queue depths and the presence set size are read when /metrics is
+# scraped. Prometheus scrapes every worker and sums across them.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Inbound frame types we label individually; anything else is counted as "other"
+FRAME_TYPES = frozenset({
+    "chat", "typing", "read_up_to", "sync", "presence_subscribe", "get_online_users", "busy_check", "ack",
+    "offer", "answer", "ice", "call", "missed_call", "end_call", "reject",
+})
+
+_registry = []
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(labelnames, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.value}"]
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {} # labels -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(series)) for labels, series in self.series.items()]
+        for labels, series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            base = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{base} {series[-1]}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+
+active_connections = Gauge("chat_active_connections", "Open chat WebSockets in this worker.")
+frames_received = Counter("chat_frames_received_total", "Frames received from clients, by type.", ("type",))
+frames_sent = Counter("chat_frames_sent_total", "Frames sent to clients.")
+group_send_seconds = Histogram("chat_group_send_seconds", "Channel-layer group_send latency.")
+push_send_seconds = Histogram("chat_push_send_seconds", "Web push request latency, by outcome.", ("outcome",))
+mongo_command_seconds = Histogram("chat_mongo_command_seconds", "MongoDB command latency, by command.", ("command",))
+outbound_dropped = Counter("chat_outbound_dropped_total", "Outbound frames dropped for slow clients, by reason.", ("reason",))
+slow_consumer_disconnects = Counter("chat_slow_consumer_disconnects_total", "Sockets closed because their outbound backlog hit OUTBOUND_MAX_BYTES.")
+frames_throttled = Counter("chat_frames_throttled_total", "Inbound frames dropped by rate limits, by class and scope.", ("class", "scope"))
+ws_auth_seconds = Histogram("chat_ws_auth_seconds", "WebSocket connect authentication latency, by method.", ("method",))
+
+
+def count_frame(frame_type):
+    frames_received.inc(frame_type if frame_type in FRAME_TYPES else "other")
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times insert/update/delete/find commands issued by both Mongo clients."""
+
+    COMMANDS = frozenset({"insert", "update", "delete", "find", "getMore", "aggregate", "count", "findAndModify"})
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if event.command_name in self.COMMANDS:
+            mongo_command_seconds.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        if event.command_name in self.COMMANDS:
+            mongo_command_seconds.observe(event.duration_micros / 1e6, event.command_name)
+
+
+mongo_listener = MongoCommandListener()
+
+
+def _stat_lines(prefix, stats):
+    """Exports a component's stats dict: last_*/max_* entries are gauges, the rest are running totals."""
+    lines = []
+    for key, value in stats.items():
+        if key.startswith(("last_", "max_")):
+            name, kind = f"{prefix}_{key}", "gauge"
+        else:
+            name, kind = f"{prefix}_{key.removeprefix('total_')}_total", "counter"
+        lines.extend((f"# TYPE {name} {kind}", f"{name} {value}"))
+    return lines
+
+
+def channel_layer_depth(channel_layer):
+    """Messages buffered in this process's channel-layer queues, waiting for consumers."""
+    # InMemoryChannelLayer and the pub/sub layer keep a queue per channel in .channels;
+    # the core Redis layer buffers messages received for local channels in .receive_buffer.
+    queues = getattr(channel_layer, "receive_buffer", None)
+    if queues is None:
+        queues = getattr(channel_layer, "channels", None) or {}
+    return sum(q.qsize() for q in list(queues.values()) if hasattr(q, "qsize"))
+
+
+async def render():
+    """Builds the exposition text; scrape-time values are collected here."""
+    from channels.layers import get_channel_layer
+
+    from . import presence, push, typing_state
+    from .persistence import chat_writer
+
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+
+    gauges = {
+        "chat_write_behind_pending": chat_writer.pending(),
+        "chat_push_queue_pending": push.dispatcher.pending(),
+        "chat_channel_layer_buffered": channel_layer_depth(get_channel_layer()),
+    }
+    try:
+        gauges["chat_presence_online_users"] = await presence.online_count()
+    except Exception as e:
+        get_logger("metrics").warning("presence size unavailable: %s", e)
+    for name, value in gauges.items():
+        lines.extend((f"# TYPE {name} gauge", f"{name} {value}"))
+
+    lines.extend(_stat_lines("chat_write_behind", chat_writer.stats))
+    lines.extend(_stat_lines("chat_push", push.dispatcher.stats))
+    lines.extend(_stat_lines("chat_typing", typing_state.stats))
+    return "\n".join(lines) + "\n"
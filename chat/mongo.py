@@ -1,33 +1,199 @@
+import asyncio
 import os
-from pymongo import MongoClient
+import time
+from pymongo import AsyncMongoClient, MongoClient
+from pymongo.errors import OperationFailure
 from django.conf import settings
 
+from . import metrics
+from .log import get_logger
+
+logger = get_logger("mongo")
+
 _client = None
 _db = None
 
-def _init():
-    global _client, _db
+_async_client = None
+_async_db = None
+_async_loop = None
+_async_lock = None # One init at a time per event loop (see _init_lock)
+_async_lock_loop = None
+
+# After a failed connection attempt, callers get None at once until the retry time instead
+# of each waiting out server selection; the delay doubles per failure up to INIT_RETRY_MAX
+INIT_RETRY_MIN = 1
+INIT_RETRY_MAX = 30
+_retry_at = {"sync": 0.0, "async": 0.0}
+_failures = {"sync": 0, "async": 0}
+
+
+def _record_failure(kind):
+    _failures[kind] += 1
+    _retry_at[kind] = time.monotonic() + min(INIT_RETRY_MAX, INIT_RETRY_MIN * 2 ** (_failures[kind] - 1))
+
+
+def _record_success(kind):
+    _failures[kind] = 0
+    _retry_at[kind] = 0.0
+
+
+def _backing_off(kind):
+    return time.monotonic() < _retry_at[kind]
+
+INDEXES = [
+    # Create indexes for chats collection
+    ("chats", [("room", 1), ("timestamp", 1)]),
+    ("chats", [("room", 1), ("_id", -1)]), # Keyset pagination for the history API
+    # Create indexes for notifications collection
+    ("notifications", [("room", 1), ("timestamp", 1)]),
+    ("notifications", [("recipient", 1), ("timestamp", 1)]), # For user-specific notifications
+    ("call_logs", [("recipient", 1), ("timestamp", -1)]), # Notifications page: newest calls for a user
+    ("groups", [("members", 1)]), # Multikey: the groups a user belongs to
+    ("chat_buckets", [("room", 1), ("start_id", -1)]), # History reads past the hot tier
+    ("chat_buckets", [("room", 1), ("window", 1), ("start_id", -1)]), # Compaction: the room's newest bucket per window
+    ("chat_buckets", [("end_id", 1)]), # Archival of old buckets
+    ("uploads", [("updated", 1)]), # Expiry of abandoned attachment uploads
+]
+
+# Notifications and call logs expire through TTL indexes when NOTIFICATION_RETENTION_DAYS is set
+TTL_COLLECTIONS = ("notifications", "call_logs")
+TTL_INDEX_NAME = "timestamp_ttl"
+
+def _ttl_seconds():
+    return getattr(settings, "NOTIFICATION_RETENTION_DAYS", 0) * 86400
+
+def _drop_ttl(collection):
+    try:
+        collection.drop_index(TTL_INDEX_NAME)
+    except OperationFailure:
+        pass # No TTL index
+
+async def _drop_ttl_async(collection):
+    try:
+        await collection.drop_index(TTL_INDEX_NAME)
+    except OperationFailure:
+        pass
+
+def _ensure_ttl(db):
+    """Best effort: a failure only disables retention, never the database handle."""
+    seconds = _ttl_seconds()
+    for collection in TTL_COLLECTIONS:
+        try:
+            if seconds <= 0:
+                _drop_ttl(db[collection]) # Retention turned off: stop expiring entries
+                continue
+            try:
+                db[collection].create_index("timestamp", name=TTL_INDEX_NAME, expireAfterSeconds=seconds)
+            except OperationFailure:
+                # The retention period changed; update the existing index in place
+                db.command("collMod", collection, index={"name": TTL_INDEX_NAME, "expireAfterSeconds": seconds})
+        except Exception as e:
+            logger.error("TTL index on %s not applied: %s", collection, e)
+
+async def _ensure_ttl_async(db):
+    seconds = _ttl_seconds()
+    for collection in TTL_COLLECTIONS:
+        try:
+            if seconds <= 0:
+                await _drop_ttl_async(db[collection])
+                continue
+            try:
+                await db[collection].create_index("timestamp", name=TTL_INDEX_NAME, expireAfterSeconds=seconds)
+            except OperationFailure:
+                await db.command("collMod", collection, index={"name": TTL_INDEX_NAME, "expireAfterSeconds": seconds})
+        except Exception as e:
+            logger.error("TTL index on %s not applied: %s", collection, e)
+
+def _conn_params():
     uri = getattr(settings, "MONGO_URI", "") or os.getenv("MONGO_URI", "")
     dbname = getattr(settings, "MONGO_DB_NAME", "") or os.getenv("MONGO_DB_NAME", "")
+    return uri, dbname
+
+def _pool_options():
+    return {
+        "minPoolSize": getattr(settings, "MONGO_MIN_POOL_SIZE", 0),
+        "maxPoolSize": getattr(settings, "MONGO_MAX_POOL_SIZE", 100),
+        "waitQueueTimeoutMS": getattr(settings, "MONGO_WAIT_QUEUE_TIMEOUT_MS", None),
+    }
+
+def _init():
+    global _client, _db
+    uri, dbname = _conn_params()
     if uri and dbname:
+        client = None
         try:
-            _client = MongoClient(uri, serverSelectionTimeoutMS=3000)
-            _client.server_info()
-            _db = _client[dbname]
+            client = MongoClient(uri, serverSelectionTimeoutMS=3000, event_listeners=[metrics.mongo_listener], **_pool_options())
+            client.server_info()
+            db = client[dbname]
 
-            # Create indexes for chats collection
-            _db.chats.create_index([("room", 1), ("timestamp", 1)])
-            # Create indexes for notifications collection
-            _db.notifications.create_index([("room", 1), ("timestamp", 1)])
-            _db.notifications.create_index([("recipient", 1), ("timestamp", 1)]) # For user-specific notifications
+            for collection, keys in INDEXES:
+                db[collection].create_index(keys)
+            _ensure_ttl(db)
 
         except Exception as e:
-            print(f"[MongoDB] connection failed: {e}")
-            _client = None
-            _db = None
+            logger.error("connection failed: %s", e)
+            _record_failure("sync")
+            if client is not None:
+                client.close()
+            return
+        _client, _db = client, db
+        _record_success("sync")
 
 def get_db():
-    global _db
-    if _db is None:
+    if _db is None and not _backing_off("sync"):
         _init()
     return _db
+
+def _init_lock(loop):
+    global _async_lock, _async_lock_loop
+    if _async_lock_loop is not loop:
+        _async_lock, _async_lock_loop = asyncio.Lock(), loop
+    return _async_lock
+
+async def _close_quietly(client):
+    try:
+        await client.close()
+    except Exception as e: # e.g. its event loop is already gone
+        logger.debug("closing stale async client failed: %s", e)
+
+async def _async_init(loop):
+    global _async_client, _async_db, _async_loop
+    uri, dbname = _conn_params()
+    if uri and dbname:
+        client = None
+        try:
+            client = AsyncMongoClient(uri, serverSelectionTimeoutMS=3000, event_listeners=[metrics.mongo_listener], **_pool_options())
+            await client.admin.command("ping")
+            db = client[dbname]
+            for collection, keys in INDEXES:
+                await db[collection].create_index(keys)
+            await _ensure_ttl_async(db)
+        except Exception as e:
+            logger.error("async connection failed: %s", e)
+            _record_failure("async")
+            if client is not None:
+                await _close_quietly(client)
+            return
+        _async_client, _async_db, _async_loop = client, db, loop
+        _record_success("async")
+
+async def get_async_db():
+    """Returns the asyncio-native database handle for use inside consumers.
+
+    The async client is bound to the event loop that created it. Concurrent first callers
+    share one connection attempt, and a client left from another loop is closed.
+    """
+    global _async_client, _async_db, _async_loop
+    loop = asyncio.get_running_loop()
+    if _async_db is not None and _async_loop is loop:
+        return _async_db
+    if _backing_off("async"):
+        return None
+    async with _init_lock(loop):
+        if _async_db is not None and _async_loop is not loop:
+            stale = _async_client
+            _async_client = _async_db = _async_loop = None
+            await _close_quietly(stale)
+        if _async_db is None and not _backing_off("async"):
+            await _async_init(loop)
+    return _async_db
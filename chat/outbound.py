@@ -0,0 +1,172 @@
+import asyncio
+import itertools
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from . import metrics
+from .log import get_logger
+
+# Application close code (4000-4999) for a client that fell too far behind; clients should
+# reconnect and resync rather than retry immediately.
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Frame priorities. LOW frames (typing, presence) are dropped first when a socket falls behind.
+NORMAL = 0
+LOW = 1
+
+# How long a reply waits for the backlog to drain below high water before the socket is closed
+REPLY_WAIT_SECONDS = 10
+
+logger = get_logger("outbound")
+
+
+class OutboundQueue:
+    """Per-connection send buffer between the consumer's handlers and the socket.
+
+    Channel-layer handlers queue a frame and return at once, so the channel-layer inbox keeps
+    draining while a writer task feeds the socket at the client's pace. Past high_water
+    pending bytes, LOW frames are dropped (queued ones first); past max_bytes the socket is
+    closed with SLOW_CONSUMER_CLOSE_CODE.
+
+    send() returning does not mean the client has the frame: daphne buffers writes in its
+    transport and returns at once. Clients therefore acknowledge how many frames they have
+    received ({"type": "ack", "frames": n}); once a socket has acknowledged, written frames
+    stay counted as pending until their ack arrives, so a client that stops reading runs
+    into the same limits. Sockets that never ack are only bounded by their queue.
+
+    Replies (put_wait) only wait for the queue itself to drain, and are not held as unacked
+    once written: acks are frames the consumer handles one at a time, so none can arrive
+    while a handler is sending, and a large catch-up must not push the socket over its limits.
+    Replies are bounded by the client's own request rate instead.
+    """
+
+    def __init__(self, send, close, high_water=None, max_bytes=None):
+        self._send = send # coroutine function taking a str or bytes frame
+        self._close = close # coroutine function taking a close code
+        self.high_water = high_water or getattr(settings, "OUTBOUND_HIGH_WATER_BYTES", 256 * 1024)
+        self.max_bytes = max_bytes or getattr(settings, "OUTBOUND_MAX_BYTES", 1024 * 1024)
+        self._frames = OrderedDict() # key -> (priority, frame); unkeyed frames get a counter key
+        self._ids = itertools.count()
+        self.pending_bytes = 0 # Queued plus written-but-unacknowledged bytes
+        self.queued_bytes = 0 # Queued, not yet written to the socket
+        self._wakeup = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._writer = None
+        self._close_task = None
+        self.closed = False
+        self.written = 0 # Frames written to the socket, numbered like the client's ack count
+        self.acking = False # Set by the first ack
+        self._unacked = deque() # (frame number, size) written but not yet acknowledged
+        self._replies = set() # Queue keys of put_wait frames, which are not tracked once written
+
+    def put(self, frame, priority=NORMAL, key=None):
+        """Queues a frame without waiting, applying the drop policies.
+
+        A frame with a key replaces a still-queued frame with the same key in its place,
+        e.g. so only a user's latest presence status is delivered.
+        """
+        if self.closed:
+            return
+        if key is not None and key in self._frames:
+            _, old = self._frames[key]
+            self._frames[key] = (priority, frame)
+            self.pending_bytes += len(frame) - len(old)
+            self.queued_bytes += len(frame) - len(old)
+            metrics.outbound_dropped.inc("coalesced")
+            return
+        if self.pending_bytes + len(frame) > self.high_water:
+            if priority == LOW:
+                metrics.outbound_dropped.inc("low_priority")
+                return
+            self._shed_low()
+            if self.pending_bytes + len(frame) > self.max_bytes:
+                self._overflow()
+                return
+        self._append(frame, priority, key)
+
+    async def put_wait(self, frame):
+        """Queues a reply to the client's own request, first waiting until the queue is below high water.
+
+        Written-but-unacknowledged bytes are not counted, since the client's acks are only
+        processed after the handler calling this returns. A queue that does not drain for
+        REPLY_WAIT_SECONDS is closed as a slow consumer.
+        """
+        while self.queued_bytes > self.high_water and not self.closed:
+            self._writable.clear()
+            try:
+                await asyncio.wait_for(self._writable.wait(), REPLY_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                self._overflow()
+        if not self.closed:
+            self._replies.add(self._append(frame, NORMAL, None))
+
+    def ack(self, frames):
+        """Records that the client has received `frames` frames in total since connecting."""
+        if self.closed or not isinstance(frames, int) or frames > self.written:
+            return
+        if not self.acking:
+            self.acking = True # Frames written before the first ack are not tracked
+            return
+        while self._unacked and self._unacked[0][0] <= frames:
+            _, size = self._unacked.popleft()
+            self.pending_bytes -= size
+
+    def close(self):
+        """Discards whatever is queued and stops the writer."""
+        self.closed = True
+        self._frames.clear()
+        self._replies.clear()
+        self.pending_bytes = 0
+        self.queued_bytes = 0
+        self._writable.set()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+    def _append(self, frame, priority, key):
+        key = key if key is not None else next(self._ids)
+        self._frames[key] = (priority, frame)
+        self.pending_bytes += len(frame)
+        self.queued_bytes += len(frame)
+        if self._writer is None:
+            self._writer = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+        return key
+
+    def _shed_low(self):
+        for key in [k for k, (priority, _) in self._frames.items() if priority == LOW]:
+            _, frame = self._frames.pop(key)
+            self.pending_bytes -= len(frame)
+            self.queued_bytes -= len(frame)
+            metrics.outbound_dropped.inc("low_priority")
+
+    def _overflow(self):
+        metrics.slow_consumer_disconnects.inc()
+        logger.warning("closing slow consumer: %d bytes pending in %d frames", self.pending_bytes, len(self._frames))
+        self.close()
+        self._close_task = asyncio.get_running_loop().create_task(self._close(SLOW_CONSUMER_CLOSE_CODE))
+
+    async def _run(self):
+        while not self.closed:
+            if not self._frames:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            key, (_, frame) = self._frames.popitem(last=False)
+            reply = key in self._replies
+            self._replies.discard(key)
+            self.queued_bytes -= len(frame)
+            if self.queued_bytes <= self.high_water:
+                self._writable.set()
+            try:
+                await self._send(frame)
+            except Exception as e:
+                logger.debug("outbound send failed: %s", e)
+            finally:
+                if not self.closed:
+                    self.written += 1
+                    if self.acking and not reply:
+                        self._unacked.append((self.written, len(frame))) # Still pending until acknowledged
+                    else:
+                        self.pending_bytes -= len(frame)
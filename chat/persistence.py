@@ -0,0 +1,158 @@
+import asyncio
+import atexit
+import time
+
+from django.conf import settings
+
+from .log import get_logger
+from .mongo import get_async_db, get_db
+
+logger = get_logger("persistence")
+
+
+class ChatWriteBehind:
+    """Per-process write-behind queue that batches chat documents into db.chats.
+
+    Messages are broadcast with their ids before they are written, so a batch that cannot be
+    written is kept and retried with backoff. It is only dropped (and counted in
+    stats["dropped"]) once the queue behind it is full, i.e. when senders would otherwise block.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=0.05, max_queue=10000, retry_max=5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # Seconds to wait for a batch to fill up
+        self.max_queue = max_queue
+        self.retry_max = retry_max # Longest backoff between attempts at one batch, in seconds
+        self._queue = None
+        self._task = None
+        self._inflight = []
+        self.stats = {
+            "enqueued": 0,
+            "flushed": 0,
+            "dropped": 0,
+            "retried": 0,
+            "batches": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def _ensure_started(self):
+        # The queue and flusher task are bound to the running loop, so create them lazily
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def pending(self):
+        """Returns the number of documents waiting to be written."""
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + len(self._inflight)
+
+    async def enqueue(self, doc):
+        """Queues a chat document; blocks the caller only when the queue is full."""
+        self._ensure_started()
+        await self._queue.put(doc)
+        self.stats["enqueued"] += 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._inflight = batch
+            try:
+                await self._flush(batch)
+            finally:
+                self._inflight = []
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch):
+        attempt = 0
+        while True:
+            attempt += 1
+            started = time.perf_counter()
+            db = await get_async_db()
+            if db is None:
+                error = "MongoDB unavailable"
+            else:
+                try:
+                    # _id is assigned before enqueueing, so a retried batch cannot duplicate messages
+                    await db.chats.insert_many(batch, ordered=False)
+                    self._record_flush(len(batch), started)
+                    return
+                except Exception as e:
+                    if _only_duplicate_keys(e):
+                        self._record_flush(len(batch), started)
+                        return
+                    error = e
+            if self._queue.full():
+                self.stats["dropped"] += len(batch)
+                logger.error("write-behind queue full, dropped %d messages after %d attempts: %s", len(batch), attempt, error)
+                return
+            self.stats["retried"] += 1
+            logger.warning("insert_many failed (attempt %d), retrying: %s", attempt, error)
+            await asyncio.sleep(min(self.retry_max, 0.1 * 2 ** attempt))
+
+    def _record_flush(self, size, started):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["flushed"] += size
+        self.stats["batches"] += 1
+        self.stats["last_batch_size"] = size
+        self.stats["max_batch_size"] = max(self.stats["max_batch_size"], size)
+        self.stats["last_flush_ms"] = elapsed_ms
+        self.stats["max_flush_ms"] = max(self.stats["max_flush_ms"], elapsed_ms)
+        self.stats["total_flush_ms"] += elapsed_ms
+
+    async def drain(self):
+        """Waits until every queued document has been flushed."""
+        if self._queue is not None and self._task is not None and not self._task.done():
+            await self._queue.join()
+
+    def flush_sync(self):
+        """Writes whatever is still buffered; used at interpreter shutdown when the loop is gone."""
+        remaining = list(self._inflight)
+        if self._queue is not None:
+            while True:
+                try:
+                    remaining.append(self._queue.get_nowait())
+                except Exception:
+                    break
+        if not remaining:
+            return
+        db = get_db()
+        if db is None:
+            logger.error("MongoDB unavailable at shutdown, dropped %d messages", len(remaining))
+            return
+        try:
+            db.chats.insert_many(remaining, ordered=False)
+        except Exception as e:
+            if not _only_duplicate_keys(e):
+                logger.error("shutdown flush failed: %s", e)
+
+
+def _only_duplicate_keys(exc):
+    # BulkWriteError where every failure is E11000 means the batch already landed
+    details = getattr(exc, "details", None) or {}
+    errors = details.get("writeErrors") or []
+    return bool(errors) and all(err.get("code") == 11000 for err in errors)
+
+
+chat_writer = ChatWriteBehind(
+    batch_size=getattr(settings, "CHAT_WRITE_BATCH_SIZE", 100),
+    flush_interval=getattr(settings, "CHAT_WRITE_FLUSH_INTERVAL", 0.05),
+    max_queue=getattr(settings, "CHAT_WRITE_MAX_QUEUE", 10000),
+    retry_max=getattr(settings, "CHAT_WRITE_RETRY_MAX", 5.0),
+)
+atexit.register(chat_writer.flush_sync)
@@ -0,0 +1,275 @@
+import asyncio
+import os
+
+import redis.asyncio as redis
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import codec, metrics
+from .log import get_logger
+from .sharding import HashRing, parse_urls
+
+# One client (and connection pool) per presence shard, separate from the channel layer's pools.
+# Users are placed on shards by a consistent hash of the username, so all of a user's
+# connection entries and refcount live on one shard and the Lua scripts stay single-node.
+PRESENCE_URLS = parse_urls(getattr(settings, "PRESENCE_REDIS_URLS", None)) or [
+    os.getenv("REDIS_URL", "redis://localhost:6379/0")
+]
+def _client(url):
+    # Waits for a free connection when the pool is exhausted instead of raising
+    pool = redis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=getattr(settings, "PRESENCE_REDIS_MAX_CONNECTIONS", 50),
+        timeout=getattr(settings, "PRESENCE_REDIS_POOL_TIMEOUT", 5),
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+shards = [_client(url) for url in PRESENCE_URLS]
+ring = HashRing(PRESENCE_URLS)
+
+logger = get_logger("presence")
+
+ONLINE_USERS_KEY = "online_users"
+CONNECTIONS_KEY = "presence:conns" # ZSET of "<username>|<channel_name>" scored by expiry time
+REFCOUNT_KEY = "presence:refcount" # HASH of username -> live connection count
+
+# All scripts take KEYS = [CONNECTIONS_KEY, REFCOUNT_KEY, ONLINE_USERS_KEY] and use the
+# Redis server clock, so expiry is consistent across worker processes.
+_TOUCH_LUA = """
+local t = redis.call('TIME')
+local expires = tonumber(t[1]) + tonumber(ARGV[1])
+local online = {}
+for i = 2, #ARGV, 2 do
+  local member, user = ARGV[i], ARGV[i + 1]
+  if redis.call('ZADD', KEYS[1], expires, member) == 1 then
+    if redis.call('HINCRBY', KEYS[2], user, 1) == 1 then
+      redis.call('SADD', KEYS[3], user)
+      table.insert(online, user)
+    end
+  end
+end
+return online
+"""
+
+_RELEASE_LUA = """
+local offline = {}
+for i = 1, #ARGV, 2 do
+  local member, user = ARGV[i], ARGV[i + 1]
+  if redis.call('ZREM', KEYS[1], member) == 1 then
+    if redis.call('HINCRBY', KEYS[2], user, -1) <= 0 then
+      redis.call('HDEL', KEYS[2], user)
+      redis.call('SREM', KEYS[3], user)
+      table.insert(offline, user)
+    end
+  end
+end
+return offline
+"""
+
+_SWEEP_LUA = """
+local t = redis.call('TIME')
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', t[1], 'LIMIT', 0, tonumber(ARGV[1]))
+local offline = {}
+for _, member in ipairs(expired) do
+  local user = string.match(member, '^(.*)|[^|]*$')
+  redis.call('ZREM', KEYS[1], member)
+  if user and redis.call('HINCRBY', KEYS[2], user, -1) <= 0 then
+    redis.call('HDEL', KEYS[2], user)
+    redis.call('SREM', KEYS[3], user)
+    table.insert(offline, user)
+  end
+end
+return {#expired, offline}
+"""
+
+# Removes online-set members without a refcount: users marked online before the refcount
+# tracker existed (or left on a shard that no longer owns them) that nothing would clear.
+# The other scripts keep the set and the hash in step, so a live user is never removed.
+_RECONCILE_LUA = """
+local scan = redis.call('SSCAN', KEYS[3], ARGV[1], 'COUNT', tonumber(ARGV[2]))
+local stale = {}
+for _, user in ipairs(scan[2]) do
+  if redis.call('HEXISTS', KEYS[2], user) == 0 then
+    redis.call('SREM', KEYS[3], user)
+    table.insert(stale, user)
+  end
+end
+return {scan[1], stale}
+"""
+
+_KEYS = [CONNECTIONS_KEY, REFCOUNT_KEY, ONLINE_USERS_KEY]
+
+
+def presence_group(username):
+    """Channel-layer group that receives status changes for a single user."""
+    return f"presence_{username}"
+
+
+def shard_index(username):
+    return ring.index(username)
+
+
+def _by_shard(usernames):
+    grouped = {}
+    for username in usernames:
+        grouped.setdefault(shard_index(username), []).append(username)
+    return grouped
+
+
+def max_interest():
+    return getattr(settings, "PRESENCE_MAX_INTEREST", 500)
+
+
+def normalize_interest(usernames, exclude=None):
+    """Dedupes and caps a client-supplied list of usernames, preserving order."""
+    if not isinstance(usernames, (list, tuple)):
+        return []
+    wanted = dict.fromkeys(
+        u for u in usernames if isinstance(u, str) and u and u != exclude
+    )
+    return list(wanted)[:max_interest()]
+
+
+async def broadcast_status(channel_layer, username, is_online):
+    """Sends a user's online/offline status to the sockets subscribed to that user."""
+    status_message = {
+        "type": "user_status",
+        "username": username,
+        "is_online": is_online,
+    }
+    event = codec.prepared_event("send_user_status", status_message, username=username) # username keys coalescing
+    with metrics.group_send_seconds.time():
+        await channel_layer.group_send(presence_group(username), event)
+
+
+async def online_among(usernames):
+    """Returns the subset of usernames that are online, without reading the whole set."""
+    grouped = _by_shard(usernames)
+    if not grouped:
+        return []
+    # One SMISMEMBER per shard, issued concurrently
+    results = await asyncio.gather(*(
+        shards[index].smismember(ONLINE_USERS_KEY, names) for index, names in grouped.items()
+    ))
+    online = set()
+    for names, flags in zip(grouped.values(), results):
+        online.update(u for u, is_online in zip(names, flags) if is_online)
+    return [u for u in usernames if u in online]
+
+
+async def online_count():
+    """Size of the online set, summed over shards."""
+    counts = await asyncio.gather(*(shard.scard(ONLINE_USERS_KEY) for shard in shards))
+    return sum(counts)
+
+
+def _decode(values):
+    return [v.decode("utf-8") if isinstance(v, bytes) else v for v in values]
+
+
+class PresenceTracker:
+    """Reference-counted presence backed by expiring per-connection entries.
+
+    Every connection is a member of a sorted set scored by its expiry time. Each
+    worker process refreshes its own connections in one batch per heartbeat, so a
+    crashed worker's entries simply stop being refreshed and the sweeper (which any
+    worker may run, atomically) removes them and reports the users that went offline.
+    Each user lives on one shard; heartbeats and sweeps run per shard.
+    """
+
+    def __init__(self, clients, ttl=60, heartbeat_interval=20, sweep_batch=500):
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.sweep_batch = sweep_batch
+        self._local = {} # member -> username for connections owned by this process
+        self._task = None
+        self._touch = [c.register_script(_TOUCH_LUA) for c in clients]
+        self._release = [c.register_script(_RELEASE_LUA) for c in clients]
+        self._sweep = [c.register_script(_SWEEP_LUA) for c in clients]
+        self._reconcile = [c.register_script(_RECONCILE_LUA) for c in clients]
+
+    @staticmethod
+    def _member(username, conn_id):
+        return f"{username}|{conn_id}"
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def connect(self, username, conn_id):
+        """Registers a connection; returns True if the user just came online."""
+        self._ensure_started()
+        member = self._member(username, conn_id)
+        self._local[member] = username
+        touch = self._touch[shard_index(username)]
+        online = await touch(keys=_KEYS, args=[self.ttl, member, username])
+        return bool(online)
+
+    async def disconnect(self, username, conn_id):
+        """Releases a connection; returns True if it was the user's last one."""
+        member = self._member(username, conn_id)
+        self._local.pop(member, None)
+        offline = await self._release[shard_index(username)](keys=_KEYS, args=[member, username])
+        return bool(offline)
+
+    async def heartbeat(self):
+        """Refreshes every local connection; returns users that (re)appeared online."""
+        if not self._local:
+            return []
+        args_by_shard = {}
+        for member, username in self._local.items():
+            args_by_shard.setdefault(shard_index(username), [self.ttl]).extend((member, username))
+        results = await asyncio.gather(*(
+            self._touch[index](keys=_KEYS, args=args) for index, args in args_by_shard.items()
+        ))
+        return [u for online in results for u in _decode(online)]
+
+    async def sweep(self):
+        """Expires stale connections in bounded batches; returns users that went offline."""
+        offline = []
+        for sweep in self._sweep:
+            while True:
+                removed, went_offline = await sweep(keys=_KEYS, args=[self.sweep_batch])
+                offline.extend(_decode(went_offline))
+                if removed < self.sweep_batch:
+                    break
+        return offline
+
+    async def reconcile(self):
+        """Clears online-set members that have no live connection; returns them."""
+        stale = []
+        for reconcile in self._reconcile:
+            cursor = "0"
+            while True:
+                cursor, removed = await reconcile(keys=_KEYS, args=[cursor, self.sweep_batch])
+                stale.extend(_decode(removed))
+                if _decode([cursor])[0] == "0":
+                    break
+        return stale
+
+    async def _run(self):
+        channel_layer = get_channel_layer()
+        try:
+            # Once per process: idempotent, and cheap next to a heartbeat once the legacy entries are gone
+            for username in dict.fromkeys(await self.reconcile()): # A legacy user may be on several shards
+                await broadcast_status(channel_layer, username, False)
+        except Exception as e:
+            logger.warning("presence reconcile failed: %s", e)
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                for username in await self.heartbeat():
+                    await broadcast_status(channel_layer, username, True)
+                for username in await self.sweep():
+                    await broadcast_status(channel_layer, username, False)
+            except Exception as e:
+                logger.warning("heartbeat/sweep failed: %s", e)
+
+
+tracker = PresenceTracker(
+    shards,
+    ttl=getattr(settings, "PRESENCE_TTL", 60),
+    heartbeat_interval=getattr(settings, "PRESENCE_HEARTBEAT_INTERVAL", 20),
+    sweep_batch=getattr(settings, "PRESENCE_SWEEP_BATCH", 500),
+)
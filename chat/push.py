@@ -0,0 +1,234 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from pywebpush import WebPushException, webpush
+
+from . import metrics
+from .log import get_logger
+from .mongo import get_async_db
+from .ttl_cache import TTLCache
+
+logger = get_logger("push")
+
+# Push service responses that mean the subscription is gone for good
+EXPIRED_STATUSES = {404, 410}
+
+# Bumped in the shared cache whenever a subscription is saved or removed, so every worker
+# process drops its cached subscriptions instead of pushing to a replaced endpoint
+SUBSCRIPTIONS_VERSION_KEY = "push:subscriptions:version"
+
+
+def bump_subscriptions_version():
+    try:
+        cache.incr(SUBSCRIPTIONS_VERSION_KEY)
+    except ValueError:
+        cache.add(SUBSCRIPTIONS_VERSION_KEY, 1, None)
+
+
+class PushDispatcher:
+    """Out-of-band web push delivery.
+
+    Consumers only enqueue jobs. A pool of worker tasks drains the queue in batches,
+    resolves recipients and subscriptions in one query each (through TTL caches),
+    sends concurrently, retries transient failures with backoff and deletes
+    subscriptions the push service reports as expired.
+    """
+
+    def __init__(self, workers=4, batch_size=50, max_queue=10000, max_retries=3,
+                 cache_ttl=300, negative_cache_ttl=30, request_timeout=10):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.negative_cache_ttl = negative_cache_ttl
+        self.request_timeout = request_timeout
+        self.user_ids = TTLCache(cache_ttl) # username -> user id
+        self.subscriptions = TTLCache(cache_ttl) # user id -> subscription info (or None)
+        self._subscriptions_version = None # SUBSCRIPTIONS_VERSION_KEY when the cache was last checked
+        self._queue = None
+        self._tasks = []
+        self.stats = {
+            "enqueued": 0,
+            "dropped": 0,
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "expired": 0,
+            "no_subscription": 0,
+        }
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [t for t in self._tasks if not t.done()]
+        loop = asyncio.get_running_loop()
+        while len(self._tasks) < self.workers:
+            self._tasks.append(loop.create_task(self._worker()))
+
+    def enqueue(self, recipient_username, title, body, url):
+        """Queues a notification without waiting; drops it if the queue is full."""
+        self._ensure_started()
+        job = {
+            "recipient": recipient_username,
+            "payload": {"head": title, "body": body, "url": url},
+            "attempt": 0,
+        }
+        try:
+            self._queue.put_nowait(job)
+            self.stats["enqueued"] += 1
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+    def invalidate_subscription(self, user_id):
+        """Drops the user's cached subscription here and, through the shared version, in every process."""
+        self.subscriptions.invalidate(user_id)
+        bump_subscriptions_version()
+
+    async def _check_subscriptions_version(self):
+        try:
+            version = await cache.aget(SUBSCRIPTIONS_VERSION_KEY)
+        except Exception as e:
+            logger.warning("subscription version check failed: %s", e)
+            return
+        if version != self._subscriptions_version:
+            self.subscriptions.clear()
+            self._subscriptions_version = version
+
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _worker(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._dispatch(batch)
+            except Exception:
+                self.stats["failed"] += len(batch)
+                logger.exception("batch dispatch failed for %d jobs", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _dispatch(self, batch):
+        user_ids = await self._resolve_user_ids({job["recipient"] for job in batch})
+        subscriptions = await self._resolve_subscriptions(set(user_ids.values()))
+        sends = []
+        for job in batch:
+            user_id = user_ids.get(job["recipient"])
+            subscription = subscriptions.get(user_id)
+            if not subscription:
+                self.stats["no_subscription"] += 1
+                continue
+            sends.append(self._send(job, user_id, subscription))
+        await asyncio.gather(*sends)
+
+    async def _resolve_user_ids(self, usernames):
+        resolved, missing = {}, []
+        for username in usernames:
+            entry = self.user_ids.get(username)
+            if entry is None:
+                missing.append(username)
+            elif entry[1] is not None:
+                resolved[username] = entry[1]
+        if missing:
+            rows = await database_sync_to_async(
+                lambda: dict(get_user_model().objects.filter(username__in=missing).values_list("username", "id"))
+            )()
+            for username in missing:
+                user_id = rows.get(username)
+                self.user_ids.set(username, user_id, None if user_id else self.negative_cache_ttl)
+                if user_id:
+                    resolved[username] = user_id
+        return resolved
+
+    async def _resolve_subscriptions(self, user_ids):
+        await self._check_subscriptions_version() # One cache read per batch
+        resolved, missing = {}, []
+        for user_id in user_ids:
+            entry = self.subscriptions.get(user_id)
+            if entry is None:
+                missing.append(user_id)
+            else:
+                resolved[user_id] = entry[1]
+        if missing:
+            found = {}
+            db = await get_async_db()
+            if db is not None:
+                async for doc in db.subscriptions.find({"user_id": {"$in": missing}}):
+                    found[doc["user_id"]] = doc.get("subscription")
+            for user_id in missing:
+                subscription = found.get(user_id)
+                self.subscriptions.set(user_id, subscription, None if subscription else self.negative_cache_ttl)
+                resolved[user_id] = subscription
+        return resolved
+
+    async def _send(self, job, user_id, subscription):
+        start = time.perf_counter()
+        outcome = "sent"
+        try:
+            await sync_to_async(webpush, thread_sensitive=False)(
+                subscription_info=subscription,
+                data=json.dumps(job["payload"]),
+                vapid_private_key=settings.VAPID_PRIVATE_KEY,
+                vapid_claims={"sub": settings.VAPID_ADMIN_EMAIL},
+                timeout=self.request_timeout,
+            )
+            self.stats["sent"] += 1
+        except WebPushException as e:
+            outcome = "rejected"
+            status = getattr(e.response, "status_code", None)
+            if status in EXPIRED_STATUSES:
+                await self._drop_subscription(user_id, subscription)
+            else:
+                self._retry(job, e)
+        except Exception as e:
+            outcome = "error"
+            self._retry(job, e)
+        finally:
+            metrics.push_send_seconds.observe(time.perf_counter() - start, outcome)
+
+    async def _drop_subscription(self, user_id, subscription):
+        """Deletes the expired endpoint only; the user may have subscribed again since it was cached."""
+        self.stats["expired"] += 1
+        self.subscriptions.invalidate(user_id)
+        db = await get_async_db()
+        if db is None:
+            return
+        result = await db.subscriptions.delete_one(
+            {"user_id": user_id, "subscription.endpoint": subscription.get("endpoint")}
+        )
+        if result.deleted_count:
+            await sync_to_async(bump_subscriptions_version)()
+
+    def _retry(self, job, error):
+        job["attempt"] += 1
+        if job["attempt"] > self.max_retries:
+            self.stats["failed"] += 1
+            logger.warning("giving up on push to %s after %d attempts: %s", job["recipient"], job["attempt"], error)
+            return
+        self.stats["retried"] += 1
+        delay = 0.5 * 2 ** (job["attempt"] - 1)
+        asyncio.get_running_loop().call_later(delay, self._requeue, job)
+
+    def _requeue(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+
+dispatcher = PushDispatcher(
+    workers=getattr(settings, "PUSH_WORKERS", 4),
+    batch_size=getattr(settings, "PUSH_BATCH_SIZE", 50),
+    max_queue=getattr(settings, "PUSH_MAX_QUEUE", 10000),
+    max_retries=getattr(settings, "PUSH_MAX_RETRIES", 3),
+    cache_ttl=getattr(settings, "PUSH_CACHE_TTL", 300),
+)
@@ -0,0 +1,139 @@
+import time
+
+from django.conf import settings
+
+from . import presence
+from .log import get_logger
+
+# Inbound frame budgets for the WebSocket path (django_ratelimit only covers HTTP views).
+# Every connection has an in-process token bucket per frame class; optionally each user also
+# has a bucket per class in the presence Redis, shared by all of their sockets on every worker.
+# Over-budget frames are dropped and the client gets a "throttle" frame with retry_after.
+
+FRAME_CLASSES = {
+    "chat": "chat",
+    "typing": "typing",
+    "offer": "signaling",
+    "answer": "signaling",
+    "ice": "signaling",
+    "call": "signaling",
+    "missed_call": "signaling",
+    "end_call": "signaling",
+    "reject": "signaling",
+}
+DEFAULT_CLASS = "other" # read_up_to, sync, presence_subscribe, ...
+
+logger = get_logger("ratelimit")
+
+
+def parse_limits(spec):
+    """Parses "chat=5/20,typing=4/10" into {"chat": (5.0, 20.0), ...} (rate per second / burst).
+
+    Entries with a non-positive rate or a burst below one frame would never grant a token
+    (and the refill math divides by the rate), so they are logged and skipped.
+    """
+    limits = {}
+    for item in (spec or "").split(","):
+        name, _, value = item.partition("=")
+        rate, _, burst = value.partition("/")
+        if name.strip() and rate.strip():
+            rate = float(rate)
+            burst = float(burst) if burst.strip() else rate
+            if rate <= 0 or burst < 1:
+                logger.warning("ignoring rate limit %r: rate must be positive and burst at least 1", item.strip())
+                continue
+            limits[name.strip()] = (rate, burst)
+    return limits
+
+
+connection_limits = parse_limits(getattr(settings, "WS_RATE_LIMITS", ""))
+user_limits = parse_limits(getattr(settings, "WS_USER_RATE_LIMITS", ""))
+
+
+def frame_class(msg_type):
+    return FRAME_CLASSES.get(msg_type, DEFAULT_CLASS)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Takes one token; returns 0 if granted, else the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+# KEYS = [bucket hash]; ARGV = [rate, burst]. Same refill rule as TokenBucket, on the Redis
+# server clock so every worker agrees. Returns the wait as a string (Lua numbers are
+# truncated to integers on the way out).
+_TAKE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+_take_scripts = [shard.register_script(_TAKE_LUA) for shard in presence.shards]
+
+
+async def take_user_token(username, name, rate, burst):
+    """Takes from the user's shared bucket on their presence shard. Fails open if Redis is unavailable."""
+    script = _take_scripts[presence.shard_index(username)]
+    try:
+        return float(await script(keys=[f"ratelimit:{name}:{username}"], args=[rate, burst]))
+    except Exception as e:
+        logger.warning("user rate limit check failed, allowing frame: %s", e)
+        return 0
+
+
+class FrameLimiter:
+    """Per-connection budgets, plus the user's shared budgets when WS_USER_RATE_LIMITS is set."""
+
+    def __init__(self, username):
+        self.username = username
+        self._buckets = {name: TokenBucket(rate, burst) for name, (rate, burst) in connection_limits.items()}
+        self._notified_until = {} # class -> monotonic time until which no new throttle frame is sent
+
+    async def check(self, msg_type):
+        """Returns (class, scope, retry_after) for a frame over budget, or None if it may proceed."""
+        name = frame_class(msg_type)
+        bucket = self._buckets.get(name)
+        if bucket is not None:
+            wait = bucket.take()
+            if wait:
+                return name, "connection", wait
+        limit = user_limits.get(name)
+        if limit is not None and self.username != "Anonymous":
+            wait = await take_user_token(self.username, name, *limit)
+            if wait:
+                return name, "user", wait
+        return None
+
+    def should_notify(self, name, retry_after):
+        """One throttle frame per class per back-off window, so throttling can't be used to amplify."""
+        now = time.monotonic()
+        if self._notified_until.get(name, 0) > now:
+            return False
+        self._notified_until[name] = now + retry_after
+        return True
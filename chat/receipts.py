@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+# One document per (room, reader): "everything up to last_read_id has been read".
+# Message ids sort by send time to the millisecond (chat/message_ids.py), so a message is
+# read iff its _id <= the reader's watermark.
+
+
+def watermark_key(room, reader):
+    return f"{room}:{reader}"
+
+
+def parse_message_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+
+async def advance_watermark(db, room, reader, message_id):
+    """Moves the reader's watermark forward (never backwards) with a single upsert."""
+    await db.read_watermarks.update_one(
+        {"_id": watermark_key(room, reader)},
+        {
+            "$max": {"last_read_id": message_id},
+            "$set": {"room": room, "reader": reader, "updated_at": datetime.utcnow()},
+        },
+        upsert=True,
+    )
+
+
+def get_watermark(db, room, reader):
+    """Returns the reader's last read message id for the room, or None."""
+    doc = db.read_watermarks.find_one({"_id": watermark_key(room, reader)}, {"last_read_id": 1})
+    return doc.get("last_read_id") if doc else None
+
+
+def get_watermarks(db, rooms, reader):
+    """The reader's watermarks for many rooms in one query: room -> last read id (None if unread)."""
+    found = {
+        doc["room"]: doc.get("last_read_id")
+        for doc in db.read_watermarks.find(
+            {"_id": {"$in": [watermark_key(room, reader) for room in rooms]}}, {"room": 1, "last_read_id": 1}
+        )
+    }
+    return {room: found.get(room) for room in rooms}
+
+
+async def get_watermark_async(db, room, reader):
+    doc = await db.read_watermarks.find_one({"_id": watermark_key(room, reader)}, {"last_read_id": 1})
+    return doc.get("last_read_id") if doc else None
+
+
+def is_read(doc, watermark):
+    # Messages flagged by the old per-message receipts stay read
+    return bool(doc.get("read")) or (watermark is not None and doc["_id"] <= watermark)
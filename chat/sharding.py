@@ -0,0 +1,92 @@
+import asyncio
+import bisect
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+from channels_redis.pubsub import RedisPubSubChannelLayer, RedisPubSubLoopLayer
+from channels_redis.utils import _wrap_close
+
+
+def parse_urls(value):
+    """Splits a comma-separated list of Redis URLs (as used by the *_REDIS_URLS settings)."""
+    if isinstance(value, (list, tuple)):
+        return [u for u in value if u]
+    return [u.strip() for u in (value or "").split(",") if u.strip()]
+
+
+class HashRing:
+    """Consistent hash ring over named nodes, with virtual nodes for an even spread.
+
+    Nodes are identified by name (the Redis address), not position, so every process
+    maps a key to the same shard regardless of list order, and adding a shard only
+    moves about 1/N of the keys.
+    """
+
+    def __init__(self, nodes, vnodes=160):
+        self.nodes = list(nodes)
+        points = []
+        for index, node in enumerate(self.nodes):
+            for replica in range(vnodes if len(self.nodes) > 1 else 1):
+                points.append((self._hash(f"{node}#{replica}"), index))
+        points.sort()
+        self._points = [p for p, _ in points]
+        self._owners = [i for _, i in points]
+
+    @staticmethod
+    def _hash(value):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        return int.from_bytes(hashlib.md5(value).digest()[:8], "big")
+
+    def index(self, key):
+        """Returns the index of the node that owns key."""
+        if len(self.nodes) == 1:
+            return 0
+        i = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[i]
+
+
+def _host_name(host):
+    return host.get("address") or repr(sorted(host.items()))
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """RedisChannelLayer that places groups and channels on shards with a HashRing.
+
+    The stock layer maps names onto hosts by CRC range, so adding a host reshuffles
+    most groups; the ring keeps existing groups where they are.
+    """
+
+    def __init__(self, *args, vnodes=160, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ring = HashRing([_host_name(h) for h in self.hosts], vnodes)
+
+    def consistent_hash(self, value):
+        return self._ring.index(value)
+
+
+class _ShardedPubSubLoopLayer(RedisPubSubLoopLayer):
+    def __init__(self, *args, vnodes=160, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ring = HashRing([_host_name(shard.host) for shard in self._shards], vnodes)
+
+    def _get_shard(self, channel_or_group_name):
+        return self._shards[self._ring.index(channel_or_group_name)]
+
+
+class ShardedRedisPubSubChannelLayer(RedisPubSubChannelLayer):
+    """Pub/sub channel layer (no per-message list writes, lowest fan-out latency) on a HashRing.
+
+    Pub/sub delivery is at-most-once: a socket that is reconnecting misses frames, which
+    the client's "sync" catch-up covers for chat messages.
+    """
+
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+        try:
+            layer = self._layers[loop]
+        except KeyError:
+            layer = _ShardedPubSubLoopLayer(*self._args, **self._kwargs, channel_layer=self)
+            self._layers[loop] = layer
+            _wrap_close(self, loop)
+        return layer
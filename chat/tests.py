@@ -0,0 +1,661 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import fakeredis
+import mongomock
+from bson.objectid import ObjectId
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from . import attachments, buckets, calls, codec, consumers, directory, groups, log, message_ids, metrics, outbound, persistence, presence, ratelimit
+from .sharding import HashRing
+from .typing_state import TypingThrottle
+from .routing import websocket_urlpatterns
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def _dropped(reason):
+    return metrics.outbound_dropped.values.get((reason,), 0)
+
+
+class _AsyncCursor:
+    """Just enough of an AsyncMongoClient cursor over a mongomock one."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args):
+        self.cursor.sort(*args)
+        return self
+
+    def limit(self, n):
+        self.cursor.limit(n)
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    async def __aiter__(self):
+        for doc in self.cursor:
+            yield doc
+
+
+class _AsyncCollection:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return _AsyncCursor(self.collection.find(*args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return self.collection.find_one(*args, **kwargs)
+
+
+class _AsyncDb:
+    def __init__(self, db):
+        self.db = db
+
+    def __getattr__(self, name):
+        return _AsyncCollection(self.db[name])
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS,
+    MONGO_URI="",
+    OUTBOUND_HIGH_WATER_BYTES=4096,
+    OUTBOUND_MAX_BYTES=16384,
+)
+class SlowConsumerTests(SimpleTestCase):
+    """A client that stops acknowledging frames is shed and then closed, even though send() never blocks."""
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/alice_bob/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_from() # join
+        await communicator.send_to(text_data=json.dumps({"type": "ack", "frames": 1}))
+        return communicator
+
+    async def test_unacknowledged_backlog_drops_low_priority_then_closes(self):
+        communicator = await self.connect()
+        layer = get_channel_layer()
+        dropped = _dropped("low_priority")
+        filler = "x" * 1000
+
+        # Typing frames are LOW priority: past high water they are dropped, not queued
+        for i in range(10):
+            await layer.group_send("user_Anonymous", {
+                "type": "typing_indicator", "username": f"user{i}", "room": "alice_bob",
+                "message": {"type": "typing_indicator", "username": f"user{i}", "filler": filler},
+            })
+        self.assertGreater(_dropped("low_priority"), dropped)
+
+        # Normal frames keep accumulating until max_bytes, then the socket is closed
+        for i in range(20):
+            await layer.group_send("user_Anonymous", codec.prepared_event(
+                "room_event", {"type": "chat", "message": filler, "n": i},
+            ))
+        while True:
+            output = await communicator.receive_output(timeout=2)
+            if output["type"] == "websocket.close":
+                break
+        self.assertEqual(output["code"], outbound.SLOW_CONSUMER_CLOSE_CODE)
+        await communicator.disconnect()
+
+    async def test_acknowledging_client_is_not_closed(self):
+        communicator = await self.connect()
+        layer = get_channel_layer()
+        received = 1
+        for i in range(40):
+            await layer.group_send("user_Anonymous", codec.prepared_event(
+                "room_event", {"type": "chat", "message": "x" * 1000, "n": i},
+            ))
+            await communicator.receive_from()
+            received += 1
+            await communicator.send_to(text_data=json.dumps({"type": "ack", "frames": received}))
+        self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+        await communicator.disconnect()
+
+    async def test_catch_up_larger_than_high_water_is_delivered(self):
+        # Acks queued behind the sync request are only handled after it, so the reply must not wait on them
+        db = mongomock.MongoClient().db
+        first = message_ids.new_message_id()
+        db.chats.insert_many([
+            {"_id": message_ids.new_message_id(), "room": "Anonymous_bob", "sender": "bob", "message": "x" * 200}
+            for _ in range(150)
+        ])
+        with mock.patch.object(consumers, "get_async_db", mock.AsyncMock(return_value=_AsyncDb(db))):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/Anonymous_bob/")
+            await communicator.connect()
+            await communicator.receive_from() # join
+            await communicator.send_to(text_data=json.dumps({"type": "ack", "frames": 1}))
+            await communicator.send_to(text_data=json.dumps({"type": "sync", "rooms": {"Anonymous_bob": str(first)}}))
+            received, frames = [], 1
+            while True:
+                frame = json.loads(await communicator.receive_from(timeout=2))
+                frames += 1
+                await communicator.send_to(text_data=json.dumps({"type": "ack", "frames": frames}))
+                if frame["type"] == "sync_complete":
+                    break
+                received.extend(frame["messages"])
+            self.assertEqual(len(received), 150)
+
+            # Live delivery carries on after the catch-up
+            await get_channel_layer().group_send("user_Anonymous", codec.prepared_event("room_event", {"type": "chat", "n": 1}))
+            self.assertEqual(json.loads(await communicator.receive_from(timeout=2))["n"], 1)
+            await communicator.disconnect()
+
+
+class LogLevelTests(SimpleTestCase):
+    def test_level_override_keeps_existing_filters(self):
+        loggers = log.apply_levels({"chat.frames": {"filters": ["sample"]}}, "frames=debug, consumer=WARNING")
+        self.assertEqual(loggers["chat.frames"], {"filters": ["sample"], "level": "DEBUG"})
+        self.assertEqual(loggers["chat.consumer"], {"level": "WARNING"})
+
+    def test_malformed_entries_are_ignored(self):
+        self.assertEqual(log.apply_levels({}, "frames=,=DEBUG,,"), {})
+
+
+class MessageIdTests(SimpleTestCase):
+    def test_ids_from_different_processes_sort_by_send_time(self):
+        first = message_ids.new_message_id(now=1700000000.120)
+        with mock.patch.object(message_ids, "_process", b"\x00\x00\x00"): # A process with a lower random part
+            second = message_ids.new_message_id(now=1700000000.450)
+        self.assertLess(first, second)
+        self.assertEqual(second.generation_time.timestamp(), 1700000000)
+
+    def test_overlap_floor_precedes_ids_from_the_window(self):
+        last_seen = message_ids.new_message_id(now=1700000010.5)
+        earlier = message_ids.new_message_id(now=1700000009.0)
+        self.assertLessEqual(message_ids.overlap_floor(last_seen, 2), earlier)
+
+
+class PreparedEventTests(SimpleTestCase):
+    message = {"type": "chat", "from": "alice", "sender": "alice", "message": "hi"}
+
+    def test_compact_sockets_get_the_same_frame_with_or_without_prepacking(self):
+        lazy = codec.prepared_event("room_event", self.message)
+        self.assertNotIn("packed", lazy)
+        with mock.patch.object(codec, "PREPACK_COMPACT", True):
+            prepacked = codec.prepared_event("room_event", self.message)
+        self.assertEqual(codec.frame_for(lazy, codec.COMPACT), codec.frame_for(prepacked, codec.COMPACT))
+        self.assertEqual(codec.frame_for(lazy, codec.JSON), lazy["text"])
+
+
+class MetricsTests(SimpleTestCase):
+    def test_stats_totals_are_exported_as_counters(self):
+        lines = metrics._stat_lines("chat_write_behind", {"flushed": 3, "total_flush_ms": 1.5, "max_batch_size": 2})
+        self.assertIn("# TYPE chat_write_behind_flushed_total counter", lines)
+        self.assertIn("chat_write_behind_flush_ms_total 1.5", lines)
+        self.assertIn("# TYPE chat_write_behind_max_batch_size gauge", lines)
+
+    @override_settings(METRICS_TOKEN="", METRICS_ALLOW_LOOPBACK=False)
+    def test_endpoint_is_closed_without_a_token(self):
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="127.0.0.1").status_code, 403)
+
+    @override_settings(METRICS_TOKEN="s3cret")
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="127.0.0.1").status_code, 403)
+        with mock.patch.object(metrics, "render", mock.AsyncMock(return_value="ok\n")):
+            response = self.client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_observations_from_other_threads_are_not_lost(self):
+        histogram = metrics.Histogram("test_threaded_seconds", "Test only.")
+        metrics._registry.remove(histogram)
+
+        def observe():
+            for _ in range(10000):
+                histogram.observe(0.001)
+
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(histogram.series[()][:-1]), 40000)
+
+
+class TypingThrottleTests(SimpleTestCase):
+    async def test_stop_all_cancels_pending_timers(self):
+        stopped = []
+
+        async def send_stop(recipient):
+            stopped.append(recipient)
+
+        throttle = TypingThrottle(send_stop, timeout=0.05)
+        throttle.should_forward("bob", True)
+        await throttle.stop_all()
+        await asyncio.sleep(0.1)
+        self.assertEqual(stopped, ["bob"])
+        self.assertFalse(throttle._timers or throttle._tasks)
+
+    async def test_idle_recipient_gets_a_stop(self):
+        stopped = []
+
+        async def send_stop(recipient):
+            stopped.append(recipient)
+
+        throttle = TypingThrottle(send_stop, timeout=0.05)
+        throttle.should_forward("bob", True)
+        await asyncio.sleep(0.1)
+        self.assertEqual(stopped, ["bob"])
+        self.assertFalse(throttle._tasks)
+
+
+class DirectoryVersionTests(TestCase):
+    def test_cache_outage_does_not_fail_user_saves(self):
+        with mock.patch.object(directory.cache, "incr", side_effect=ConnectionError("redis down")), \
+                self.assertLogs("chat.directory", "WARNING"), \
+                self.captureOnCommitCallbacks(execute=True) as callbacks:
+            get_user_model().objects.create_user("carol", password="pw")
+        self.assertEqual(len(callbacks), 1)
+
+    def test_version_is_bumped_after_commit_but_not_for_logins(self):
+        user = get_user_model().objects.create_user("dave", password="pw")
+        with mock.patch.object(directory.cache, "incr") as incr:
+            with self.captureOnCommitCallbacks(execute=True):
+                user.save(update_fields=["last_login"])
+            self.assertEqual(incr.call_count, 0)
+            with self.captureOnCommitCallbacks(execute=True):
+                user.save()
+                self.assertEqual(incr.call_count, 0) # Not before the commit
+        self.assertEqual(incr.call_count, 1)
+
+
+class WriteBehindTests(SimpleTestCase):
+    """chat/persistence.py: messages are already broadcast, so a batch is only given up when the queue is full."""
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.fail = False
+        self.calls = []
+        real_insert = self.db.chats.insert_many
+
+        async def insert_many(docs, ordered=True):
+            self.calls.append(len(docs))
+            if self.fail:
+                raise AutoReconnect("primary stepped down")
+            return real_insert(docs, ordered=ordered)
+
+        fake_db = mock.Mock()
+        fake_db.chats.insert_many = insert_many
+        patcher = mock.patch.object(persistence, "get_async_db", mock.AsyncMock(return_value=fake_db))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def docs(self, n):
+        return [{"_id": message_ids.new_message_id(), "room": "alice_bob", "message": str(i)} for i in range(n)]
+
+    async def test_documents_are_written_in_batches(self):
+        writer = persistence.ChatWriteBehind(batch_size=100, flush_interval=0.01)
+        for doc in self.docs(250):
+            await writer.enqueue(doc)
+        await writer.drain()
+        self.assertEqual(self.calls, [100, 100, 50])
+        self.assertEqual(self.db.chats.count_documents({}), 250)
+        self.assertEqual(writer.stats["batches"], 3)
+
+    async def test_batch_that_already_landed_is_not_retried(self):
+        writer = persistence.ChatWriteBehind(flush_interval=0.01)
+        duplicate = BulkWriteError({"writeErrors": [{"code": 11000, "index": 0}]})
+        with mock.patch.object(self.db.chats, "insert_many", side_effect=duplicate):
+            await writer.enqueue(self.docs(1)[0])
+            await writer.drain()
+        self.assertEqual(self.calls, [1])
+        self.assertEqual((writer.stats["flushed"], writer.stats["retried"], writer.stats["dropped"]), (1, 0, 0))
+
+    async def test_failed_batch_is_kept_and_retried(self):
+        writer = persistence.ChatWriteBehind(flush_interval=0.01, retry_max=0.01)
+        self.fail = True
+        await writer.enqueue(self.docs(1)[0])
+        while len(self.calls) < 3:
+            await asyncio.sleep(0.01)
+        self.fail = False
+        await writer.drain()
+        self.assertEqual(self.db.chats.count_documents({}), 1)
+        self.assertGreaterEqual(writer.stats["retried"], 2)
+        self.assertEqual(writer.stats["dropped"], 0)
+
+    async def test_batch_is_dropped_once_the_queue_is_full(self):
+        writer = persistence.ChatWriteBehind(batch_size=1, flush_interval=0.01, max_queue=2, retry_max=0.05)
+        first, *rest = self.docs(3)
+        self.fail = True
+        await writer.enqueue(first)
+        while not self.calls:
+            await asyncio.sleep(0.01)
+        for doc in rest: # Fill the queue behind the failing batch
+            await writer.enqueue(doc)
+        while not writer.stats["dropped"]:
+            await asyncio.sleep(0.01)
+        self.fail = False
+        await writer.drain()
+        self.assertEqual(writer.stats["dropped"], 1)
+        self.assertEqual([d["_id"] for d in self.db.chats.find().sort("_id")], [d["_id"] for d in rest])
+
+
+class GroupAccessTests(TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        patcher = mock.patch("chat.views.get_db", return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.group_id = str(self.db.groups.insert_one({"name": "g", "members": ["alice", "bob"], "created_by": "bob"}).inserted_id)
+        self.client.force_login(get_user_model().objects.create_user("alice"))
+
+    def test_removal_made_by_another_worker_applies_at_once(self):
+        url = reverse("group_history", args=[self.group_id])
+        self.assertIn("alice", groups.get_members_sync(self.db, self.group_id)) # Now cached in this process
+        self.assertEqual(self.client.get(url).status_code, 200)
+        # Removed elsewhere: this process's member cache is not invalidated
+        self.db.groups.update_one({}, {"$pull": {"members": "alice"}})
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class RateLimitTests(SimpleTestCase):
+    def test_non_positive_rates_are_rejected(self):
+        with self.assertLogs("chat.ratelimit", "WARNING"):
+            limits = ratelimit.parse_limits("chat=5/20,typing=0/10,call=-1,ice=2/0.5,other=3")
+        self.assertEqual(limits, {"chat": (5.0, 20.0), "other": (3.0, 3.0)})
+
+
+class PresenceTrackerTests(SimpleTestCase):
+    """The presence Lua scripts, run by fakeredis over two shards."""
+
+    def setUp(self):
+        self.shards = [fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer()) for _ in range(2)]
+        for name, value in (("shards", self.shards), ("ring", HashRing(["a", "b"]))):
+            patcher = mock.patch.object(presence, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.tracker = presence.PresenceTracker(self.shards, ttl=60, heartbeat_interval=3600)
+
+    def shard(self, username):
+        return self.shards[presence.shard_index(username)]
+
+    async def test_user_is_online_until_the_last_connection_is_released(self):
+        self.assertTrue(await self.tracker.connect("alice", "c1"))
+        self.assertFalse(await self.tracker.connect("alice", "c2"))
+        self.assertEqual(await presence.online_among(["alice", "bob"]), ["alice"])
+        self.assertFalse(await self.tracker.disconnect("alice", "c1"))
+        self.assertFalse(await self.tracker.disconnect("alice", "c1")) # Already released
+        self.assertTrue(await self.tracker.disconnect("alice", "c2"))
+        self.assertEqual(await presence.online_among(["alice"]), [])
+        self.assertIsNone(await self.shard("alice").hget(presence.REFCOUNT_KEY, "alice"))
+
+    async def test_heartbeat_keeps_refcount_and_reports_users_back_online(self):
+        await self.tracker.connect("alice", "c1")
+        self.assertEqual(await self.tracker.heartbeat(), []) # Refreshing doesn't count twice
+        self.assertEqual(await self.shard("alice").hget(presence.REFCOUNT_KEY, "alice"), b"1")
+        await self.shard("alice").delete(presence.CONNECTIONS_KEY, presence.REFCOUNT_KEY, presence.ONLINE_USERS_KEY)
+        self.assertEqual(await self.tracker.heartbeat(), ["alice"])
+
+    async def test_sweep_expires_connections_of_a_dead_worker(self):
+        await self.tracker.connect("alice", "live")
+        await self.tracker.connect("alice", "dead")
+        for i in range(5):
+            await self.tracker.connect(f"user{i}", "dead")
+        # Entries nobody refreshes any more
+        for member in ["alice|dead"] + [f"user{i}|dead" for i in range(5)]:
+            await self.shard(member.split("|")[0]).zadd(presence.CONNECTIONS_KEY, {member: 0})
+        self.tracker.sweep_batch = 2 # Several batches per shard
+        self.assertEqual(sorted(await self.tracker.sweep()), [f"user{i}" for i in range(5)])
+        self.assertEqual(await presence.online_among(["alice", "user0"]), ["alice"])
+        self.assertEqual(await self.tracker.sweep(), [])
+
+    async def test_reconcile_clears_only_legacy_members(self):
+        await self.tracker.connect("alice", "c1")
+        await self.shard("alice").sadd(presence.ONLINE_USERS_KEY, "old")
+        self.assertEqual(await self.tracker.reconcile(), ["old"])
+        self.assertEqual(await presence.online_count(), 1)
+
+
+class CallRegistryTests(SimpleTestCase):
+    """The 1:1 call state machine (ringing -> active -> ended) in chat/calls.py."""
+
+    def setUp(self):
+        self.registry = calls.CallRegistry(fakeredis.FakeAsyncRedis(), ring_seconds=45, reconnect_grace=30)
+
+    async def test_ringing_call_is_answered_then_ended(self):
+        status, call_id = await self.registry.start("alice", "bob", "alice_bob")
+        self.assertEqual(status, "ringing")
+        self.assertEqual(await self.registry.start("alice", "bob", "alice_bob"), ("existing", call_id))
+        self.assertIsNone(await self.registry.answer("alice")) # Only the callee answers a ringing call
+        answered = await self.registry.answer("bob")
+        self.assertEqual((answered.id, answered.reason), (call_id, "answered"))
+        self.assertEqual((await self.registry.answer("alice")).reason, "active") # Renegotiation
+        self.assertEqual(sorted(await self.registry.busy_among(["alice", "bob", "carol"])), ["alice", "bob"])
+        ended = await self.registry.end("bob")
+        self.assertEqual((ended.caller, ended.callee, ended.reason), ("alice", "bob", "ended"))
+        self.assertEqual(await self.registry.busy_among(["alice", "bob"]), [])
+        self.assertIsNone(await self.registry.end("alice"))
+
+    async def test_busy_participants_cannot_be_rung(self):
+        await self.registry.start("alice", "bob", "alice_bob")
+        self.assertEqual((await self.registry.start("carol", "bob", "bob_carol"))[0], "busy")
+        self.assertEqual((await self.registry.start("alice", "carol", "alice_carol"))[0], "in_call")
+
+    async def test_hanging_up_while_ringing(self):
+        await self.registry.start("alice", "bob", "alice_bob")
+        self.assertEqual((await self.registry.end("alice")).reason, "cancelled")
+        await self.registry.start("alice", "bob", "alice_bob")
+        self.assertEqual((await self.registry.end("bob")).reason, "rejected")
+
+    async def test_unanswered_call_is_swept_as_missed(self):
+        self.registry.ring_seconds = 0
+        await self.registry.start("alice", "bob", "alice_bob")
+        self.assertEqual([call.reason for call in await self.registry.sweep()], ["missed"])
+        self.assertEqual(await self.registry.busy_among(["alice", "bob"]), [])
+
+    async def test_detached_participant_can_rejoin_within_the_grace_period(self):
+        self.registry.reconnect_grace = 0
+        _, call_id = await self.registry.start("alice", "bob", "alice_bob")
+        await self.registry.answer("bob")
+        self.assertIsNone(await self.registry.detach("bob"))
+        self.assertEqual(await self.registry.start("bob", "alice", "alice_bob"), ("existing", call_id)) # Reconnected
+        self.assertEqual(await self.registry.sweep(), [])
+        await self.registry.detach("bob")
+        self.assertEqual([call.reason for call in await self.registry.sweep()], ["disconnected"])
+
+    async def test_caller_leaving_cancels_a_ringing_call(self):
+        await self.registry.start("alice", "bob", "alice_bob")
+        self.assertIsNone(await self.registry.detach("bob")) # The callee's other sockets may still answer
+        self.assertEqual((await self.registry.detach("alice")).reason, "cancelled")
+
+    async def test_declines_are_logged_as_the_callee_and_missed_calls_as_the_caller(self):
+        with mock.patch.object(calls, "log_call_event", mock.AsyncMock()) as log_event:
+            await calls.log_call_end(calls.Call("1", "alice", "bob", "alice_bob", "rejected"))
+            await calls.log_call_end(calls.Call("2", "alice", "bob", "alice_bob", "missed"))
+        self.assertEqual(log_event.await_args_list, [
+            mock.call("reject", "bob", "alice", "alice_bob"),
+            mock.call("missed_call", "alice", "bob", "alice_bob"),
+        ])
+
+
+class AttachmentTests(TestCase):
+    """Resumable uploads, content-hash dedup and range-served downloads (chat/attachments.py)."""
+
+    data = bytes(range(256)) * 400
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.db = mongomock.MongoClient().db
+        settings_override = override_settings(ATTACHMENT_ROOT=root.name, ATTACHMENT_CHUNK_MAX_BYTES=64 * 1024)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch("chat.views.get_db", return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.root = root.name
+        for username in ("alice", "bob"):
+            get_user_model().objects.create_user(username)
+        self.client.force_login(get_user_model().objects.get(username="alice"))
+
+    def upload(self, data, content_type="text/html", chunk=50000):
+        start = self.client.post(reverse("attachment_upload_start"), {
+            "filename": "../report.html", "size": len(data), "content_type": content_type,
+        }, content_type="application/json")
+        self.assertEqual(start.status_code, 201)
+        url = reverse("attachment_upload", args=[start.json()["upload_id"]])
+        for offset in range(0, len(data), chunk):
+            response = self.client.put(url, data[offset:offset + chunk], content_type="application/octet-stream",
+                                       headers={"Upload-Offset": str(offset)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()["attachment"]
+
+    def download(self, attachment_id, **headers):
+        return self.client.get(reverse("attachment_download", args=[attachment_id]), headers=headers)
+
+    def test_upload_resumes_from_the_recorded_offset(self):
+        start = self.client.post(reverse("attachment_upload_start"), {"filename": "a.bin", "size": len(self.data)},
+                                 content_type="application/json")
+        url = reverse("attachment_upload", args=[start.json()["upload_id"]])
+        put = lambda offset, body: self.client.put(url, body, content_type="application/octet-stream",
+                                                   headers={"Upload-Offset": str(offset)})
+        self.assertEqual(put(0, self.data[:40000]).json()["offset"], 40000)
+        retried = put(0, self.data[:40000]) # A retried chunk that already landed
+        self.assertEqual((retried.status_code, retried.json()["offset"]), (409, 40000))
+        self.assertEqual(self.client.get(url).json()["offset"], 40000)
+        done = put(40000, self.data[40000:])
+        self.assertEqual(done.status_code, 201)
+        self.assertEqual(done.json()["attachment"]["id"], hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(os.listdir(os.path.join(self.root, "incoming")), [])
+
+    def test_identical_uploads_are_stored_once(self):
+        first = self.upload(self.data)
+        self.client.force_login(get_user_model().objects.get(username="bob"))
+        second = self.upload(self.data, chunk=60000)
+        self.assertEqual(first["id"], second["id"])
+        self.assertEqual(self.db.attachments.find_one()["uploaders"], ["alice", "bob"])
+        self.assertEqual(self.db.attachments.count_documents({}), 1)
+        self.assertEqual(os.listdir(os.path.join(self.root, first["id"][:2])), [first["id"]])
+
+    def test_ranges_and_validators(self):
+        attachment_id = self.upload(self.data)["id"]
+        full = self.download(attachment_id)
+        self.assertEqual(b"".join(full.streaming_content), self.data)
+        self.assertEqual(full["Content-Type"], "application/octet-stream") # Declared HTML is never served inline
+        self.assertTrue(full["Content-Disposition"].startswith("attachment"))
+
+        partial = self.download(attachment_id, Range="bytes=100-199")
+        self.assertEqual((partial.status_code, partial["Content-Range"]), (206, f"bytes 100-199/{len(self.data)}"))
+        self.assertEqual(b"".join(partial.streaming_content), self.data[100:200])
+        suffix = self.download(attachment_id, Range="bytes=-10")
+        self.assertEqual(b"".join(suffix.streaming_content), self.data[-10:])
+
+        unsatisfiable = self.download(attachment_id, Range=f"bytes={len(self.data)}-")
+        self.assertEqual((unsatisfiable.status_code, unsatisfiable["Content-Range"]), (416, f"bytes */{len(self.data)}"))
+        self.assertEqual(self.download(attachment_id, **{"If-None-Match": full["ETag"]}).status_code, 304)
+        self.assertEqual(self.download(attachment_id, Range="bytes=0-1", **{"If-Range": '"stale"'}).status_code, 200)
+
+    def test_only_uploaders_and_room_members_can_download(self):
+        attachment_id = self.upload(self.data)["id"]
+        self.client.force_login(get_user_model().objects.get(username="bob"))
+        self.assertEqual(self.download(attachment_id).status_code, 404)
+        self.db.attachments.update_one({"_id": attachment_id}, {"$addToSet": {"rooms": "alice_bob"}})
+        self.assertEqual(self.download(attachment_id).status_code, 200)
+
+    def test_parse_range(self):
+        self.assertEqual(attachments.parse_range("bytes=5-", 10), (5, 9))
+        self.assertEqual(attachments.parse_range("bytes=2-100", 10), (2, 9))
+        self.assertEqual(attachments.parse_range("bytes=-20", 10), (0, 9))
+        self.assertIsNone(attachments.parse_range("bytes=0-1,4-5", 10)) # Multi-range: whole file
+        self.assertIsNone(attachments.parse_range("bytes=5-2", 10))
+        with self.assertRaises(ValueError):
+            attachments.parse_range("bytes=10-", 10)
+
+
+def _bulk_write(collection, ops, ordered=True):
+    # mongomock's bulk_write doesn't accept current pymongo operations; apply them one by one
+    for op in ops:
+        if isinstance(op, InsertOne):
+            collection.insert_one(op._doc)
+        elif isinstance(op, UpdateOne):
+            collection.update_one(op._filter, op._doc, upsert=op._upsert)
+        elif isinstance(op, ReplaceOne):
+            collection.replace_one(op._filter, op._doc, upsert=op._upsert)
+
+
+class BucketTests(SimpleTestCase):
+    """Compaction of old messages into buckets, and history pages that span both tiers."""
+
+    def setUp(self):
+        patcher = mock.patch.object(mongomock.collection.Collection, "bulk_write", _bulk_write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = mongomock.MongoClient().db
+        self.now = datetime.now(timezone.utc)
+        # 300 messages 15 minutes apart, ending 27 days ago, plus one in another room
+        for i in range(300):
+            sent = self.now - timedelta(days=30) + timedelta(minutes=15 * i)
+            self.db.chats.insert_one({
+                "_id": message_ids.new_message_id(now=sent.timestamp()), "room": "alice_bob",
+                "sender": "alice", "recipient": "bob", "message": f"m{i}", "timestamp": sent,
+            })
+        self.db.chats.insert_one({"_id": message_ids.new_message_id(), "room": "alice_carol", "message": "new"})
+        self.cutoff = ObjectId.from_datetime(self.now - timedelta(days=28))
+
+    def walk(self, limit=37):
+        ids, before = [], None
+        while True:
+            page = buckets.history_page(self.db, "alice_bob", before, limit, {"room": 0})
+            ids.extend(doc["_id"] for doc in page[:limit])
+            if len(page) <= limit:
+                return ids
+            before = page[limit - 1]["_id"]
+
+    def compact(self):
+        moved = 0
+        while n := buckets.compact_batch(self.db, self.cutoff, batch_size=60, max_messages=50, span_hours=24):
+            moved += n
+        return moved
+
+    def test_history_reads_the_same_across_compaction(self):
+        before = self.walk()
+        self.assertEqual(len(before), 300)
+        moved = self.compact()
+        self.assertGreater(moved, 0)
+        self.assertLess(moved, 300) # The newest ~day stays hot, so pages cross the tier boundary
+        self.assertEqual(self.db.chats.count_documents({"room": "alice_bob"}), 300 - moved)
+        self.assertEqual(self.walk(), before)
+        bucketed = list(self.db.chat_buckets.find())
+        self.assertTrue(all(bucket["count"] == len(bucket["messages"]) <= 50 for bucket in bucketed))
+        self.assertEqual(sum(bucket["count"] for bucket in bucketed), moved)
+        self.assertEqual(self.db.chats.count_documents({"room": "alice_carol"}), 1) # Too new to compact
+
+    def test_rerun_after_an_interrupted_compaction_does_not_duplicate(self):
+        self.compact()
+        before = self.walk()
+        # A crash between the bucket write and the delete leaves the newest bucketed messages in db.chats
+        newest = self.db.chat_buckets.find_one(sort=[("start_id", -1)])
+        self.db.chats.insert_many([dict(message, room="alice_bob") for message in newest["messages"][-5:]])
+        self.assertEqual(self.walk(), before) # Hidden by the dedup in history_page
+        total = sum(b["count"] for b in self.db.chat_buckets.find())
+        self.assertEqual(self.compact(), 5) # Already bucketed: only deleted
+        self.assertEqual(sum(b["count"] for b in self.db.chat_buckets.find()), total)
+        self.assertEqual(self.walk(), before)
+
+    def test_archived_messages_leave_the_served_tiers(self):
+        self.compact()
+        archived = buckets.archive_batch(self.db, "chat_buckets", {"end_id": {"$lt": self.cutoff}}, 1000)
+        self.assertEqual(self.db.chat_archive.count_documents({"tier": "chat_buckets"}), archived)
+        self.assertEqual(len(self.walk()), self.db.chats.count_documents({"room": "alice_bob"}))
+
+    @override_settings(CHAT_BUCKET_AFTER_DAYS=28)
+    def test_catch_up_defers_to_history_once_messages_may_be_bucketed(self):
+        self.assertTrue(buckets.is_bucketed(ObjectId.from_datetime(self.now - timedelta(days=29))))
+        self.assertFalse(buckets.is_bucketed(message_ids.new_message_id()))
@@ -0,0 +1,32 @@
+import time
+
+
+class TTLCache:
+    """Small in-process cache with per-entry expiry."""
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = {}
+
+    def get(self, key):
+        """Returns the (expires, value) entry, so a cached None can be told apart from a miss."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return entry
+
+    def set(self, key, value, ttl=None):
+        if len(self._data) >= self.max_entries:
+            self._data.clear()
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+# Process-wide counters for typing frames, summed over all connections
+stats = {
+    "received": 0,
+    "forwarded": 0,
+    "suppressed": 0,
+    "auto_stopped": 0,
+}
+
+
+class TypingThrottle:
+    """Per-connection typing state, one entry per recipient.
+
+    Only real state changes are forwarded; repeated "typing" frames are dropped unless
+    refresh_interval has passed, and an automatic stop is sent if the client goes quiet
+    for `timeout` seconds or disconnects while typing.
+    """
+
+    def __init__(self, send_stop, refresh_interval=None, timeout=None):
+        self._send_stop = send_stop # coroutine function taking the recipient username
+        self.refresh_interval = refresh_interval or getattr(settings, "TYPING_REFRESH_INTERVAL", 3.0)
+        self.timeout = timeout or getattr(settings, "TYPING_TIMEOUT", 6.0)
+        self._typing = {} # recipient -> time the last "typing" frame was forwarded
+        self._timers = {}
+        self._tasks = set() # Pending _expire tasks, kept referenced until done and cancelled on stop_all
+
+    def should_forward(self, recipient, is_typing):
+        """Updates state for a client frame and returns whether it should be sent on."""
+        stats["received"] += 1
+        now = time.monotonic()
+        last_forwarded = self._typing.get(recipient)
+        if is_typing:
+            self._arm_timer(recipient)
+            if last_forwarded is not None and now - last_forwarded < self.refresh_interval:
+                stats["suppressed"] += 1
+                return False
+            self._typing[recipient] = now
+        else:
+            self._cancel_timer(recipient)
+            if self._typing.pop(recipient, None) is None:
+                stats["suppressed"] += 1
+                return False
+        stats["forwarded"] += 1
+        return True
+
+    def _arm_timer(self, recipient):
+        self._cancel_timer(recipient)
+        loop = asyncio.get_running_loop()
+        self._timers[recipient] = loop.call_later(self.timeout, self._start_expiry, recipient)
+
+    def _start_expiry(self, recipient):
+        task = asyncio.get_running_loop().create_task(self._expire(recipient))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _cancel_timer(self, recipient):
+        timer = self._timers.pop(recipient, None)
+        if timer is not None:
+            timer.cancel()
+
+    async def _expire(self, recipient):
+        self._timers.pop(recipient, None)
+        if recipient in self._typing:
+            # Cleared only once sent, so a stop cut short by stop_all is sent again there
+            await self._send_stop(recipient)
+            self._typing.pop(recipient, None)
+            stats["auto_stopped"] += 1
+
+    async def stop_all(self):
+        """Cancels pending timers and sends "stopped typing" for every recipient still marked as typing."""
+        for task in list(self._tasks):
+            task.cancel()
+        for recipient in list(self._timers):
+            self._cancel_timer(recipient)
+        for recipient in list(self._typing):
+            self._cancel_timer(recipient)
+            self._typing.pop(recipient, None)
+            stats["auto_stopped"] += 1
+            await self._send_stop(recipient)
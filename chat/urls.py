@@ -4,7 +4,17 @@ from . import views
 urlpatterns = [
     path('', views.home, name='home'),
     path('notifications/', views.notifications, name='notifications'),
+    path('contacts/', views.contacts, name='contacts'),
     path('room/<str:username>/', views.room_with_user, name='room_with_user'),
+    path('room/<str:username>/history/', views.room_history, name='room_history'),
     path('call/<str:username>/', views.room_with_user, name='call_user'),  # legacy alias
     path('subscribe_push/', views.subscribe_push, name='subscribe_push'),
+    path('groups/', views.group_list, name='group_list'),
+    path('groups/<str:group_id>/history/', views.group_history, name='group_history'),
+    path('groups/<str:group_id>/members/', views.group_members, name='group_members'),
+    path('attachments/uploads/', views.attachment_upload_start, name='attachment_upload_start'),
+    path('attachments/uploads/<str:upload_id>/', views.attachment_upload, name='attachment_upload'),
+    path('attachments/<str:attachment_id>/', views.attachment_download, name='attachment_download'),
+    path('attachments/<str:attachment_id>/thumbnail/', views.attachment_thumbnail, name='attachment_thumbnail'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
@@ -1,23 +1,48 @@
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model
 from django.shortcuts import render, get_object_or_404
-from django.http import Http404, JsonResponse
-from django.views.decorators.http import require_POST
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, JsonResponse, StreamingHttpResponse,
+)
+from django.utils.http import content_disposition_header
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings # Import settings
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from chat.mongo import get_db
+from chat.receipts import get_watermark, get_watermarks, is_read
+from chat import attachments, buckets, directory, groups, metrics, push
+from chat.log import get_logger
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+import hmac
 import json
+import os
 
 User = get_user_model()
+logger = get_logger("views")
 
 def _pair_room_name(a, b):
     a, b = sorted([a, b])
     return f"{a}_{b}"
 
+def _room_peer(room_name, username):
+    """Returns the other participant of a 1-1 room, or None if username is not in it."""
+    candidates = []
+    if room_name.startswith(f"{username}_"):
+        candidates.append(room_name[len(username) + 1:])
+    if room_name.endswith(f"_{username}"):
+        candidates.append(room_name[:-len(username) - 1])
+    for peer in candidates:
+        if peer and _pair_room_name(username, peer) == room_name:
+            return peer
+    return None
+
 @login_required
 def home(request):
-    users = User.objects.exclude(id=request.user.id).order_by("username")
-    return render(request, "chat/home.html", {"users": users})
+    directory_page = directory.search(request.user.username)
+    return render(request, "chat/home.html", {"users": directory_page["contacts"], "contacts_next": directory_page["next_after"]})
 
 @login_required
 def room_with_user(request, username):
@@ -25,54 +50,226 @@ def room_with_user(request, username):
     if peer.id == request.user.id:
         raise Http404("Cannot call yourself.")
 
-    print(f"[DEBUG chat/views.py] Current user: {request.user.username}, Peer: {peer.username}")
     room_name = _pair_room_name(request.user.username, peer.username)
-    print(f"[DEBUG chat/views.py] Generated room_name: {room_name}")
+    logger.debug("room page user=%s peer=%s room=%s", request.user.username, peer.username, room_name)
 
-    # preload last 50 chat messages from Mongo (if available)
-    history = []
-    db = get_db()
-    if db is not None:
-        try:
-            print(f"[DEBUG chat/views.py] Querying MongoDB for room: {room_name}")
-            cur = db.chats.find({"room": room_name}).sort("timestamp", -1).limit(50)
-            for msg in reversed(list(cur)):
-                msg['id'] = str(msg['_id']) # Convert ObjectId to string and map to 'id' for template
-                # Convert timestamp string back to datetime object for Django template filter
-                if 'timestamp' in msg and isinstance(msg['timestamp'], str):
-                    from datetime import datetime
-                    msg['timestamp'] = datetime.fromisoformat(msg['timestamp'])
-                history.append(msg)
-            print(f"[DEBUG chat/views.py] Fetched {len(history)} messages from MongoDB for room {room_name}.")
-            # print(f"[DEBUG chat/views.py] History: {history}") # Uncomment for full history dump if needed
-        except Exception as e:
-            print(f"[MongoDB] fetch history failed: {e}")
-            print(f"[MongoDB] Error details: {e}")
+    # History is loaded by the client from room_history so the page renders without touching Mongo
 
-    users = User.objects.exclude(id=request.user.id).order_by("username")
+    directory_page = directory.search(request.user.username)
     return render(
         request,
         "chat/room.html",
         {
             "peer": peer,
             "room_name": room_name,
-            "history": history,
-            "users": users,
+            "users": directory_page["contacts"],
+            "contacts_next": directory_page["next_after"],
             "webrtc_ice_servers": settings.WEBRTC_ICE_SERVERS, # Pass ICE servers to template
         },
     )
 
+# Fields returned by the history API; everything else in the chat document stays in Mongo
+HISTORY_PROJECTION = {"_id": 1, "sender": 1, "recipient": 1, "message": 1, "timestamp": 1, "read": 1, "attachment": 1}
+
+def _history_page_size(raw):
+    default = getattr(settings, "CHAT_HISTORY_PAGE_SIZE", 50)
+    maximum = getattr(settings, "CHAT_HISTORY_MAX_PAGE_SIZE", 200)
+    try:
+        size = int(raw) if raw else default
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, maximum))
+
+def _serialize_message(doc, room_name, peer_watermark):
+    timestamp = doc.get("timestamp")
+    message = {
+        "id": str(doc["_id"]),
+        "room": room_name,
+        "sender": doc.get("sender"),
+        "recipient": doc.get("recipient"),
+        "message": doc.get("message", ""),
+        "timestamp": timestamp if isinstance(timestamp, str) or timestamp is None else timestamp.isoformat(),
+        "read": is_read(doc, peer_watermark),
+    }
+    if doc.get("attachment"):
+        message["attachment"] = doc["attachment"]
+    return message
+
+def _history_page(request, room_name, watermark_reader=None):
+    """Returns one page of room history, newest first in the query, oldest first in the response.
+
+    Pagination is keyset-based on (room, _id): pass the `before` id returned by the
+    previous page to walk further back without offset scans, into bucketed history too.
+    """
+    limit = _history_page_size(request.GET.get("limit"))
+
+    before = None
+    if request.GET.get("before"):
+        try:
+            before = ObjectId(request.GET["before"])
+        except (InvalidId, TypeError):
+            return JsonResponse({"error": "Invalid cursor."}, status=400)
+
+    db = get_db()
+    if db is None:
+        return JsonResponse({"error": "MongoDB not connected."}, status=503)
+    try:
+        # One extra document tells whether an older page exists; older pages may come from buckets
+        docs = buckets.history_page(db, room_name, before, limit, HISTORY_PROJECTION)
+        # Read state is derived from the peer's watermark rather than stored per message
+        peer_watermark = get_watermark(db, room_name, watermark_reader) if watermark_reader else None
+    except Exception as e:
+        logger.warning("fetch history failed for room %s: %s", room_name, e)
+        return JsonResponse({"error": "Failed to load history."}, status=500)
+
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    return JsonResponse({
+        "messages": [_serialize_message(doc, room_name, peer_watermark) for doc in reversed(docs)],
+        "next_before": str(docs[-1]["_id"]) if has_more else None,
+        "has_more": has_more,
+    })
+
+@login_required
+def room_history(request, username):
+    peer = get_object_or_404(User, username=username)
+    if peer.id == request.user.id:
+        raise Http404("No history with yourself.")
+    room_name = _pair_room_name(request.user.username, peer.username)
+    return _history_page(request, room_name, watermark_reader=peer.username)
+
+def _group_for_member(db, group_id, username):
+    group_id = groups.parse_group_id(group_id)
+    if group_id is None or not groups.is_member_sync(db, group_id, username):
+        raise Http404("No such group.")
+    return group_id
+
+@login_required
+def group_history(request, group_id):
+    db = get_db()
+    if db is None:
+        return JsonResponse({"error": "MongoDB not connected."}, status=503)
+    group_id = _group_for_member(db, group_id, request.user.username)
+    return _history_page(request, groups.group_room(group_id))
+
+@login_required
+def group_list(request):
+    """GET: the user's groups with per-member unread counts. POST: create a group."""
+    db = get_db()
+    if db is None:
+        return JsonResponse({"error": "MongoDB not connected."}, status=503)
+    username = request.user.username
+
+    if request.method == "POST":
+        try:
+            data = json.loads(request.body)
+            name = str(data.get("name", "")).strip()[:100]
+            members = _username_list(data.get("members", []))
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        if not name:
+            return JsonResponse({"error": "A group name is required."}, status=400)
+        if members is None:
+            return JsonResponse({"error": '"members" must be a list of usernames.'}, status=400)
+        if len(set(members) | {username}) > groups.max_members():
+            return JsonResponse({"error": f"Groups are limited to {groups.max_members()} members."}, status=400)
+        members = list(User.objects.filter(username__in=members).values_list("username", flat=True))
+        group_id, members = groups.create_group(db, name, username, members)
+        _notify_membership(group_id, joined=members)
+        return JsonResponse({"id": group_id, "name": name, "members": members}, status=201)
+
+    docs = list(db.groups.find({"members": username}, {"name": 1}).limit(getattr(settings, "GROUP_MAX_PER_USER", 500)))
+    # A fixed number of queries however many groups: watermarks in one $in, unread counts batched
+    watermarks = get_watermarks(db, [groups.group_room(doc["_id"]) for doc in docs], username)
+    unread = groups.unread_counts(db, username, watermarks, getattr(settings, "GROUP_UNREAD_COUNT_CAP", 99))
+    result = []
+    for doc in docs:
+        room_name = groups.group_room(doc["_id"])
+        result.append({
+            "id": str(doc["_id"]),
+            "name": doc.get("name", ""),
+            "room": room_name,
+            "unread": unread.get(room_name, 0),
+        })
+    return JsonResponse({"groups": result})
+
+@require_POST
+@login_required
+def group_members(request, group_id):
+    """Adds and/or removes members: {"add": [...], "remove": [...]}.
+
+    The creator and admins manage membership; other members may only remove themselves.
+    """
+    db = get_db()
+    if db is None:
+        return JsonResponse({"error": "MongoDB not connected."}, status=503)
+    username = request.user.username
+    group_id = _group_for_member(db, group_id, username)
+    try:
+        data = json.loads(request.body)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    add = _username_list(data.get("add", []))
+    remove = _username_list(data.get("remove", []))
+    if add is None or remove is None:
+        return JsonResponse({"error": '"add" and "remove" must be lists of usernames.'}, status=400)
+
+    group = groups.get_group_sync(db, group_id)
+    if group is None:
+        raise Http404("No such group.")
+    if not groups.is_admin(group, username) and (add or set(remove) - {username}):
+        return JsonResponse({"error": "Only the group's creator or an admin can change its members."}, status=403)
+    if group.get("created_by") in remove and username != group.get("created_by"):
+        return JsonResponse({"error": "The group's creator cannot be removed."}, status=403)
+
+    current = set(group.get("members", ()))
+    add = list(User.objects.filter(username__in=set(add) - current).values_list("username", flat=True))
+    remove = [m for m in set(remove) if m in current]
+    members = groups.update_members(db, group_id, add=add, remove=remove)
+    if members is None:
+        return JsonResponse({"error": f"Groups are limited to {groups.max_members()} members."}, status=400)
+    _notify_membership(group_id, joined=add, left=remove)
+    return JsonResponse({"id": group_id, "members": members})
+
+def _username_list(value):
+    """value if it is a list of at most GROUP_MAX_MEMBERS strings, else None."""
+    if not isinstance(value, list) or len(value) > groups.max_members():
+        return None
+    return value if all(isinstance(v, str) for v in value) else None
+
+def _notify_membership(group_id, joined=(), left=()):
+    # Live sockets subscribe themselves to the group's channel group when told about it
+    channel_layer = get_channel_layer()
+    for username, is_member in [(u, True) for u in joined] + [(u, False) for u in left]:
+        async_to_sync(channel_layer.group_send)(
+            f"user_{username}",
+            {"type": "group_membership", "group_id": group_id, "is_member": is_member},
+        )
+
+@login_required
+def contacts(request):
+    """Lazy-loaded, prefix-searchable contact list for the sidebar."""
+    return JsonResponse(directory.search(
+        request.user.username,
+        prefix=request.GET.get("q", "").strip(),
+        after=request.GET.get("after", ""),
+        limit=request.GET.get("limit"),
+    ))
+
 @login_required
 def notifications(request):
     logs = []
     db = get_db()
     if db is not None:
         try:
-            # Fetch notifications where the current user is the recipient
-            cursor = db.notifications.find({"recipient": request.user.username}).sort("timestamp", -1).limit(50)
+            # Call lifecycle events addressed to the current user, newest first
+            cursor = db.call_logs.find(
+                {"recipient": request.user.username},
+                {"_id": 0, "type": 1, "sender": 1, "timestamp": 1, "is_group_call": 1},
+            ).sort("timestamp", -1).limit(50)
             logs = list(cursor)
         except Exception as e:
-            print(f"[MongoDB] fetch notifications failed: {e}")
+            logger.warning("fetch notifications failed: %s", e)
     return render(request, "chat/notifications.html", {"logs": logs})
 
 @require_POST
@@ -86,15 +283,170 @@ def subscribe_push(request):
             user_id = request.user.id
 
             db = get_db()
-            if db:
+            if db is not None:
                 db.subscriptions.update_one(
                     {"user_id": user_id},
                     {"$set": {"subscription": subscription}},
                     upsert=True
                 )
+                push.dispatcher.invalidate_subscription(user_id) # Drop the cached lookup for this user
                 return JsonResponse({"message": "Subscription saved successfully."})
             else:
                 return JsonResponse({"error": "MongoDB not connected."}, status=500)
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=400)
     return JsonResponse({"error": "Invalid request method."}, status=405)
+
+@require_POST
+@login_required
+def attachment_upload_start(request):
+    """Starts a resumable upload: {"filename", "size", "content_type"} -> upload id and offset 0."""
+    try:
+        data = json.loads(request.body)
+        size = int(data["size"])
+        filename = os.path.basename(str(data.get("filename", "")))[:255] or "file"
+        content_type = str(data.get("content_type", ""))[:100].lower()
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    max_bytes = getattr(settings, "ATTACHMENT_MAX_BYTES", 100 * 1024 * 1024)
+    if not 0 < size <= max_bytes:
+        return JsonResponse({"error": f"Attachments must be between 1 and {max_bytes} bytes."}, status=413)
+    db = get_db()
+    if db is None:
+        return JsonResponse({"error": "MongoDB not connected."}, status=503)
+    upload = attachments.create_upload(db, request.user.username, filename, size, content_type)
+    return JsonResponse({
+        "upload_id": str(upload["_id"]),
+        "offset": 0,
+        "size": size,
+        "chunk_size": getattr(settings, "ATTACHMENT_CHUNK_MAX_BYTES", 8 * 1024 * 1024),
+    }, status=201)
+
+@require_http_methods(["GET", "PUT"])
+@login_required
+def attachment_upload(request, upload_id):
+    """GET: the offset to resume from. PUT: appends the body at the Upload-Offset header.
+
+    The body is copied to disk in small blocks (Django has already spooled it to a temporary
+    file past FILE_UPLOAD_MAX_MEMORY_SIZE), so no chunk is held in memory whole. The chunk
+    that completes the upload returns the attachment reference to put in a chat frame.
+    """
+    db = get_db()
+    if db is None:
+        return JsonResponse({"error": "MongoDB not connected."}, status=503)
+    try:
+        upload = db.uploads.find_one({"_id": ObjectId(upload_id), "owner": request.user.username})
+    except (InvalidId, TypeError):
+        upload = None
+    if upload is None:
+        raise Http404("No such upload.")
+    if request.method == "GET":
+        return JsonResponse({"upload_id": upload_id, "offset": upload["received"], "size": upload["size"]})
+
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        return JsonResponse({"error": "Upload-Offset and Content-Length are required."}, status=400)
+    if offset != upload["received"]:
+        # The client lost track (e.g. a retried chunk); it resumes from the offset returned here
+        return JsonResponse({"error": "Offset mismatch.", "offset": upload["received"]}, status=409)
+    if length <= 0 or length > getattr(settings, "ATTACHMENT_CHUNK_MAX_BYTES", 8 * 1024 * 1024):
+        return JsonResponse({"error": "Invalid chunk size."}, status=400)
+    if offset + length > upload["size"]:
+        return JsonResponse({"error": "Chunk runs past the declared size."}, status=400)
+
+    received = attachments.append_chunk(db, upload, request, length)
+    if received is None:
+        return JsonResponse({"error": "Incomplete chunk.", "offset": upload["received"]}, status=400)
+    if received < upload["size"]:
+        return JsonResponse({"upload_id": upload_id, "offset": received, "size": upload["size"]})
+    attachment = attachments.finish_upload(db, upload)
+    return JsonResponse({"attachment": attachments.attachment_ref(attachment)}, status=201)
+
+def _can_read_attachment(db, attachment, username):
+    # Uploaders, and members of any room the attachment was sent to
+    if username in attachment.get("uploaders", ()):
+        return True
+    for room_name in attachment.get("rooms", ()):
+        group_id = groups.parse_group_room(room_name)
+        if group_id is not None:
+            if groups.is_member_sync(db, group_id, username):
+                return True
+        elif _room_peer(room_name, username) is not None:
+            return True
+    return False
+
+def _serve_attachment(request, attachment_id, thumbnail):
+    if not attachments.is_attachment_id(attachment_id):
+        raise Http404("No such attachment.")
+    db = get_db()
+    if db is None:
+        return JsonResponse({"error": "MongoDB not connected."}, status=503)
+    attachment = db.attachments.find_one({"_id": attachment_id})
+    if attachment is None or not _can_read_attachment(db, attachment, request.user.username):
+        raise Http404("No such attachment.")
+    if thumbnail:
+        if not attachment.get("thumbnail"):
+            raise Http404("No thumbnail.")
+        path, etag = attachments.thumbnail_path(attachment_id), f'"{attachment_id}-thumb"'
+        content_type, inline = "image/jpeg", True
+    else:
+        path, etag = attachments.content_path(attachment_id), f'"{attachment_id}"'
+        content_type, inline = attachments.serve_as(attachment.get("content_type"))
+
+    # Files are content-addressed, so the hash is a strong validator and they never change
+    if etag in request.headers.get("If-None-Match", ""):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        raise Http404("No such attachment.")
+
+    byte_range = None
+    if request.headers.get("If-Range", etag) == etag:
+        try:
+            byte_range = attachments.parse_range(request.headers.get("Range"), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+    if byte_range is None:
+        response = FileResponse(open(path, "rb"), content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(attachments.file_range(path, start, end), status=206, content_type=content_type)
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Cache-Control"] = "private, max-age=31536000, immutable"
+    response["Content-Disposition"] = content_disposition_header(not inline, attachment.get("filename") or attachment_id)
+    return response
+
+@require_GET
+@login_required
+def attachment_download(request, attachment_id):
+    return _serve_attachment(request, attachment_id, thumbnail=False)
+
+@require_GET
+@login_required
+def attachment_thumbnail(request, attachment_id):
+    return _serve_attachment(request, attachment_id, thumbnail=True)
+
+async def metrics_view(request):
+    """Prometheus scrape endpoint for this worker (see chat/metrics.py)."""
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if token:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        allowed = hmac.compare_digest(supplied, token)
+    elif getattr(settings, "METRICS_ALLOW_LOOPBACK", False):
+        # Opt-in only: behind a reverse proxy on the same host every request comes from loopback
+        allowed = request.META.get("REMOTE_ADDR") in ("127.0.0.1", "::1")
+    else:
+        allowed = False
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(await metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
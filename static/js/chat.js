@@ -16,6 +16,16 @@
   const onlineUsers = new Set();
   let typingTimeout = null;
   const TYPING_INDICATOR_TIMEOUT = 3000; // 3 seconds
+  // While typing, "is_typing: true" is repeated at most this often (the server refreshes every 3s)
+  const TYPING_REFRESH_MS = 2500;
+  let typingWanted = false; // Latest state asked for
+  let typingSent = false; // Latest state sent to the server
+  let typingSentAt = 0;
+  // Chat frames waiting for the server's echo, by temp id, so a throttled one can be resent
+  const pendingMessages = new Map();
+  const MAX_SEND_ATTEMPTS = 3;
+  // Frame class -> time until which the server asked us not to send more (see "throttle")
+  const throttledUntil = {};
 
   // Expose sendWS globally for webrtc.js to use
   window.sendChatWS = function (payload) {
@@ -26,14 +36,7 @@
     }
   };
 
-  function appendMessage(
-    sender,
-    message,
-    timestamp,
-    messageId = null,
-    readStatus = false,
-    messageRoom = null // Added messageRoom parameter
-  ) {
+  function buildMessageElement(sender, message, timestamp, messageId, readStatus) {
     const msgDiv = document.createElement("div");
     msgDiv.classList.add("msg");
     msgDiv.classList.add(sender === me ? "msg--me" : "msg--peer");
@@ -78,23 +81,62 @@
     msgBubble.appendChild(msgText);
     msgBubble.appendChild(msgTime);
     msgDiv.appendChild(msgBubble);
-    chatBox.appendChild(msgDiv);
+    return msgDiv;
+  }
+
+  function appendMessage(
+    sender,
+    message,
+    timestamp,
+    messageId = null,
+    readStatus = false,
+    messageRoom = null // Added messageRoom parameter
+  ) {
+    hideEmptyState();
+    chatBox.appendChild(
+      buildMessageElement(sender, message, timestamp, messageId, readStatus)
+    );
 
     chatBox.scrollTop = chatBox.scrollHeight; // Auto-scroll to bottom
 
-    // If the message is from the peer, send a read receipt
+    // If the message is from the peer, advance our read watermark
     // Ensure read receipt is only sent if the message is for the current active room
     if (
       sender !== me &&
       messageId &&
       messageRoom === window.APP_CONTEXT.roomName // Use messageRoom parameter
     ) {
+      markRead(messageId);
+    }
+  }
+
+  // Read receipts are a per-room watermark: one "read up to X" frame covers
+  // every earlier message, and bursts are collapsed into a single frame.
+  const READ_RECEIPT_DEBOUNCE = 300;
+  let readWatermark = null;
+  let readWatermarkSent = null;
+  let readReceiptTimer = null;
+
+  // ObjectId hex strings have a fixed width, so string order matches id order
+  function isRealMessageId(messageId) {
+    return /^[0-9a-f]{24}$/.test(messageId || "");
+  }
+
+  function markRead(messageId) {
+    if (!isRealMessageId(messageId)) return;
+    if (readWatermark && messageId <= readWatermark) return;
+    readWatermark = messageId;
+    clearTimeout(readReceiptTimer);
+    readReceiptTimer = setTimeout(() => {
+      if (readWatermark === readWatermarkSent) return;
+      readWatermarkSent = readWatermark;
       window.sendChatWS({
-        type: "read_receipt",
-        message_id: messageId,
+        type: "read_up_to",
+        message_id: readWatermark,
         room: window.APP_CONTEXT.roomName,
+        peer: window.APP_CONTEXT.peerUsername,
       });
-    }
+    }, READ_RECEIPT_DEBOUNCE);
   }
 
   // Function to auto-scroll chat box to the bottom
@@ -102,19 +144,130 @@
     chatBox.scrollTop = chatBox.scrollHeight;
   }
 
+  function hideEmptyState() {
+    const empty = document.getElementById("chatEmpty");
+    if (empty) empty.style.display = "none";
+  }
+
+  // History paging: the server returns pages keyed by the oldest message id seen so far
+  let historyCursor = null;
+  let historyHasMore = true;
+  let historyLoading = false;
+
+  async function loadHistory() {
+    if (!window.APP_CONTEXT.historyUrl || historyLoading || !historyHasMore) {
+      return;
+    }
+    historyLoading = true;
+    try {
+      const url = new URL(window.APP_CONTEXT.historyUrl, location.origin);
+      if (historyCursor) url.searchParams.set("before", historyCursor);
+      const response = await fetch(url, { credentials: "same-origin" });
+      if (!response.ok) throw new Error(`HTTP ${response.status}`);
+      const page = await response.json();
+
+      const isFirstPage = historyCursor === null;
+      const previousHeight = chatBox.scrollHeight;
+      const fragment = document.createDocumentFragment();
+      page.messages.forEach((m) => {
+        if (!chatBox.querySelector(`[data-message-id="${m.id}"]`)) {
+          fragment.appendChild(
+            buildMessageElement(m.sender, m.message, m.timestamp, m.id, m.read)
+          );
+        }
+      });
+      chatBox.insertBefore(fragment, chatBox.firstChild);
+
+      if (isFirstPage) {
+        const newestFromPeer = page.messages
+          .filter((m) => m.sender !== me)
+          .pop();
+        if (newestFromPeer) markRead(newestFromPeer.id);
+      }
+
+      historyCursor = page.next_before;
+      historyHasMore = page.has_more;
+      if (isFirstPage) {
+        if (page.messages.length === 0 && !chatBox.querySelector(".msg")) {
+          document.getElementById("chatEmpty").style.display = "block";
+        }
+        scrollToBottom();
+      } else {
+        // Keep the viewport anchored on the message the user was reading
+        chatBox.scrollTop += chatBox.scrollHeight - previousHeight;
+      }
+    } catch (error) {
+      console.error("[chat.js] Failed to load history:", error);
+    } finally {
+      historyLoading = false;
+    }
+  }
+
+  if (chatBox) {
+    chatBox.addEventListener("scroll", () => {
+      if (chatBox.scrollTop < 80) loadHistory();
+    });
+    loadHistory();
+  }
+
   // This function will now be called by webrtc.js to set the shared WebSocket
   window.setSharedWebSocket = function (sharedWs) {
     ws = sharedWs;
     connected = true; // Assume connected when shared WS is set
     console.log("[chat.js] Shared WebSocket set and connected.");
 
-    // Request online users list on connect
+    // Subscribe to presence for the users shown on this page; the server
+    // replies with an online_users_list limited to that set
     window.sendChatWS({
-      type: "get_online_users",
+      type: "presence_subscribe",
+      users: getPresenceInterest(),
       room: window.APP_CONTEXT.roomName,
     });
+
+    // After a reconnect, ask only for what we missed instead of reloading the page
+    const lastSeen = getLastSeenMessageId();
+    if (lastSeen) {
+      window.sendChatWS({
+        type: "sync",
+        rooms: { [window.APP_CONTEXT.roomName]: lastSeen },
+      });
+    }
   };
 
+  function getLastSeenMessageId() {
+    // Highest id rather than the last rendered one: catch-up can append older ids.
+    // Ids are fixed-length hex, so string order is id order.
+    const rendered = chatBox ? chatBox.querySelectorAll(".msg[data-message-id]") : [];
+    let lastSeen = null;
+    rendered.forEach((el) => {
+      const messageId = el.dataset.messageId;
+      if (isRealMessageId(messageId) && (!lastSeen || messageId > lastSeen)) lastSeen = messageId;
+    });
+    return lastSeen;
+  }
+
+  // Re-subscribe when the sidebar lazy-loads or filters its contact list
+  window.addEventListener("contactsLoaded", () => {
+    window.sendChatWS({
+      type: "presence_subscribe",
+      users: getPresenceInterest(),
+      room: window.APP_CONTEXT.roomName,
+    });
+  });
+
+  function getPresenceInterest() {
+    const users = new Set();
+    if (window.APP_CONTEXT.peerUsername) {
+      users.add(window.APP_CONTEXT.peerUsername);
+    }
+    if (sidebarUsers) {
+      sidebarUsers.querySelectorAll("[data-username]").forEach((userDiv) => {
+        users.add(userDiv.dataset.username);
+      });
+    }
+    return Array.from(users);
+  }
+
   // Expose a handler for webrtc.js to pass chat-specific messages to chat.js
   window.handleChatMessage = (data) => {
     console.log("[chat.js] Chat message received:", data); // Debugging
@@ -149,6 +302,7 @@
         // If the message is from the current user, and it's a temporary message, remove it.
         // The server will send back the canonical message.
         if (from === me && data.temp_message_id) {
+          pendingMessages.delete(data.temp_message_id);
           const tempMsgDiv = chatBox.querySelector(
             `[data-message-id="${data.temp_message_id}"]`
           );
@@ -181,6 +335,24 @@
         handleUserStatus(data.username, data.is_online);
         break;
 
+      case "sync_batch":
+        data.messages.forEach((m) => {
+          if (!chatBox.querySelector(`[data-message-id="${m.id}"]`)) {
+            appendMessage(m.sender, m.message, m.timestamp, m.id, m.read, m.room);
+          }
+        });
+        break;
+
+      case "sync_complete":
+        if (data.has_more) {
+          // Too much was missed to stream; start over from the newest history page
+          chatBox.querySelectorAll(".msg").forEach((el) => el.remove());
+          historyCursor = null;
+          historyHasMore = true;
+          loadHistory();
+        }
+        break;
+
       case "online_users_list":
         updateOnlineUsersList(data.users);
         break;
@@ -189,14 +361,14 @@
         handleTypingIndicator(data.username, data.is_typing, messageRoom); // Pass messageRoom
         break;
 
-      case "read_receipt":
-        // This case handles the read receipt sent by the client to the server.
-        // The server will then broadcast 'read_receipt_update' back to the sender.
-        // No UI update needed here directly from this client-sent event.
+      case "read_watermark": // Peer has read everything up to data.message_id
+        if (data.reader !== me) {
+          updateReadReceipts(data.message_id);
+        }
         break;
 
-      case "read_receipt_update": // New event type from consumer
-        updateReadReceipt(data.message_id);
+      case "throttle": // The server dropped one of our frames for exceeding its budget
+        handleThrottle(data);
         break;
 
       case "missed_call":
@@ -204,14 +376,24 @@
         setTimeout(() => hidePopup("popup-message"), 4000);
         break;
 
-      case "end_call":
-        if (window.GlobalCallManager && window.GlobalCallManager.endCall) {
-          window.GlobalCallManager.endCall();
+      case "end_call": // Group calls; 1:1 calls end through call_state
+        if (window.GlobalCallManager && window.GlobalCallManager.finishCall) {
+          window.GlobalCallManager.finishCall();
           showPopup("popup-message", `${from} has ended the call.`);
           setTimeout(() => hidePopup("popup-message"), 4000);
         }
         break;
 
+      case "call_state": // 1:1 call lifecycle, decided by the server
+        if (window.GlobalCallManager && window.GlobalCallManager.handleCallState) {
+          const text = window.GlobalCallManager.handleCallState(data, me);
+          if (text) {
+            showPopup("popup-message", text);
+            setTimeout(() => hidePopup("popup-message"), 4000);
+          }
+        }
+        break;
+
       default:
         // Pass other messages to webrtc.js if it has a handler
         if (window.handleWebRTCMessage) {
@@ -239,14 +421,15 @@
           window.APP_CONTEXT.roomName // Pass current room for temporary message
         );
 
-        window.sendChatWS({
-          // Use the exposed sendChatWS
+        const payload = {
           type: "chat",
           message: message,
           room: window.APP_CONTEXT.roomName, // Use window.APP_CONTEXT.roomName
           recipient: window.APP_CONTEXT.peerUsername, // Include the recipient
           temp_message_id: tempMessageId, // Send temp ID to server
-        });
+        };
+        pendingMessages.set(tempMessageId, { payload, attempts: 1 });
+        window.sendChatWS(payload); // Use the exposed sendChatWS
         messageInput.value = "";
         sendTypingStatus(false); // Stop typing after sending message
       }
@@ -265,6 +448,15 @@
   }
 
   function sendTypingStatus(isTyping) {
+    // Only state changes and periodic refreshes are sent, not every keystroke
+    typingWanted = isTyping;
+    const now = Date.now();
+    if (isTyping && typingSent && now - typingSentAt < TYPING_REFRESH_MS) return;
+    if (!isTyping && !typingSent) return;
+    const blockedFor = (throttledUntil.typing || 0) - now;
+    if (blockedFor > 0) return; // handleThrottle resends the latest state when the budget allows
+    typingSent = isTyping;
+    typingSentAt = now;
     window.sendChatWS({
       // Use the exposed sendChatWS
       type: "typing",
@@ -274,6 +466,35 @@
     });
   }
 
+  function handleThrottle(data) {
+    const delay = Math.max(0, (data.retry_after || 0) * 1000);
+    throttledUntil[data.class] = Date.now() + delay;
+    if (data.class === "typing") {
+      // A typing frame was dropped; make sure the peer ends up with the latest state
+      typingSent = !typingWanted;
+      setTimeout(() => sendTypingStatus(typingWanted), delay);
+    }
+    const pending = data.temp_message_id && pendingMessages.get(data.temp_message_id);
+    if (!pending) return;
+    if (pending.attempts >= MAX_SEND_ATTEMPTS) {
+      pendingMessages.delete(data.temp_message_id);
+      markMessageFailed(data.temp_message_id);
+      return;
+    }
+    // Resend after the server's retry_after, backing off further on each attempt
+    pending.attempts++;
+    setTimeout(() => window.sendChatWS(pending.payload), delay * pending.attempts);
+  }
+
+  function markMessageFailed(tempMessageId) {
+    const msgDiv = chatBox.querySelector(`[data-message-id="${tempMessageId}"]`);
+    if (!msgDiv) return;
+    msgDiv.classList.add("msg--failed");
+    msgDiv.title = "Not delivered: you are sending messages too fast.";
+    const receipt = msgDiv.querySelector(".read-receipt");
+    if (receipt) receipt.innerHTML = '<i class="fas fa-exclamation-circle"></i>';
+  }
+
   function handleTypingIndicator(username, isTyping, messageRoom) {
     // Add messageRoom parameter
     if (messageRoom && messageRoom !== window.APP_CONTEXT.roomName) {
@@ -289,14 +510,16 @@
     }
   }
 
-  function updateReadReceipt(messageId) {
-    const readReceiptSpan = chatBox.querySelector(
-      `.read-receipt[data-message-id="${messageId}"]`
-    );
-    if (readReceiptSpan) {
-      readReceiptSpan.dataset.read = "true";
-      readReceiptSpan.innerHTML = '<i class="fas fa-check-double"></i>';
-    }
+  function updateReadReceipts(upToMessageId) {
+    chatBox
+      .querySelectorAll('.read-receipt[data-read="false"]')
+      .forEach((readReceiptSpan) => {
+        const messageId = readReceiptSpan.dataset.messageId;
+        if (isRealMessageId(messageId) && messageId <= upToMessageId) {
+          readReceiptSpan.dataset.read = "true";
+          readReceiptSpan.innerHTML = '<i class="fas fa-check-double"></i>';
+        }
+      });
   }
 
   function handleUserStatus(username, isOnline) {
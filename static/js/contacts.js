@@ -0,0 +1,101 @@
+// Contact directory - lazy-loads and searches the sidebar user list
+(() => {
+  "use strict";
+
+  const sidebarUsers = document.getElementById("sidebarUsers");
+  if (!sidebarUsers || !sidebarUsers.dataset.contactsUrl) return;
+
+  const scrollContainer = sidebarUsers.closest(".chat-list") || sidebarUsers;
+  const searchInput = document.querySelector(".sidebar__search input");
+  const activePeer = (window.APP_CONTEXT || {}).peerUsername;
+
+  let query = "";
+  let nextAfter = sidebarUsers.dataset.nextAfter || null;
+  let loading = false;
+  let searchTimer = null;
+
+  function buildContactItem(username) {
+    const li = document.createElement("li");
+    li.className = "chat-item";
+    if (username === activePeer) li.classList.add("is-active");
+    li.dataset.username = username;
+
+    const link = document.createElement("a");
+    link.className = "chat-item__link";
+    link.href = `/room/${encodeURIComponent(username)}/`;
+
+    const avatar = document.createElement("div");
+    avatar.className = "chat-item__avatar";
+    avatar.innerText = username.charAt(0).toUpperCase();
+
+    const meta = document.createElement("div");
+    meta.className = "chat-item__meta";
+    const top = document.createElement("div");
+    top.className = "chat-item__top";
+    const name = document.createElement("span");
+    name.className = "chat-item__name";
+    name.innerText = `@${username}`;
+    const status = document.createElement("span");
+    status.className = "user-status";
+    const time = document.createElement("span");
+    time.className = "chat-item__time";
+    top.append(name, status, time);
+    const last = document.createElement("div");
+    last.className = "chat-item__last";
+    meta.append(top, last);
+
+    link.append(avatar, meta);
+    li.appendChild(link);
+    return li;
+  }
+
+  async function loadContacts(reset) {
+    if (loading || (!reset && !nextAfter)) return;
+    loading = true;
+    try {
+      const url = new URL(sidebarUsers.dataset.contactsUrl, location.origin);
+      if (query) url.searchParams.set("q", query);
+      if (!reset && nextAfter) url.searchParams.set("after", nextAfter);
+      const response = await fetch(url, { credentials: "same-origin" });
+      if (!response.ok) throw new Error(`HTTP ${response.status}`);
+      const page = await response.json();
+
+      if (reset) sidebarUsers.innerHTML = "";
+      const fragment = document.createDocumentFragment();
+      page.contacts.forEach((c) => fragment.appendChild(buildContactItem(c.username)));
+      sidebarUsers.appendChild(fragment);
+      if (!sidebarUsers.children.length) {
+        const empty = document.createElement("li");
+        empty.className = "chat-item--empty";
+        empty.innerText = query ? "No matching users." : "No other users yet.";
+        sidebarUsers.appendChild(empty);
+      }
+      nextAfter = page.next_after;
+
+      // Lets chat.js refresh presence subscriptions for the newly shown users
+      window.dispatchEvent(new CustomEvent("contactsLoaded"));
+    } catch (error) {
+      console.error("[contacts.js] Failed to load contacts:", error);
+    } finally {
+      loading = false;
+    }
+  }
+
+  scrollContainer.addEventListener("scroll", () => {
+    const remaining =
+      scrollContainer.scrollHeight -
+      scrollContainer.scrollTop -
+      scrollContainer.clientHeight;
+    if (remaining < 120) loadContacts(false);
+  });
+
+  if (searchInput) {
+    searchInput.addEventListener("input", () => {
+      clearTimeout(searchTimer);
+      searchTimer = setTimeout(() => {
+        query = searchInput.value.trim();
+        loadContacts(true);
+      }, 250);
+    });
+  }
+})();
@@ -77,11 +77,9 @@
         }
       });
 
-      // Check for existing call state on page load
+      // Check for existing call state on page load.
+      // Unanswered and abandoned calls are ended by the server, which sends call_state.
       this.restoreCallState();
-
-      // Set up periodic cleanup of expired calls
-      setInterval(() => this.cleanupExpiredCalls(), 5000);
     },
 
     // Set local video stream
@@ -256,8 +254,8 @@
 
       try {
         const state = JSON.parse(stored);
-        // Expire calls older than 2 minutes
-        if (Date.now() - state.timestamp > 120000) {
+        // Drop a stale ringing popup left behind by a closed page
+        if (state.type === "incoming" && Date.now() - state.timestamp > 120000) {
           this.clearCallState();
           return null;
         }
@@ -356,6 +354,9 @@
             JSON.stringify({
               type: "reject",
               to: this.incomingCall.from,
+              is_group_call: Boolean(
+                this.incomingCall.isGroup || this.incomingCall.is_group_call
+              ),
             })
           );
         }
@@ -379,7 +380,11 @@
           );
         }
       }
+      this.finishCall();
+    },
 
+    // Tear down the local side of a call without notifying anyone
+    finishCall() {
       // Stop local stream
       if (this.localStream) {
         this.localStream.getTracks().forEach((track) => track.stop());
@@ -397,6 +402,41 @@
 
       this.clearCallState();
       this.hideCallWindow();
+      this.hideGlobalCallPopup();
+    },
+
+    // Handle a call_state frame from the server; returns popup text for the user, if any
+    handleCallState(data, me) {
+      if (data.state === "active") {
+        // Answered, possibly in another tab: stop ringing here
+        if (this.incomingCall && !this.currentCall) {
+          this.hideGlobalCallPopup();
+          this.clearCallState();
+        }
+        return null;
+      }
+      if (data.state !== "ended") return null;
+
+      this.finishCall();
+      if (data.ended_by === me) return null;
+      const peer = data.caller === me ? data.callee : data.caller;
+      const outgoing = data.caller === me;
+      switch (data.reason) {
+        case "missed":
+          return outgoing ? `${peer} didn't answer.` : `Missed call from ${peer}`;
+        case "cancelled":
+          return outgoing ? null : `Missed call from ${peer}`;
+        case "rejected":
+          return `${peer} declined the call.`;
+        case "busy":
+          return `${peer} is on another call.`;
+        case "in_call":
+          return "You are already in a call.";
+        case "disconnected":
+          return `Lost connection with ${peer}. Call ended.`;
+        default:
+          return `${peer} has ended the call.`;
+      }
     },
 
     // Show global call popup (for incoming calls)
@@ -487,18 +527,6 @@
       });
       window.dispatchEvent(event);
     },
-
-    // Clean up expired calls
-    cleanupExpiredCalls() {
-      const state = this.getCallState();
-      if (!state) return;
-
-      // Remove calls older than 2 minutes
-      if (Date.now() - state.timestamp > 120000) {
-        this.endCall(); // Use endCall to ensure all resources are properly released
-        this.hideGlobalCallPopup();
-      }
-    },
   };
 
   // Initialize when DOM is ready
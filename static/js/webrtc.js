@@ -25,6 +25,9 @@
   const GlobalCallManager = window.GlobalCallManager;
 
   let ws; // Declare ws once here
+  // Acknowledge received frames every ACK_EVERY_FRAMES frames, or after ACK_INTERVAL_MS (see chat/outbound.py)
+  const ACK_EVERY_FRAMES = 32;
+  const ACK_INTERVAL_MS = 1000;
   let localStream;
   let peerConnections = {}; // Use an object for multiple peer connections in group calls
   let isMuted = false;
@@ -115,11 +118,8 @@
         break;
 
       case "end_call":
-        GlobalCallManager.endCall();
-        break;
-
       case "reject":
-        GlobalCallManager.endCall();
+        GlobalCallManager.finishCall();
         break;
     }
   };
@@ -156,6 +156,16 @@
 
     ws = new WebSocket(wsUrl);
     GlobalCallManager.currentWebSocket = ws;
+    // Frames received on this socket, acknowledged so the server can tell a slow client from a fast one
+    let framesReceived = 0;
+    let framesAcked = 0;
+    const sendAck = () => {
+      if (framesReceived > framesAcked && ws.readyState === WebSocket.OPEN) {
+        framesAcked = framesReceived;
+        ws.send(JSON.stringify({ type: "ack", frames: framesReceived }));
+      }
+    };
+    const ackTimer = setInterval(sendAck, ACK_INTERVAL_MS);
 
     ws.onopen = async () => {
       log("WebRTC WS open");
@@ -171,6 +181,8 @@
     };
 
     ws.onmessage = async (evt) => {
+      framesReceived++;
+      if (framesReceived - framesAcked >= ACK_EVERY_FRAMES) sendAck();
       const data = JSON.parse(evt.data);
       console.log("[webrtc.js] WS message received:", data);
       if (
@@ -178,7 +190,11 @@
         data.type === "user_status" ||
         data.type === "online_users_list" ||
         data.type === "typing_indicator" ||
-        data.type === "read_receipt"
+        data.type === "read_watermark" ||
+        data.type === "sync_batch" ||
+        data.type === "sync_complete" ||
+        data.type === "throttle" ||
+        data.type === "call_state"
       ) {
         if (window.handleChatMessage) {
           window.handleChatMessage(data);
@@ -193,6 +209,7 @@
     };
 
     ws.onclose = () => {
+      clearInterval(ackTimer);
       log("WebRTC WS closed. Reconnecting in 1.5 seconds...");
       setTimeout(window.connectWebRTCWS, 1500); // Use window.connectWebRTCWS for global access
     };
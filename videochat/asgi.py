@@ -1,19 +1,19 @@
 import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
-from channels.auth import AuthMiddlewareStack # Import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "videochat.settings")
 
 django_asgi_app = get_asgi_application()
 
+from chat.jwt_auth import JWTAuthMiddlewareStack
 from chat.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack( # Use AuthMiddlewareStack for session authentication
+        JWTAuthMiddlewareStack( # JWT cookie/subprotocol first, session authentication as the fallback
             URLRouter(websocket_urlpatterns)
         )
     ),
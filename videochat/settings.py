@@ -60,11 +60,16 @@ TEMPLATES = [
 ROOT_URLCONF = 'videochat.urls'
 ASGI_APPLICATION = 'videochat.asgi.application'
 
+# Comma-separated Redis URLs; groups and channels are spread over them with a consistent hash
+CHANNEL_REDIS_URLS = [u.strip() for u in os.getenv("CHANNEL_REDIS_URLS", os.getenv("REDIS_URL", "redis://localhost:6379/0")).split(",") if u.strip()]
+# "core" (list-backed, buffered delivery) or "pubsub" (lower fan-out latency, at-most-once)
+CHANNEL_LAYER_BACKEND = os.getenv("CHANNEL_LAYER_BACKEND", "core")
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "chat.sharding.ShardedRedisPubSubChannelLayer" if CHANNEL_LAYER_BACKEND == "pubsub" else "chat.sharding.ShardedRedisChannelLayer",
         "CONFIG": {
-            "hosts": [os.getenv("REDIS_URL", "redis://localhost:6379/0")],
+            "hosts": CHANNEL_REDIS_URLS,
         },
     },
 }
@@ -95,6 +100,11 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_EXP_CLAIM': 'refresh_exp',
     'SLIDING_TOKEN_LIFETIME': timedelta(minutes=5),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
+    # Cookie the login view stores the access token in; WebSocket connects authenticate with it
+    'AUTH_COOKIE': 'access_token',
+    'AUTH_COOKIE_SECURE': not DEBUG,
+    'AUTH_COOKIE_HTTP_ONLY': True,
+    'AUTH_COOKIE_SAMESITE': 'Lax',
 }
 
 DATABASES = {
@@ -112,6 +122,10 @@ LOGOUT_REDIRECT_URL = '/accounts/login/'
 # --- MongoDB from .env ---
 MONGO_URI = os.getenv("MONGO_URI", "")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "")
+# Connection pool tuning, shared by the sync (views) and async (consumers) clients
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "200"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000"))
 
 mongo_client = None
 mongo_db = None
@@ -172,3 +186,141 @@ CACHES = {
 VAPID_PUBLIC_KEY = os.getenv("VAPID_PUBLIC_KEY", "BP_YOUR_PUBLIC_KEY_HERE")
 VAPID_PRIVATE_KEY = os.getenv("VAPID_PRIVATE_KEY", "YOUR_PRIVATE_KEY_HERE")
 VAPID_ADMIN_EMAIL = os.getenv("VAPID_ADMIN_EMAIL", "mailto:your_email@example.com")
+
+# Write-behind batching for chat messages (see chat/persistence.py)
+CHAT_WRITE_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", "100"))
+CHAT_WRITE_FLUSH_INTERVAL = float(os.getenv("CHAT_WRITE_FLUSH_INTERVAL", "0.05"))
+CHAT_WRITE_MAX_QUEUE = int(os.getenv("CHAT_WRITE_MAX_QUEUE", "10000"))
+# Longest backoff (seconds) between attempts at a batch that failed to write; a failing
+# batch is retried until CHAT_WRITE_MAX_QUEUE messages are waiting behind it
+CHAT_WRITE_RETRY_MAX = float(os.getenv("CHAT_WRITE_RETRY_MAX", "5"))
+
+# Maximum number of users a single socket may subscribe to for presence updates
+PRESENCE_MAX_INTEREST = int(os.getenv("PRESENCE_MAX_INTEREST", "500"))
+
+# Presence heartbeat: connections not refreshed within PRESENCE_TTL seconds are swept as offline
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "60"))
+PRESENCE_HEARTBEAT_INTERVAL = int(os.getenv("PRESENCE_HEARTBEAT_INTERVAL", "20"))
+PRESENCE_SWEEP_BATCH = int(os.getenv("PRESENCE_SWEEP_BATCH", "500"))
+
+# Room history API page sizes (see chat.views.room_history)
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", "50"))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", "200"))
+
+# Read receipts are coalesced per room for this many seconds before the watermark is written
+READ_WATERMARK_WINDOW = float(os.getenv("READ_WATERMARK_WINDOW", "0.5"))
+
+# Web push dispatch (see chat/push.py)
+PUSH_WORKERS = int(os.getenv("PUSH_WORKERS", "4"))
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", "50"))
+PUSH_MAX_QUEUE = int(os.getenv("PUSH_MAX_QUEUE", "10000"))
+PUSH_MAX_RETRIES = int(os.getenv("PUSH_MAX_RETRIES", "3"))
+PUSH_CACHE_TTL = int(os.getenv("PUSH_CACHE_TTL", "300"))
+
+# Sidebar contact directory (see chat/directory.py)
+CONTACTS_PAGE_SIZE = int(os.getenv("CONTACTS_PAGE_SIZE", "50"))
+CONTACTS_MAX_PAGE_SIZE = int(os.getenv("CONTACTS_MAX_PAGE_SIZE", "200"))
+CONTACTS_CACHE_TTL = int(os.getenv("CONTACTS_CACHE_TTL", "300"))
+
+# Typing indicators: repeats within TYPING_REFRESH_INTERVAL are dropped, and a stop is sent after TYPING_TIMEOUT of silence
+TYPING_REFRESH_INTERVAL = float(os.getenv("TYPING_REFRESH_INTERVAL", "3"))
+TYPING_TIMEOUT = float(os.getenv("TYPING_TIMEOUT", "6"))
+
+# Reconnect catch-up ("sync" frames): batch size and caps per request
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "100"))
+SYNC_MAX_MESSAGES = int(os.getenv("SYNC_MAX_MESSAGES", "1000"))
+SYNC_MAX_ROOMS = int(os.getenv("SYNC_MAX_ROOMS", "20"))
+# Catch-up re-reads this far before the last-seen id to cover clock skew between workers
+SYNC_OVERLAP_SECONDS = int(os.getenv("SYNC_OVERLAP_SECONDS", "2"))
+
+# Group conversations (see chat/groups.py): membership cache TTL, groups per user, unread badge cap
+GROUP_CACHE_TTL = int(os.getenv("GROUP_CACHE_TTL", "60"))
+GROUP_MAX_PER_USER = int(os.getenv("GROUP_MAX_PER_USER", "500"))
+GROUP_UNREAD_COUNT_CAP = int(os.getenv("GROUP_UNREAD_COUNT_CAP", "99"))
+# Largest group, creator included
+GROUP_MAX_MEMBERS = int(os.getenv("GROUP_MAX_MEMBERS", "256"))
+
+# Presence store shards (comma-separated, defaults to REDIS_URL); kept on their own blocking connection pools
+PRESENCE_REDIS_URLS = os.getenv("PRESENCE_REDIS_URLS", os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+PRESENCE_REDIS_MAX_CONNECTIONS = int(os.getenv("PRESENCE_REDIS_MAX_CONNECTIONS", "50"))
+PRESENCE_REDIS_POOL_TIMEOUT = int(os.getenv("PRESENCE_REDIS_POOL_TIMEOUT", "5"))
+
+# Bearer token required by /metrics; when empty the endpoint is closed unless
+# METRICS_ALLOW_LOOPBACK=1, which lets unauthenticated loopback requests through. Only enable
+# that when no reverse proxy on the same host forwards public traffic to this server.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_ALLOW_LOOPBACK = os.getenv("METRICS_ALLOW_LOOPBACK", "0") == "1"
+
+# Logging for the chat stack (see chat/log.py): JSON lines written off the event loop.
+# CHAT_LOG_LEVELS overrides single categories, e.g. "consumer=DEBUG,presence=WARNING".
+CHAT_LOG_LEVEL = os.getenv("CHAT_LOG_LEVEL", "INFO").upper()
+CHAT_LOG_LEVELS = os.getenv("CHAT_LOG_LEVELS", "")
+CHAT_LOG_JSON = os.getenv("CHAT_LOG_JSON", "1") == "1"
+# High-frequency events (per-frame logs on chat.frames) are sampled 1 in N when enabled
+CHAT_LOG_SAMPLE_RATE = int(os.getenv("CHAT_LOG_SAMPLE_RATE", "100"))
+
+from chat.log import apply_levels # Stdlib-only module, safe to import while settings load
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "sample": {"()": "chat.log.SamplingFilter", "rate": CHAT_LOG_SAMPLE_RATE},
+    },
+    "handlers": {
+        "chat_queue": {"()": "chat.log.QueueLogHandler", "json_format": CHAT_LOG_JSON},
+    },
+    "loggers": apply_levels({
+        "chat": {"handlers": ["chat_queue"], "level": CHAT_LOG_LEVEL, "propagate": False},
+        "chat.frames": {"filters": ["sample"]},
+    }, CHAT_LOG_LEVELS),
+}
+
+# Retention (see chat/buckets.py and the compact_chats command). 0 disables a tier.
+# Notifications and call logs expire through a TTL index after this many days. Opt-in: enabling it
+# deletes existing entries older than the period on the next start
+NOTIFICATION_RETENTION_DAYS = int(os.getenv("NOTIFICATION_RETENTION_DAYS", "0"))
+# Chat messages older than this are packed into per-room buckets of up to CHAT_BUCKET_MAX_MESSAGES
+CHAT_BUCKET_AFTER_DAYS = int(os.getenv("CHAT_BUCKET_AFTER_DAYS", "0"))
+CHAT_BUCKET_MAX_MESSAGES = int(os.getenv("CHAT_BUCKET_MAX_MESSAGES", "200"))
+CHAT_BUCKET_SPAN_HOURS = int(os.getenv("CHAT_BUCKET_SPAN_HOURS", "24"))
+# Messages and buckets older than this move to db.chat_archive and drop out of the history API
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "0"))
+
+# Seconds a user resolved from a WebSocket JWT is cached before the row is read again
+WS_AUTH_USER_CACHE_TTL = int(os.getenv("WS_AUTH_USER_CACHE_TTL", "60"))
+
+# Per-socket outbound buffer (see chat/outbound.py): above the high-water mark typing and
+# presence frames are dropped; above the maximum the socket is closed with code 4008
+OUTBOUND_HIGH_WATER_BYTES = int(os.getenv("OUTBOUND_HIGH_WATER_BYTES", str(256 * 1024)))
+OUTBOUND_MAX_BYTES = int(os.getenv("OUTBOUND_MAX_BYTES", str(1024 * 1024)))
+
+# Also carry msgpack in every broadcast event (see chat/codec.py); worth it only when most sockets
+# negotiate chat.msgpack.v1, otherwise compact sockets re-encode the JSON text themselves
+WS_PREPACK_MSGPACK = os.getenv("WS_PREPACK_MSGPACK", "0") == "1"
+
+# Inbound WebSocket frame budgets (see chat/ratelimit.py) as "<class>=<rate per second>/<burst>";
+# classes are chat, typing, signaling and other. A class left out is not limited.
+WS_RATE_LIMITS = os.getenv("WS_RATE_LIMITS", "chat=5/20,typing=10/30,signaling=50/200,other=10/40")
+# Optional budgets per user, shared by all of a user's sockets across workers via the presence Redis
+WS_USER_RATE_LIMITS = os.getenv("WS_USER_RATE_LIMITS", "")
+
+# Attachments (see chat/attachments.py), stored once per content hash. Kept outside MEDIA_ROOT
+# so they are only reachable through the access-checked attachment views, never as media files
+ATTACHMENT_ROOT = os.getenv("ATTACHMENT_ROOT", str(BASE_DIR / "attachments"))
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(100 * 1024 * 1024)))
+ATTACHMENT_CHUNK_MAX_BYTES = int(os.getenv("ATTACHMENT_CHUNK_MAX_BYTES", str(8 * 1024 * 1024)))
+# Uploads with no new chunk for this long are removed by compact_chats
+ATTACHMENT_UPLOAD_EXPIRY_HOURS = int(os.getenv("ATTACHMENT_UPLOAD_EXPIRY_HOURS", "24"))
+# Thumbnails for images need Pillow; they are made on a small thread pool off the request path
+ATTACHMENT_THUMBNAIL_SIZE = int(os.getenv("ATTACHMENT_THUMBNAIL_SIZE", "320"))
+ATTACHMENT_THUMBNAIL_WORKERS = int(os.getenv("ATTACHMENT_THUMBNAIL_WORKERS", "2"))
+
+# 1:1 call sessions (see chat/calls.py), kept on the first presence Redis shard.
+# Unanswered calls end as missed after CALL_RING_SECONDS
+CALL_RING_SECONDS = int(os.getenv("CALL_RING_SECONDS", "45"))
+# How long an active call survives a participant's socket going away before it ends
+CALL_RECONNECT_GRACE = int(os.getenv("CALL_RECONNECT_GRACE", "30"))
+# Backstop expiry for call keys in case no worker ends the call
+CALL_MAX_SECONDS = int(os.getenv("CALL_MAX_SECONDS", str(4 * 3600)))
+CALL_SWEEP_INTERVAL = int(os.getenv("CALL_SWEEP_INTERVAL", "2"))